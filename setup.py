@@ -24,7 +24,6 @@ setup(
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Natural Language :: English",
-        "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
         "Programming Language :: Python :: 3.10"
@@ -32,18 +31,22 @@ setup(
     description="Python URL Shortener",
     include_package_data=True,
     install_requires=[
+        "aiosqlite==0.20.0",
+        "asyncpg==0.29.0",
         "autopep8==1.6.0",
         "build==0.8.0",
         "fastapi==0.78.0",
+        "httpx==0.22.0",
         "jinja2==3.1.2",
         "multipart==0.2.4",
+        "orjson==3.8.3",
         "psycopg2-binary==2.9.3",
         "pytest==7.1.2",
         "pytest-cov==3.0.0",
         "python_multipart==0.0.5",
         "requests==2.28.0",
         "setuptools_rust==1.3.0",
-        "sqlalchemy==1.4",
+        "sqlalchemy[asyncio]==2.0.36",
         "sqlalchemy_serializer==1.4.1",
         "supertokens-python==0.8.4",
         "uvicorn[standard]==0.17.6",
@@ -55,6 +58,7 @@ setup(
     long_description=readme,
     name="shtl-ink-api",
     packages=find_packages(include=["shtl_ink_api"]),
+    python_requires=">=3.8",
     url="https://github.com/mskymoore/url_shortener",
     version="0.1.0",
     zip_safe=True,
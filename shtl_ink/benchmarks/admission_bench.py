@@ -0,0 +1,130 @@
+"""
+Redirect latency under a write flood benchmark.
+
+Sends GET /{short_code} requests in process through the RedirectFastPath, with the redirect
+cache off so every redirect needs a pooled connection, first on an idle worker and then
+while --writers clients send POST /create_short_code as fast as they are answered, once
+with admission control off and once on, and reports redirect p50/p99 and write outcomes.
+
+usage: python -m benchmarks.admission_bench [--writers N] [--redirects N] [--pool-size N]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+from collections import Counter
+from time import perf_counter
+import httpx
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from shtl_ink_api.app import app, get_db_router, redirect_cache, admission
+from shtl_ink_api.auth import init_auth
+from shtl_ink_api.routing import ReadWriteRouter
+from shtl_ink_api.fastpath import RedirectFastPath
+from shtl_ink_api.models import ShortURLModel, Base, url_hash
+
+DATABASE_PATH = "admission_bench.db.sqlite"
+
+
+def percentiles(seconds: list) -> dict:
+    cuts = statistics.quantiles(seconds, n=100)
+    return {"p50_ms": cuts[49] * 1e3, "p99_ms": cuts[98] * 1e3}
+
+
+async def time_redirects(client, count: int) -> list:
+    timings = []
+
+    for i in range(count):
+        start = perf_counter()
+        response = await client.get(f"/c{i % 100}")
+        assert response.status_code == 307
+        timings.append(perf_counter() - start)
+
+    return timings
+
+
+async def write(client, writer: str, stop: asyncio.Event, outcomes: Counter) -> None:
+    i = 0
+
+    while not stop.is_set():
+        i += 1
+        response = await client.post(
+            "/create_short_code", json={"url": f"https://example.com/{writer}/{i}"})
+        outcomes[response.status_code] += 1
+
+        # a rejected client waits as told, like a well behaved one would
+        if response.status_code in (429, 503):
+            await asyncio.sleep(min(float(response.headers["retry-after"]), 0.05))
+
+
+async def run(writers: int, redirects: int, pool_size: int) -> list:
+    # sqlite files get no pool by default, give it one as small as a busy postgres pool
+    async_engine = create_async_engine(
+        f"sqlite+aiosqlite:///{DATABASE_PATH}", poolclass=AsyncAdaptedQueuePool,
+        pool_size=pool_size, max_overflow=0)
+    router = ReadWriteRouter(async_engine)
+    app.dependency_overrides[get_db_router] = lambda: router
+    app.state.db_router = router
+    fast_app = RedirectFastPath(app, async_engine, redirect_cache)
+    redirect_cache.max_size = 0
+    init_auth()
+    results = []
+
+    async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=fast_app), base_url="http://bench") as client:
+        await time_redirects(client, 10)
+        results.append({"flood": False, **percentiles(await time_redirects(client, redirects))})
+
+        # off, then a concurrency limit leaving one pooled connection for redirects
+        for rate, max_concurrent in ((0, 0), (admission.rate, pool_size - 1)):
+            admission.rate, admission.max_concurrent = rate, max_concurrent
+            admission.buckets.clear()
+            stop = asyncio.Event()
+            outcomes = Counter()
+            flood = [
+                asyncio.ensure_future(write(client, f"{rate}/{writer}", stop, outcomes))
+                for writer in range(writers)]
+            timings = await time_redirects(client, redirects)
+            stop.set()
+            await asyncio.gather(*flood)
+            results.append({
+                "flood": True,
+                "admission_control": max_concurrent > 0,
+                **percentiles(timings),
+                "writes": {str(status): count for status, count in sorted(outcomes.items())}
+            })
+
+    await async_engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--writers", type=int, default=50)
+    parser.add_argument("--redirects", type=int, default=500)
+    parser.add_argument("--pool-size", type=int, default=4)
+    args = parser.parse_args()
+
+    if os.path.exists(DATABASE_PATH):
+        os.remove(DATABASE_PATH)
+
+    engine = create_engine(f"sqlite:///{DATABASE_PATH}")
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as connection:
+        connection.execute(insert(ShortURLModel), [
+            {"owner_id": "anonymous", "url": f"https://example.com/{i}",
+             "url_hash": url_hash(f"https://example.com/{i}"), "short_code": f"c{i}"}
+            for i in range(100)])
+
+    engine.dispose()
+    results = asyncio.run(run(args.writers, args.redirects, args.pool_size))
+    os.remove(DATABASE_PATH)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Capacity and collision benchmark for short code allocation.
+
+Compares the random seed * multiplier scheme Codec.url_encode used to use with the
+ShortCodeAllocator, allocating a code for every url in data/input_urls.txt (repeated
+--scale times) against an in memory set standing in for the primary key.
+
+usage: python -m benchmarks.allocator_bench [--urls PATH] [--scale N]
+"""
+
+import argparse
+import json
+import os
+import random
+from time import perf_counter
+from shtl_ink_api.allocator import ShortCodeAllocator
+
+ALPHABET = '23456789bcdfghjkmnpqrstvwxyzBCDFGHJKLMNPQRSTVWXYZ'
+DEFAULT_URLS = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'input_urls.txt')
+# the old scheme recursed without bound, give up on a url after this many tries
+MAX_RETRIES = 1000
+
+
+def random_short_code(multiplier: int) -> str:
+    """
+    the short code generation Codec.url_encode used before the allocator
+    """
+    base = len(ALPHABET) - 1
+    shift_bits = 12
+    short_code = ''
+    key = random.randint(3333, 13983816) * multiplier
+
+    for _ in range(2, 8):
+        short_code += ALPHABET[(key >> shift_bits) & base]
+        shift_bits -= 2
+
+    return short_code
+
+
+def random_capacity() -> int:
+    """
+    number of distinct codes the old scheme can produce, masking with len(ALPHABET) - 1
+    (0b110000) only ever selects alphabet positions 0, 16, 32 and 48
+    """
+    base = len(ALPHABET) - 1
+    reachable = {index & base for index in range(len(ALPHABET))}
+    return len(reachable) ** 6
+
+
+def run_random(count: int) -> dict:
+    taken = set()
+    retries = 0
+    failures = 0
+    start = perf_counter()
+
+    for _ in range(count):
+        multiplier = 333
+
+        for _ in range(MAX_RETRIES):
+            short_code = random_short_code(multiplier)
+
+            if short_code not in taken:
+                taken.add(short_code)
+                break
+
+            retries += 1
+            multiplier += random.choice(range(2, 8))
+
+        else:
+            failures += 1
+
+    elapsed = perf_counter() - start
+    return {
+        "scheme": "random",
+        "capacity": random_capacity(),
+        "allocated": len(taken),
+        "failures": failures,
+        "retries": retries,
+        "retries_per_code": retries / count,
+        "us_per_code": elapsed / count * 1e6
+    }
+
+
+def run_allocator(count: int) -> dict:
+    allocator = ShortCodeAllocator(ALPHABET, 6, "benchmark", 1000)
+    taken = set()
+    collisions = 0
+    start = perf_counter()
+
+    for id in range(count):
+        short_code = allocator.short_code(id)
+
+        if short_code in taken:
+            collisions += 1
+
+        taken.add(short_code)
+
+    elapsed = perf_counter() - start
+    return {
+        "scheme": "allocator",
+        "capacity": allocator.capacity,
+        "allocated": len(taken),
+        "failures": 0,
+        "retries": collisions,
+        "retries_per_code": collisions / count,
+        "us_per_code": elapsed / count * 1e6
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--urls", default=DEFAULT_URLS)
+    parser.add_argument("--scale", type=int, default=10)
+    args = parser.parse_args()
+
+    with open(args.urls, 'r') as file:
+        count = len(file.read().splitlines()) * args.scale
+
+    print(json.dumps({
+        "urls": count,
+        "results": [run_random(count), run_allocator(count)]
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Bulk import and export benchmark.
+
+Loads the urls of data/input_urls.txt (repeated --scale times) into an empty sqlite
+database the way seeding used to work, one Codec.encode() and commit per url, and with
+bulk.import_records() in batched transactions, then exports the table with
+bulk.export_records(), and reports rows/sec for each.
+
+usage: python -m benchmarks.bulk_bench [--urls PATH] [--scale N] [--batch-size N]
+"""
+
+import argparse
+import io
+import json
+import os
+import tempfile
+from time import perf_counter
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from shtl_ink_api.models import Base
+from shtl_ink_api.codec import Codec
+from shtl_ink_api.bulk import read_records, import_records, export_records
+
+DEFAULT_URLS = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'data', 'input_urls.txt')
+
+
+def empty_engine(directory: str, name: str):
+    engine = create_engine(f"sqlite:///{os.path.join(directory, name)}")
+    Base.metadata.create_all(bind=engine)
+    return engine
+
+
+def rate(rows: int, seconds: float) -> dict:
+    return {"rows": rows, "seconds": seconds, "rows_per_sec": rows / seconds}
+
+
+def run(urls: list, batch_size: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        engine = empty_engine(directory, "encode.db")
+        codec = Codec()
+        start = perf_counter()
+
+        with Session(engine) as session:
+            for url in urls:
+                codec.encode(url, "anonymous", session)
+
+        encode = rate(len(urls), perf_counter() - start)
+        engine.dispose()
+
+        engine = empty_engine(directory, "import.db")
+        start = perf_counter()
+        imported, _ = import_records(
+            [engine], read_records(io.StringIO("\n".join(urls)), 'txt'),
+            batch_size=batch_size)
+        bulk_import = rate(imported, perf_counter() - start)
+
+        start = perf_counter()
+        exported = export_records([engine], io.StringIO(), 'ndjson', batch_size=batch_size)
+        bulk_export = rate(exported, perf_counter() - start)
+        engine.dispose()
+
+    return {
+        "encode_per_url": encode,
+        "import_records": bulk_import,
+        "export_records": bulk_export,
+        "import_speedup": bulk_import["rows_per_sec"] / encode["rows_per_sec"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--urls", default=DEFAULT_URLS)
+    parser.add_argument("--scale", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    with open(args.urls, 'r') as file:
+        urls = file.read().splitlines() * args.scale
+
+    print(json.dumps({"urls": len(urls), **run(urls, args.batch_size)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compact schema size benchmark.
+
+Seeds a sqlite database with --rows short codes from the allocator, one in --custom-every
+of them custom, for --owners owners shortening --urls urls between them, copies them
+into the compact schema with compact.migrate_compact(), and reports the bytes, pages and
+rows per leaf page of short_code_to_url and of the compact tables, with their indexes,
+read from sqlite's dbstat table.
+
+usage: python -m benchmarks.compact_bench [--rows N] [--owners N] [--urls N]
+    pass --rows 10000000 for the full run, it takes a while
+"""
+
+import argparse
+import json
+import os
+import uuid
+from time import perf_counter
+from sqlalchemy import create_engine, insert, text
+from shtl_ink_api.models import ShortURLModel, Base, url_hash
+from shtl_ink_api.allocator import ShortCodeAllocator
+from shtl_ink_api.codec import Codec
+from shtl_ink_api.compact import migrate_compact
+
+DATABASE_PATH = "compact_bench.db.sqlite"
+SEED_BATCH_SIZE = 10000
+ROW_SCHEMA = ['short_code_to_url']
+COMPACT_SCHEMA = ['owners', 'url_bodies', 'compact_short_codes', 'compact_custom_short_codes']
+
+
+def seed(engine, rows: int, owners: int, urls: int, custom_every: int) -> None:
+    codec = Codec()
+    allocator = ShortCodeAllocator(codec.alphabet, codec.length, "compact bench", 1)
+
+    for batch_start in range(0, rows, SEED_BATCH_SIZE):
+        records = []
+
+        for i in range(batch_start, min(batch_start + SEED_BATCH_SIZE, rows)):
+            url = f"https://example.com/campaign/{i % urls}/landing?utm_source=newsletter"
+            custom = i % custom_every == 0
+            records.append({
+                "short_code": f"custom-{i}" if custom else allocator.short_code(i),
+                # supertokens user ids are uuids, each pass over the urls moves every url
+                # to another owner, an owner shortens a url once
+                "owner_id": str(uuid.UUID(int=(i // urls + i * 7919) % owners)), "url": url,
+                "url_hash": url_hash(url), "canonical": None if custom else True})
+
+        with engine.begin() as connection:
+            connection.execute(insert(ShortURLModel), records)
+
+
+def sizes(engine, tables: list, rows: int) -> dict:
+    with engine.connect() as connection:
+        # every btree of the tables, the table itself and each of its indexes
+        btrees = {name: table for name, table in connection.execute(text(
+            "SELECT name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')"))
+            if table in tables}
+        report = {}
+
+        for name, pages, bytes, leaf_pages, leaf_cells in connection.execute(text(
+                "SELECT name, count(*), sum(pgsize), "
+                "sum(pagetype = 'leaf'), sum(CASE WHEN pagetype = 'leaf' THEN ncell END) "
+                "FROM dbstat GROUP BY name")):
+            if name in btrees:
+                report[name] = {
+                    "bytes": bytes, "pages": pages,
+                    "rows_per_leaf_page": leaf_cells / leaf_pages if leaf_pages else 0}
+
+    total = sum(btree["bytes"] for btree in report.values())
+    return {"bytes": total, "bytes_per_short_code": total / rows, "btrees": report}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--owners", type=int, default=1000)
+    parser.add_argument("--urls", type=int, default=20000)
+    parser.add_argument("--custom-every", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.rows > args.owners * args.urls:
+        parser.error("--rows can be at most --owners times --urls")
+
+    if os.path.exists(DATABASE_PATH):
+        os.remove(DATABASE_PATH)
+
+    engine = create_engine(f"sqlite:///{DATABASE_PATH}")
+    Base.metadata.create_all(bind=engine)
+    seed(engine, args.rows, args.owners, args.urls, args.custom_every)
+    start = perf_counter()
+    copied, _ = migrate_compact(engine)
+    seconds = perf_counter() - start
+    row_schema = sizes(engine, ROW_SCHEMA, args.rows)
+    compact_schema = sizes(engine, COMPACT_SCHEMA, args.rows)
+    engine.dispose()
+    os.remove(DATABASE_PATH)
+
+    print(json.dumps({
+        "rows": args.rows,
+        "migrate": {"rows": copied, "seconds": seconds, "rows_per_sec": copied / seconds},
+        "short_code_to_url": row_schema,
+        "compact": compact_schema,
+        "size_ratio": compact_schema["bytes"] / row_schema["bytes"]
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
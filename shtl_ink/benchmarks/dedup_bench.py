@@ -0,0 +1,94 @@
+"""
+Create dedup lookup benchmark.
+
+Seeds a sqlite database with growing numbers of rows for a handful of owners and times
+the dedup lookup create_short_code runs before every create, once as the old url and
+owner_id scan and once as the (owner_id, url_hash) index probe.
+
+usage: python -m benchmarks.dedup_bench [--sizes 1000,10000,100000] [--probes N]
+    pass --sizes 1000,10000,100000,1000000,10000000 for the full run, it takes a while
+"""
+
+import argparse
+import json
+import os
+import statistics
+from time import perf_counter
+from sqlalchemy import create_engine, insert, select
+from shtl_ink_api.models import ShortURLModel, Base, url_hash
+
+DATABASE_PATH = "dedup_bench.db.sqlite"
+OWNERS = 16
+SEED_BATCH_SIZE = 10000
+
+
+def seed(engine, start: int, stop: int) -> None:
+    for batch_start in range(start, stop, SEED_BATCH_SIZE):
+        rows = []
+
+        for i in range(batch_start, min(batch_start + SEED_BATCH_SIZE, stop)):
+            url = f"https://example.com/campaign/{i}"
+            rows.append({"owner_id": f"owner{i % OWNERS}", "url": url,
+                         "url_hash": url_hash(url), "short_code": f"c{i}"})
+
+        with engine.begin() as connection:
+            connection.execute(insert(ShortURLModel), rows)
+
+
+def time_lookups(engine, statements) -> float:
+    timings = []
+
+    with engine.connect() as connection:
+        for statement in statements:
+            start = perf_counter()
+            connection.execute(statement).first()
+            timings.append(perf_counter() - start)
+
+    return statistics.median(timings) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--probes", type=int, default=200)
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+
+    if os.path.exists(DATABASE_PATH):
+        os.remove(DATABASE_PATH)
+
+    engine = create_engine(f"sqlite:///{DATABASE_PATH}")
+    Base.metadata.create_all(bind=engine)
+    results = []
+    seeded = 0
+
+    for size in sizes:
+        seed(engine, seeded, size)
+        seeded = size
+        # half the probes hit existing rows, half miss like a fresh create would
+        urls = [f"https://example.com/campaign/{(i * 7919) % (size * 2)}"
+                for i in range(args.probes)]
+        owners = [f"owner{(i * 7919) % OWNERS}" for i in range(args.probes)]
+
+        scans = [select(ShortURLModel).where(
+            ShortURLModel.url == url, ShortURLModel.owner_id == owner)
+            for url, owner in zip(urls, owners)]
+        probes = [select(ShortURLModel).where(
+            ShortURLModel.owner_id == owner,
+            ShortURLModel.url_hash == url_hash(url),
+            ShortURLModel.url == url)
+            for url, owner in zip(urls, owners)]
+
+        results.append({
+            "rows": size,
+            "url_scan_p50_us": time_lookups(engine, scans),
+            "url_hash_index_p50_us": time_lookups(engine, probes)
+        })
+
+    engine.dispose()
+    os.remove(DATABASE_PATH)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
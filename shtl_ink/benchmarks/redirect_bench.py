@@ -0,0 +1,92 @@
+"""
+Redirect overhead benchmark.
+
+Sends GET /{short_code} requests in process through an ASGI transport, once to the FastAPI
+app and once to the RedirectFastPath in front of it, with the redirect cache off (every
+request reads the database) and on, and reports the mean time per request.
+
+usage: python -m benchmarks.redirect_bench [--codes N] [--requests N]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from time import perf_counter
+import httpx
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from shtl_ink_api.app import app, get_db_router, redirect_cache
+from shtl_ink_api.routing import ReadWriteRouter
+from shtl_ink_api.fastpath import RedirectFastPath
+from shtl_ink_api.models import ShortURLModel, Base, url_hash
+
+DATABASE_PATH = "redirect_bench.db.sqlite"
+
+
+async def time_requests(asgi_app, short_codes) -> float:
+    async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=asgi_app), base_url="http://bench") as client:
+        # warm up pools and statement caches
+        await client.get(f"/{short_codes[0]}")
+        start = perf_counter()
+
+        for short_code in short_codes:
+            response = await client.get(f"/{short_code}")
+            assert response.status_code == 307
+
+        return (perf_counter() - start) / len(short_codes) * 1e6
+
+
+async def run(codes: int, requests: int) -> list:
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{DATABASE_PATH}")
+    router = ReadWriteRouter(async_engine)
+    app.dependency_overrides[get_db_router] = lambda: router
+    fast_app = RedirectFastPath(app, async_engine, redirect_cache)
+    short_codes = [f"c{(i * 7919) % codes}" for i in range(requests)]
+    results = []
+
+    for cache_size in (0, codes):
+        redirect_cache.max_size = cache_size
+        redirect_cache.clear()
+        app_us = await time_requests(app, short_codes)
+        redirect_cache.clear()
+        fast_us = await time_requests(fast_app, short_codes)
+        results.append({
+            "cache": cache_size > 0,
+            "app_us_per_request": app_us,
+            "fast_path_us_per_request": fast_us,
+            "overhead_removed_us": app_us - fast_us
+        })
+
+    app.dependency_overrides.clear()
+    await async_engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--codes", type=int, default=10000)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    if os.path.exists(DATABASE_PATH):
+        os.remove(DATABASE_PATH)
+
+    engine = create_engine(f"sqlite:///{DATABASE_PATH}")
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as connection:
+        connection.execute(insert(ShortURLModel), [
+            {"owner_id": "anonymous", "url": f"https://example.com/{i}",
+             "url_hash": url_hash(f"https://example.com/{i}"), "short_code": f"c{i}"}
+            for i in range(args.codes)])
+
+    engine.dispose()
+    results = asyncio.run(run(args.codes, args.requests))
+    os.remove(DATABASE_PATH)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
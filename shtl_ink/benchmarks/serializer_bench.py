@@ -0,0 +1,68 @@
+"""
+Response serialization benchmark.
+
+Serializes batches of ShortURLModel records the way the api used to, SerializerMixin.to_dict()
+and json.dumps, and the way it does now, ShortURLModel.to_json() and orjson.dumps, and
+reports the cost per batch of records, each step timed on its own and end to end.
+
+usage: python -m benchmarks.serializer_bench [--records 10000] [--repeat 5]
+"""
+
+import argparse
+import json
+from time import perf_counter
+import orjson
+from shtl_ink_api.models import ShortURLModel
+
+
+def best_ms(function, repeat: int) -> float:
+    timings = []
+
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+
+    return min(timings) * 1e3
+
+
+def run(records: int, repeat: int) -> dict:
+    url_records = [
+        ShortURLModel(owner_id=f"owner{i % 16}", url=f"https://example.com/campaign/{i}",
+                      short_code=f"c{i}")
+        for i in range(records)]
+    old_dicts = [url_record.to_dict() for url_record in url_records]
+    new_dicts = [url_record.to_json() for url_record in url_records]
+    assert old_dicts == new_dicts
+
+    to_dict = best_ms(lambda: [url_record.to_dict() for url_record in url_records], repeat)
+    to_json = best_ms(lambda: [url_record.to_json() for url_record in url_records], repeat)
+    json_dumps = best_ms(lambda: json.dumps(old_dicts), repeat)
+    orjson_dumps = best_ms(lambda: orjson.dumps(new_dicts), repeat)
+    old = best_ms(lambda: json.dumps(
+        [url_record.to_dict() for url_record in url_records]).encode('utf-8'), repeat)
+    new = best_ms(lambda: orjson.dumps(
+        [url_record.to_json() for url_record in url_records]), repeat)
+
+    return {
+        "records": records,
+        "to_dict_ms": to_dict,
+        "to_json_ms": to_json,
+        "json_dumps_ms": json_dumps,
+        "orjson_dumps_ms": orjson_dumps,
+        "old_total_ms": old,
+        "new_total_ms": new,
+        "speedup": old / new
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(run(args.records, args.repeat), indent=2))
+
+
+if __name__ == "__main__":
+    main()
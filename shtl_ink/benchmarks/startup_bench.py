@@ -0,0 +1,102 @@
+"""
+Cold start benchmark.
+
+Measures how long a new worker takes before it can serve: the import time of
+shtl_ink_api.app in a fresh interpreter, and the time from launching uvicorn until the
+first redirect request is answered. Each worker runs in a temporary directory against a
+sqlite database migrated beforehand, the way a deployment runs the migrate command once.
+
+usage: python -m benchmarks.startup_bench [--runs N] [--port N]
+"""
+
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+
+PACKAGE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+IMPORT_SCRIPT = (
+    "from time import perf_counter\n"
+    "start = perf_counter()\n"
+    "import shtl_ink_api.app\n"
+    "print(perf_counter() - start)\n")
+
+
+def environment() -> dict:
+    env = {key: value for key, value in os.environ.items() if not key.startswith('DB_')}
+    env['PYTHONPATH'] = PACKAGE_PATH
+    env['MIGRATE_ON_STARTUP'] = 'false'
+    return env
+
+
+def time_import(cwd: str) -> float:
+    result = subprocess.run(
+        [sys.executable, '-c', IMPORT_SCRIPT], cwd=cwd, env=environment(),
+        capture_output=True, text=True, check=True)
+    return float(result.stdout.split()[-1])
+
+
+def time_first_request(cwd: str, port: int, timeout: float = 60.0) -> float:
+    start = perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', '--port', str(port),
+         'shtl_ink_api.app:redirect_app'],
+        cwd=cwd, env=environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        while perf_counter() - start < timeout:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+
+            try:
+                connection.request('GET', '/bench')
+                connection.getresponse().read()
+                return perf_counter() - start
+
+            except OSError:
+                sleep(0.005)
+
+            finally:
+                connection.close()
+
+        raise TimeoutError(f"no response within {timeout} seconds")
+
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def summarize(timings: list) -> dict:
+    return {
+        "median_ms": statistics.median(timings) * 1e3,
+        "min_ms": min(timings) * 1e3,
+        "max_ms": max(timings) * 1e3
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as cwd:
+        subprocess.run(
+            [sys.executable, '-m', 'shtl_ink_api', 'migrate'], cwd=cwd, env=environment(),
+            capture_output=True, check=True)
+        imports = [time_import(cwd) for _ in range(args.runs)]
+        first_requests = [time_first_request(cwd, args.port) for _ in range(args.runs)]
+
+    print(json.dumps({
+        "runs": args.runs,
+        "import": summarize(imports),
+        "first_request": summarize(first_requests)
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
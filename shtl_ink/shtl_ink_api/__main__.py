@@ -0,0 +1,106 @@
+"""
+command line tools for the api
+
+usage: python -m shtl_ink_api migrate
+       python -m shtl_ink_api snapshot PATH [--delta]
+       python -m shtl_ink_api import PATH [--format FORMAT] [--owner OWNER]
+       python -m shtl_ink_api export PATH [--format FORMAT]
+       python -m shtl_ink_api rebalance
+       python -m shtl_ink_api compact
+
+PATH - reads stdin or writes stdout
+"""
+
+import argparse
+import sys
+from .database import shard_engines, shard_names
+from .migrations import migrate
+from .rebalance import rebalance
+from .compact import migrate_compact
+from .snapshot import export_snapshot, export_delta
+from .bulk import FORMATS, Progress, format_of, read_records, import_records, export_records
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="shtl_ink_api", description="shtl.ink api tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("migrate", help="create missing tables and upgrade existing ones")
+    snapshot = commands.add_parser(
+        "snapshot", help="write the short code -> url snapshot redirects are served from")
+    snapshot.add_argument("path")
+    snapshot.add_argument(
+        "--delta", action="store_true",
+        help="write only the changes since the snapshot at path, to path.delta")
+
+    for name, help in (("import", "write urls from a txt, csv or ndjson file in batches"),
+                       ("export", "stream every short code to a txt, csv or ndjson file")):
+        bulk = commands.add_parser(name, help=help)
+        bulk.add_argument("path")
+        bulk.add_argument(
+            "--format", choices=FORMATS, help="format of the file, by default from its name")
+        bulk.add_argument(
+            "--batch-size", type=int, default=10000, help="rows per transaction or read")
+
+        if name == "import":
+            bulk.add_argument(
+                "--owner", default="anonymous", help="owner of records that do not name one")
+
+    moves = commands.add_parser(
+        "rebalance", help="move short codes to their shard after shards are added or removed")
+    moves.add_argument(
+        "--batch-size", type=int, default=10000, help="short codes checked per read")
+    compact = commands.add_parser(
+        "compact", help="copy short codes into the compact schema, run again to catch up")
+    compact.add_argument(
+        "--batch-size", type=int, default=10000, help="short codes per transaction")
+
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        for engine in shard_engines:
+            migrate(engine)
+            print(f"schema of {engine.url.render_as_string(hide_password=True)} is up to date")
+
+    elif args.command == "snapshot" and args.delta:
+        print(f"wrote {export_delta(shard_engines, args.path)} changes to {args.path}.delta")
+
+    elif args.command == "snapshot":
+        print(f"wrote {export_snapshot(shard_engines, args.path)} short codes to {args.path}")
+
+    elif args.command == "import":
+        format = args.format or format_of(args.path)
+        file = sys.stdin if args.path == "-" else open(args.path, 'r', newline='')
+
+        # each record goes straight to its shard
+        with file:
+            imported, skipped = import_records(
+                shard_engines, read_records(file, format, args.owner), shard_names,
+                batch_size=args.batch_size, progress=Progress("imported"))
+
+        print(f"imported {imported} short codes, skipped {skipped}", file=sys.stderr)
+
+    elif args.command == "export":
+        format = args.format or format_of(args.path)
+        file = sys.stdout if args.path == "-" else open(args.path, 'w', newline='')
+
+        with file:
+            export_records(
+                shard_engines, file, format, batch_size=args.batch_size,
+                progress=Progress("exported"))
+
+    elif args.command == "rebalance":
+        moved, left = rebalance(
+            shard_engines, shard_names, args.batch_size, progress=Progress("checked"))
+        print(f"moved {moved} short codes to their shards, left {left} that their shard "
+              "already has")
+
+    elif args.command == "compact":
+        for engine in shard_engines:
+            copied, removed = migrate_compact(
+                engine, batch_size=args.batch_size, progress=Progress("compacted"))
+            print(f"copied {copied} short codes to the compact schema of "
+                  f"{engine.url.render_as_string(hide_password=True)}, removed {removed}")
+
+
+if __name__ == "__main__":
+    main()
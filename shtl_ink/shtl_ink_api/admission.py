@@ -0,0 +1,115 @@
+"""
+admission.py: per owner rate limits and a concurrency limit for the write routes
+"""
+
+from ipaddress import ip_address, ip_network
+from math import ceil
+from time import monotonic
+from .cache import LRUCache
+
+
+class Rejected(Exception):
+    """
+    Rejected: a write turned away, answered with status and a Retry-After header of
+        retry_after seconds
+    """
+
+    def __init__(self, status: int, message: str, retry_after: float):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+    def headers(self) -> dict:
+        return {"Retry-After": str(max(1, ceil(self.retry_after)))}
+
+
+class AdmissionController:
+    """
+    AdmissionController: decides whether a write is let through before it touches the
+        database. Each owner has a token bucket refilled at rate tokens per second and
+        holding up to burst, one token per write, and at most max_concurrent writes of
+        the worker run at once, so a flood of writes can not take every pooled connection
+        away from redirects. State is plain numbers changed between awaits on the event
+        loop, so no locking is needed. A rate or max_concurrent of 0 turns that limit off.
+    Buckets are kept in an LRUCache of max_owners entries that expire once they would be
+        full again, a bucket that is evicted or expired starts out full.
+    AdmissionController.enter() takes a token and a concurrency slot for owner_id or
+        raises Rejected, 429 when the owner is out of tokens and 503 when the worker is
+        at its concurrency limit
+    AdmissionController.exit() gives the concurrency slot back
+    """
+
+    def __init__(
+            self,
+            rate: float,
+            burst: float,
+            max_concurrent: int,
+            max_owners: int = 100000,
+            busy_retry_after: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.busy_retry_after = busy_retry_after
+        self.in_flight = 0
+        self.throttled = 0
+        self.shed = 0
+        self.buckets = LRUCache(max_owners, burst / rate if rate > 0 else 0)
+
+    def take_token(self, owner_id: str) -> None:
+        if self.rate <= 0:
+            return
+
+        now = monotonic()
+        bucket = self.buckets.get(owner_id)
+        tokens = self.burst if bucket is None else min(
+            self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+        if tokens < 1:
+            self.throttled += 1
+            raise Rejected(
+                429, f"too many writes from {owner_id}, slow down", (1 - tokens) / self.rate)
+
+        self.buckets.set(owner_id, (tokens - 1, now))
+
+    def enter(self, owner_id: str) -> None:
+        # shed before spending a token, a write the worker can not take costs the owner nothing
+        if 0 < self.max_concurrent <= self.in_flight:
+            self.shed += 1
+            raise Rejected(503, "too many writes in progress, try again", self.busy_retry_after)
+
+        self.take_token(owner_id)
+        self.in_flight += 1
+
+    def exit(self) -> None:
+        self.in_flight -= 1
+
+
+def is_trusted_proxy(host: str, trusted_proxies: tuple) -> bool:
+    if '*' in trusted_proxies or host in trusted_proxies:
+        return True
+
+    try:
+        address = ip_address(host)
+
+    except ValueError:
+        return False
+
+    return any(address in ip_network(proxy, strict=False)
+               for proxy in trusted_proxies if '/' in proxy)
+
+
+def client_address(host: str, forwarded_for: str, trusted_proxies: tuple) -> str:
+    """
+    client_address: the address of the client behind host, the peer of the connection.
+        While the address reached is one of trusted_proxies, it steps back one entry of
+        forwarded_for, the X-Forwarded-For header, from the right. Entries a client wrote
+        itself are left of the ones the proxies appended, so they are never reached.
+    """
+    forwarded = [address.strip() for address in (forwarded_for or '').split(',')
+                 if address.strip()]
+
+    while forwarded and is_trusted_proxy(host, trusted_proxies):
+        host = forwarded.pop()
+
+    return host
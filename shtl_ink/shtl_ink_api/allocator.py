@@ -0,0 +1,200 @@
+"""
+allocator.py: collision free short code allocation
+"""
+
+import asyncio
+from hashlib import blake2b
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.exc import IntegrityError
+from .models import ShortCodeBlockModel
+
+
+class FeistelPermutation:
+    """
+    FeistelPermutation: keyed bijection of the integers [0, domain).
+    A balanced Feistel network permutes the smallest even bit width covering the domain,
+        values that land outside the domain are fed through again (cycle walking) until
+        they land inside it, which keeps the mapping a bijection on the domain itself.
+    FeistelPermutation.permute() maps an integer to its image
+    FeistelPermutation.invert() maps an image back to its integer
+    """
+
+    def __init__(self, key: bytes, domain: int, rounds: int = 4):
+        self.key = key
+        self.domain = domain
+        self.rounds = rounds
+        self.half_bits = ((domain - 1).bit_length() + 1) // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.half_bytes = (self.half_bits + 7) // 8
+
+    def _round(self, i: int, value: int) -> int:
+        digest = blake2b(
+            value.to_bytes(self.half_bytes, 'big'),
+            key=self.key,
+            person=i.to_bytes(16, 'big'),
+            digest_size=8).digest()
+        return int.from_bytes(digest, 'big') & self.half_mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.half_mask
+
+        for i in range(self.rounds):
+            left, right = right, left ^ self._round(i, right)
+
+        return (left << self.half_bits) | right
+
+    def _decrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.half_mask
+
+        for i in reversed(range(self.rounds)):
+            left, right = right ^ self._round(i, left), left
+
+        return (left << self.half_bits) | right
+
+    def permute(self, value: int) -> int:
+        if not 0 <= value < self.domain:
+            raise ValueError(f"{value} is outside of the permutation domain")
+
+        value = self._encrypt(value)
+
+        while value >= self.domain:
+            value = self._encrypt(value)
+
+        return value
+
+    def invert(self, value: int) -> int:
+        if not 0 <= value < self.domain:
+            raise ValueError(f"{value} is outside of the permutation domain")
+
+        value = self._decrypt(value)
+
+        while value >= self.domain:
+            value = self._decrypt(value)
+
+        return value
+
+
+class ShortCodeAllocator:
+    """
+    ShortCodeAllocator: hands out fixed length short codes that never repeat.
+    Ids come from a counter in the short_code_blocks table, each worker reserves a block
+        of block_size ids at a time so concurrent workers never hand out the same id.
+        Every id is mapped through a keyed FeistelPermutation over the short code space
+        and written out in the alphabet, so consecutive ids give unrelated looking codes.
+    ShortCodeAllocator.short_code() maps an id to its short code
+    ShortCodeAllocator.next_short_code() takes a sqlalchemy.orm.Session object, reserves
+        a new block of ids when the current one is used up and returns the next short code
+    ShortCodeAllocator.next_short_code_async() does the same with a
+        sqlalchemy.ext.asyncio.AsyncSession object and must be awaited
+    """
+
+    def __init__(
+            self,
+            alphabet: str,
+            length: int,
+            key: str,
+            block_size: int,
+            name: str = "short_code"):
+        self.alphabet = alphabet
+        self.length = length
+        self.capacity = len(alphabet) ** length
+        self.permutation = FeistelPermutation(key.encode('utf-8'), self.capacity)
+        self.block_size = block_size
+        self.name = name
+        self.next_id = 0
+        self.end_id = 0
+        self._lock = None
+
+    def short_code(self, id: int) -> str:
+        value = self.permutation.permute(id)
+        short_code = ''
+
+        for _ in range(self.length):
+            value, index = divmod(value, len(self.alphabet))
+            short_code = self.alphabet[index] + short_code
+
+        return short_code
+
+    def short_code_id(self, short_code: str) -> int:
+        value = 0
+
+        for character in short_code:
+            value = value * len(self.alphabet) + self.alphabet.index(character)
+
+        return self.permutation.invert(value)
+
+    def _take_id(self) -> int:
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    def _use_block(self, end_id: int) -> None:
+        if end_id > self.capacity:
+            raise Exception("short code space is exhausted")
+
+        self.next_id, self.end_id = end_id - self.block_size, end_id
+
+    def _reserve_statement(self):
+        return update(ShortCodeBlockModel).where(
+            ShortCodeBlockModel.name == self.name).values(
+            next_id=ShortCodeBlockModel.next_id + self.block_size)
+
+    def _end_id_statement(self):
+        return select(ShortCodeBlockModel.next_id).where(
+            ShortCodeBlockModel.name == self.name)
+
+    def reserve_block(self, session: Session) -> None:
+        if session.execute(self._reserve_statement()).rowcount == 0:
+            try:
+                session.add(ShortCodeBlockModel(
+                    name=self.name, next_id=self.block_size))
+                session.commit()
+                self._use_block(self.block_size)
+                return
+
+            # another worker created the counter first
+            except IntegrityError:
+                session.rollback()
+                return self.reserve_block(session)
+
+        end_id = session.execute(self._end_id_statement()).scalar_one()
+        session.commit()
+        self._use_block(end_id)
+
+    async def reserve_block_async(self, session: AsyncSession) -> None:
+        if (await session.execute(self._reserve_statement())).rowcount == 0:
+            try:
+                session.add(ShortCodeBlockModel(
+                    name=self.name, next_id=self.block_size))
+                await session.commit()
+                self._use_block(self.block_size)
+                return
+
+            # another worker created the counter first
+            except IntegrityError:
+                await session.rollback()
+                return await self.reserve_block_async(session)
+
+        end_id = (await session.execute(self._end_id_statement())).scalar_one()
+        await session.commit()
+        self._use_block(end_id)
+
+    def next_short_code(self, session: Session) -> str:
+        if self.next_id >= self.end_id:
+            self.reserve_block(session)
+
+        return self.short_code(self._take_id())
+
+    async def next_short_code_async(self, session: AsyncSession) -> str:
+        if self.next_id >= self.end_id:
+            # only one coroutine per worker goes to the database for a new block
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+
+            async with self._lock:
+                if self.next_id >= self.end_id:
+                    await self.reserve_block_async(session)
+
+        return self.short_code(self._take_id())
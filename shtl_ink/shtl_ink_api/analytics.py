@@ -0,0 +1,190 @@
+"""
+analytics.py: write behind click counting for redirects
+"""
+
+import asyncio
+from datetime import datetime, timezone
+from time import time
+from sqlalchemy import select, exists, bindparam
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine
+from .models import ClickStatsModel, ShortURLModel
+from .routing import ShardRouter
+
+
+def clicks_upsert(engine):
+    """
+    clicks_upsert: insert into link_clicks in the dialect of a sync or async engine, rows
+        of short codes that are already counted add to their counts
+    """
+    dialect = postgresql if engine.dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(ClickStatsModel)
+    return statement.on_conflict_do_update(
+        index_elements=[ClickStatsModel.short_code],
+        set_={
+            'clicks': ClickStatsModel.clicks + statement.excluded.clicks,
+            'last_access': statement.excluded.last_access
+        })
+
+
+def linked_clicks_upsert(engine):
+    """
+    linked_clicks_upsert: clicks_upsert() as INSERT ... SELECT ... WHERE EXISTS, run with
+        short_code, clicks and last_access parameters, counts of short codes no longer in
+        short_code_to_url, deleted or renamed since they were clicked, are dropped instead
+        of left as rows a new short code of the same name would inherit
+    """
+    dialect = postgresql if engine.dialect.name == 'postgresql' else sqlite
+    clicks, links = ClickStatsModel.__table__, ShortURLModel.__table__
+    values = [bindparam(column.name, type_=column.type) for column in clicks.columns]
+    statement = dialect.insert(clicks).from_select(list(clicks.columns), select(*values).where(
+        exists().where(links.c.short_code == bindparam('short_code'))))
+    return statement.on_conflict_do_update(
+        index_elements=[clicks.c.short_code],
+        set_={
+            'clicks': clicks.c.clicks + statement.excluded.clicks,
+            'last_access': statement.excluded.last_access
+        })
+
+
+class ClickAggregator:
+    """
+    ClickAggregator: counts redirects in memory and writes them to the link_clicks table
+        in batches, so the redirect path never waits on the database.
+    ClickAggregator.record() counts one click for a short code, it does not await
+    ClickAggregator.discard() drops the buffered counts of deleted short codes
+    ClickAggregator.rename() moves the buffered counts of a renamed short code to its new
+        short code, like the foreign key of link_clicks does with the flushed ones
+    ClickAggregator.flush() upserts every buffered count in one statement and clears the buffer,
+        counts are put back if the write fails. With a routing.ShardRouter, counts are
+        written to the shard of their short code, one statement per shard, otherwise to
+        engine. Counts of short codes gone from short_code_to_url are not written
+    ClickAggregator.start() runs flush in the background every interval seconds, or sooner
+        once size distinct short codes are buffered
+    ClickAggregator.stop() stops the background task and flushes what is left
+    """
+
+    def __init__(
+            self,
+            engine: AsyncEngine,
+            interval: float,
+            size: int,
+            router: ShardRouter = None):
+        self.engine = engine
+        self.router = router
+        self.interval = interval
+        self.size = size
+        self.flushes = 0
+        self._pending = {}
+        self._full = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, short_code: str) -> None:
+        entry = self._pending.get(short_code)
+
+        if entry is None:
+            self._pending[short_code] = [1, time()]
+
+            if len(self._pending) >= self.size and self._full is not None:
+                self._full.set()
+
+        else:
+            entry[0] += 1
+            entry[1] = time()
+
+    def discard(self, *short_codes: str) -> None:
+        for short_code in short_codes:
+            self._pending.pop(short_code, None)
+
+    def rename(self, short_code: str, new_short_code: str) -> None:
+        entry = self._pending.pop(short_code, None)
+
+        if entry is None:
+            return
+
+        merged = self._pending.setdefault(new_short_code, [0, entry[1]])
+        merged[0] += entry[0]
+        merged[1] = max(merged[1], entry[1])
+
+    async def flush(self) -> int:
+        pending, self._pending = self._pending, {}
+
+        if not pending:
+            return 0
+
+        shards = {}
+
+        for short_code in pending:
+            engine = self.engine if self.router is None else \
+                self.router.shard(short_code).primary_engine
+            shards.setdefault(engine, []).append(short_code)
+
+        unwritten = list(shards.items())
+
+        try:
+            while unwritten:
+                engine, short_codes = unwritten[0]
+
+                async with engine.begin() as connection:
+                    await connection.execute(linked_clicks_upsert(engine), [{
+                        'short_code': short_code,
+                        'clicks': pending[short_code][0],
+                        'last_access': datetime.fromtimestamp(
+                            pending[short_code][1], timezone.utc).replace(tzinfo=None)
+                    } for short_code in short_codes])
+
+                unwritten.pop(0)
+
+        # keep the counts of the shards not written for the next flush, also when
+        # cancelled mid write
+        except BaseException:
+            for _, short_codes in unwritten:
+                for short_code in short_codes:
+                    clicks, last_access = pending[short_code]
+                    entry = self._pending.setdefault(short_code, [0, last_access])
+                    entry[0] += clicks
+                    entry[1] = max(entry[1], last_access)
+            raise
+
+        self.flushes += 1
+        return len(pending)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+
+            except asyncio.TimeoutError:
+                pass
+
+            self._full.clear()
+
+            try:
+                await self.flush()
+
+            # the database is unavailable, try again next interval
+            except Exception:
+                pass
+
+    def start(self) -> None:
+        if self._task is None:
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            try:
+                await self._task
+
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+            self._full = None
+
+        await self.flush()
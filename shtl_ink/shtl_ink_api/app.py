@@ -1,60 +1,180 @@
-from urllib import response
-from fastapi import FastAPI, Depends, Request, Form, status
+import asyncio
+import heapq
+import orjson
+from functools import partial
+from hashlib import blake2b
+from typing import List, Optional
+from fastapi import FastAPI, Depends, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import RedirectResponse, JSONResponse, Response
-from supertokens_python.recipe.session.framework.fastapi import verify_session
-from supertokens_python.recipe.session import SessionContainer
-from supertokens_python.framework.fastapi import get_middleware
-from supertokens_python import get_all_cors_headers
-
-from sqlalchemy import select, delete
-from sqlalchemy.orm import Session
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+from fastapi.responses import ORJSONResponse
+from starlette.responses import PlainTextResponse
+
+from sqlalchemy import select, delete, update, insert, func, bindparam, exists, values, column
+from sqlalchemy import String
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
-from pydantic import BaseModel
-from .models import ShortURLModel, Base
+from pydantic import BaseModel, ValidationError, conint
+from .models import ShortURLModel, ClickStatsModel, ShortCodeChangeModel, url_hash
 from .codec import Codec
-from .database import engine
-from .config import frontend_base_url
+from .cache import LRUCache, SingleFlight
+from .fastpath import RedirectFastPath, redirect_policy
+from .analytics import ClickAggregator, clicks_upsert
+from .bloom import BloomFilter
+from .routing import ReadWriteRouter, ShardRouter
+from .auth import PathScopedMiddleware, UserSession, cached_session, init_auth, CORS_PATHS
+from .auth import deferred_verify_session, supertokens_middleware
+from .admission import AdmissionController, Rejected, client_address
+from .snapshot import Snapshot, DELETED
+from .changes import ChangeFeed, CREATE, DELETE, log_changes, change_rows
+from . import metrics
+from .database import engine, async_engine, replica_engines, shard_engines
+from .database import async_shard_engines, shard_names
+from .migrations import migrate
+from .config import frontend_base_url, redirect_cache_size, redirect_cache_ttl, batch_max_size
+from .config import page_size, page_size_max, click_flush_interval, click_flush_size
+from .config import bloom_filter, bloom_capacity, bloom_error_rate, read_your_writes_window
+from .config import shard_fallback
+from .config import session_cache_size, session_cache_ttl, migrate_on_startup
+from .config import snapshot_path, snapshot_refresh_interval
+from .config import change_feed_interval, change_feed_retain, change_feed_compact_interval
+from .config import write_rate, write_burst, write_concurrency, trusted_proxies
 
-Base.metadata.create_all(bind=engine)
 codec = Codec()
-app = FastAPI()
-
-app.add_middleware(get_middleware())
+redirect_cache = LRUCache(redirect_cache_size, redirect_cache_ttl)
+# mutations go to the primary of a short code's shard, reads to its replicas when there
+# are any, only the first shard has replicas
+db_router = ShardRouter(
+    [ReadWriteRouter(async_engine, replica_engines, read_your_writes_window)] + [
+        ReadWriteRouter(shard_engine, window=read_your_writes_window)
+        for shard_engine in async_shard_engines[1:]],
+    shard_names, shard_fallback)
+click_aggregator = ClickAggregator(
+    async_engine, click_flush_interval, click_flush_size, router=db_router)
+# answers lookups of codes that were never created without a database round trip
+short_code_filter = BloomFilter(bloom_capacity, bloom_error_rate)
+# redirects are answered from the mapped snapshot before the database is asked
+redirect_snapshot = Snapshot(snapshot_path) if snapshot_path else None
+# bursts of management calls with the same tokens verify the session once
+session_cache = LRUCache(session_cache_size, session_cache_ttl)
+optional_session = cached_session(
+    session_cache, deferred_verify_session(session_required=False))
+# concurrent creates of the same url by the same owner share one database round trip
+create_flights = SingleFlight()
+# floods of writes are turned away before they take database connections from redirects
+admission = AdmissionController(write_rate, write_burst, write_concurrency)
+app = FastAPI(default_response_class=ORJSONResponse)
+# shards for work outside of requests, like startup loads and background flushes
+app.state.db_router = db_router
+
+# sessions only for the management routes, CORS for those and the short code lookups,
+# redirects skip both
+app.add_middleware(PathScopedMiddleware, middleware=supertokens_middleware)
 
 app.add_middleware(
-    CORSMiddleware,
+    PathScopedMiddleware,
+    middleware=CORSMiddleware,
+    paths=CORS_PATHS,
     allow_origins=[frontend_base_url],
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"] + get_all_cors_headers(),
+    # covers the supertokens headers, which can only be listed once it is initialized
+    allow_headers=["*"],
 )
 
+# outermost, so time spent in the other middleware is counted too
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.instrument_engine(engine, "sync")
+metrics.instrument_engine(async_engine.sync_engine, "async")
+
+for replica, replica_engine in enumerate(replica_engines):
+    metrics.instrument_engine(replica_engine.sync_engine, f"replica{replica}")
+
+for shard, shard_engine in enumerate(async_shard_engines[1:], 1):
+    metrics.instrument_engine(shard_engine.sync_engine, f"shard{shard}")
+
+
+def collect_metrics():
+    metrics.short_code_collisions.set(codec.collisions)
+    metrics.short_code_retries.set(codec.retries)
+    metrics.creates_coalesced.set(create_flights.coalesced)
+    metrics.redirect_cache_hits.set(redirect_cache.hits)
+    metrics.redirect_cache_misses.set(redirect_cache.misses)
+    metrics.redirect_cache_entries.set(len(redirect_cache))
+    metrics.clicks_buffered.set(len(click_aggregator))
+    metrics.writes_in_flight.set(admission.in_flight)
+    metrics.writes_rejected.set(admission.throttled, 'rate')
+    metrics.writes_rejected.set(admission.shed, 'concurrency')
+
+
+metrics.registry.add_collector(collect_metrics)
+
 
 class ModificiationRequest(BaseModel):
     short_code: str
     new_short_code: str
 
 
+# a year, the longest max-age caches are expected to honor
+CacheMaxAge = Optional[conint(ge=0, le=31536000)]
+
+
 class CreateRequest(BaseModel):
     url: str
+    # seconds browsers and caches may keep the redirect, a temporary redirect when unset
+    cache_max_age: CacheMaxAge = None
+
+
+class CreateBatchRequest(BaseModel):
+    urls: List[str]
 
 
 class CreateCustomRequest(BaseModel):
     short_code: str
     url: str
+    cache_max_age: CacheMaxAge = None
 
 
 class UrlRequest(BaseModel):
     short_code: str
 
 
-def get_db():
-    db = Session(engine)
-    try:
-        yield db
-    finally:
-        db.close()
+class DeleteBatchRequest(BaseModel):
+    short_codes: List[str]
+
+
+class ModifyBatchRequest(BaseModel):
+    modifications: List[ModificiationRequest]
+
+
+def get_db_router():
+    return db_router
+
+
+async def read_short_code(router: ShardRouter, short_code: str):
+    shard = router.shard(short_code)
+
+    async with shard.read_session(short_code) as db:
+        url_record = await db.get(ShortURLModel, (short_code))
+
+        # not on the replica yet, or written by another worker just now
+        if url_record is None and shard.is_replica(db.bind):
+            async with shard.primary() as primary_db:
+                url_record = await primary_db.get(ShortURLModel, (short_code))
+
+    for other in router.fallbacks(short_code):
+        if url_record is not None:
+            break
+
+        async with other.primary() as db:
+            url_record = await db.get(ShortURLModel, (short_code))
+
+    return url_record
+
+
+async def on_every_shard(router: ShardRouter, read) -> list:
+    # awaits read(shard) for every shard at once, results in shard order
+    return await asyncio.gather(*(read(shard) for shard in router.shards))
 
 
 def get_user_id(session):
@@ -64,61 +184,311 @@ def get_user_id(session):
         return "anonymous"
 
 
+async def admit_write(
+        request: Request,
+        session: UserSession = Depends(optional_session)):
+    owner_id = get_user_id(session)
+
+    # anonymous writers share an owner id, limit each client address on its own, behind
+    # the load balancer the peer is the proxy, the client is in X-Forwarded-For
+    if session is None and request.client is not None:
+        address = client_address(
+            request.client.host, request.headers.get('x-forwarded-for'), trusted_proxies)
+        owner_id = f"{owner_id}@{address}"
+
+    admission.enter(owner_id)
+
+    try:
+        yield
+
+    finally:
+        admission.exit()
+
+
+@app.exception_handler(Rejected)
+async def rejected_write(request: Request, rejected: Rejected):
+    return ORJSONResponse(
+        {"message": rejected.message}, status_code=rejected.status,
+        headers=rejected.headers())
+
+
 def json_response_not_found(short_code):
-    return JSONResponse(
+    return ORJSONResponse(
         {"message": f"{short_code} not found"},
         status_code=status.HTTP_404_NOT_FOUND)
 
 
 def json_response_in_use(short_code):
-    return JSONResponse(
+    return ORJSONResponse(
         {"message": f"{short_code} already in use"},
         status_code=status.HTTP_409_CONFLICT)
 
 
 def json_response_not_owned(short_code):
-    return JSONResponse(
+    return ORJSONResponse(
         {"message": f"{short_code} not owned by you"},
         status_code=status.HTTP_403_FORBIDDEN)
 
 
 def json_response_created(url_record):
-    return JSONResponse(
-        url_record.to_dict(),
+    return ORJSONResponse(
+        url_record.to_json(),
         status_code=status.HTTP_201_CREATED)
 
 
 def json_response_already_reported(url_record):
-    return JSONResponse(
-        url_record.to_dict(),
+    return ORJSONResponse(
+        url_record.to_json(),
         status_code=status.HTTP_208_ALREADY_REPORTED)
 
 
 def json_response_deleted(short_code, url):
-    return JSONResponse(
+    return ORJSONResponse(
         {"message": f"deleted record {short_code} -> {url}"},
         status_code=status.HTTP_200_OK)
 
 
 def json_response_record(url_record):
-    return JSONResponse(
-        url_record.to_dict(),
+    return ORJSONResponse(
+        url_record.to_json(),
         status_code=status.HTTP_200_OK)
 
 
 def json_response_missing(something):
-    return JSONResponse({"message": f"you must supply {something}"},
-                        status_code=status.HTTP_406_NOT_ACCEPTABLE)
+    return ORJSONResponse({"message": f"you must supply {something}"},
+                          status_code=status.HTTP_406_NOT_ACCEPTABLE)
+
+
+def json_response_too_many(count):
+    return ORJSONResponse(
+        {"message": f"{count} items is more than the limit of {batch_max_size}"},
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
 
 
 def json_response_failure():
-    return JSONResponse(
+    return ORJSONResponse(
         {"message": "something went wrong..."},
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def track_created(router: ShardRouter, user_id: str, redirects: dict) -> None:
+    # redirects maps each committed short code to its (url, cache_max_age)
+    for short_code, (url, cache_max_age) in redirects.items():
+        short_code_filter.add(short_code)
+
+        if redirect_snapshot is not None:
+            redirect_snapshot.set(short_code, url, cache_max_age)
+
+    redirect_cache.invalidate(*redirects)
+    router.written(user_id, *redirects)
+
+
+def track_deleted(router: ShardRouter, user_id: str, *short_codes: str) -> None:
+    # clicks not flushed yet would count for a later short code of the same name
+    for short_code in short_codes:
+        if redirect_snapshot is not None:
+            redirect_snapshot.delete(short_code)
+
+    click_aggregator.discard(*short_codes)
+    redirect_cache.invalidate(*short_codes)
+    router.written(user_id, *short_codes)
+
+
+def track_renamed(
+        router: ShardRouter,
+        user_id: str,
+        short_code: str,
+        new_short_code: str,
+        redirect: tuple) -> None:
+    # clicks not flushed yet follow the link to its new short code, redirect is its
+    # (url, cache_max_age)
+    click_aggregator.rename(short_code, new_short_code)
+    track_deleted(router, user_id, short_code)
+    track_created(router, user_id, {new_short_code: redirect})
+
+
+def apply_change(shard: int, op: str, short_code: str, seq: int) -> None:
+    # a change from the log of shard, maybe made by another worker, the next lookup asks
+    # the database until a snapshot file past seq is swapped in
+    if op == CREATE:
+        short_code_filter.add(short_code)
+
+    else:
+        click_aggregator.discard(short_code)
+
+    if redirect_snapshot is not None:
+        redirect_snapshot.invalidate(short_code, shard, seq)
+
+    redirect_cache.invalidate(short_code)
+
+
+def reset_caches() -> None:
+    # changes this worker missed are gone from the log, forget everything cached, the
+    # snapshot is not asked until its next delta or base snapshot
+    redirect_cache.clear()
+
+    if redirect_snapshot is not None:
+        redirect_snapshot.ignore()
+
+    if bloom_filter:
+        app.state.filter_loader = asyncio.create_task(
+            reload_short_code_filter(getattr(app.state, "filter_loader", None)))
+
+
+# every worker follows the change log of every shard so changes made elsewhere reach its
+# caches, one feed per shard, made at startup
+change_feeds = []
 # all reserved endings that have no form data need to be before
 # short code redirect reciever
 
 
+@app.on_event("startup")
+async def start_auth():
+    init_auth()
+
+
+@app.on_event("startup")
+async def migrate_schema():
+    # off for production databases, run python -m shtl_ink_api migrate before deploying
+    if migrate_on_startup:
+        for shard_engine in shard_engines:
+            await asyncio.get_running_loop().run_in_executor(None, migrate, shard_engine)
+
+
+@app.on_event("startup")
+async def start_click_aggregator():
+    click_aggregator.router = app.state.db_router
+    click_aggregator.start()
+
+
+def refresh_snapshot() -> None:
+    redirect_snapshot.refresh()
+    watermarks = redirect_snapshot.watermarks
+
+    # the files miss the changes logged after their watermarks, unless every feed replays
+    # them, one written for other shards or before a feed started or was reset can not
+    # be trusted
+    if watermarks is not None and (len(watermarks) != len(change_feeds) or any(
+            watermark < change_feed.since
+            for watermark, change_feed in zip(watermarks, change_feeds))):
+        redirect_snapshot.ignore()
+
+
+@app.on_event("startup")
+async def start_change_feeds():
+    # before the filter load starts, so no change lands between the two unseen
+    change_feeds[:] = [
+        ChangeFeed(shard.primary_engine, partial(apply_change, index), reset_caches,
+                   change_feed_interval, change_feed_retain, change_feed_compact_interval)
+        for index, shard in enumerate(app.state.db_router.shards)]
+    watermarks = None
+
+    # changes logged since the snapshot was written are replayed into its overlay before
+    # the worker serves
+    if redirect_snapshot is not None:
+        redirect_snapshot.refresh()
+        watermarks = redirect_snapshot.watermarks
+
+    if watermarks is None or len(watermarks) != len(change_feeds):
+        watermarks = [None] * len(change_feeds)
+
+    for change_feed, watermark in zip(change_feeds, watermarks):
+        await change_feed.start(watermark)
+
+
+async def count_short_codes(shard: ReadWriteRouter) -> int:
+    async with shard.primary_engine.connect() as connection:
+        return (await connection.execute(
+            select(func.count()).select_from(ShortURLModel))).scalar()
+
+
+async def fill_short_code_filter():
+    # the old filter may not match the shards any more, lookups go to the database
+    # until the new one is loaded
+    short_code_filter.loaded = False
+    count = sum(await on_every_shard(app.state.db_router, count_short_codes))
+    # room to grow before the false positive rate climbs past the target, codes
+    # created from here on are added to the new filter, older ones are streamed
+    short_code_filter.reset(max(bloom_capacity, count * 2))
+
+    for shard in app.state.db_router.shards:
+        async with shard.primary_engine.connect() as connection:
+            short_codes = await connection.stream(
+                select(ShortURLModel.short_code).execution_options(yield_per=10000))
+
+            async for short_code in short_codes.scalars():
+                short_code_filter.add(short_code)
+
+    short_code_filter.loaded = True
+
+
+async def reload_short_code_filter(loader: asyncio.Task):
+    # one load at a time, an older one finishing last would mark the filter loaded after
+    # this one emptied it
+    if loader is not None and not loader.done():
+        loader.cancel()
+        # does not raise the cancellation of loader, only one of this load
+        await asyncio.wait([loader])
+
+    await fill_short_code_filter()
+
+
+@app.on_event("startup")
+async def load_short_code_filter():
+    # in the background so the worker serves right away, lookups go to the database
+    # until the filter is loaded
+    if bloom_filter:
+        app.state.filter_loader = asyncio.create_task(fill_short_code_filter())
+
+
+async def watch_snapshot():
+    while True:
+        await asyncio.sleep(snapshot_refresh_interval)
+
+        try:
+            refresh_snapshot()
+
+        # a half copied or corrupt file, keep serving the current one
+        except (OSError, ValueError):
+            pass
+
+
+@app.on_event("startup")
+async def load_snapshot():
+    if redirect_snapshot is not None:
+        refresh_snapshot()
+        app.state.snapshot_watcher = asyncio.create_task(watch_snapshot())
+
+
+@app.on_event("shutdown")
+async def stop_snapshot_watcher():
+    watcher = getattr(app.state, "snapshot_watcher", None)
+
+    if watcher is not None:
+        watcher.cancel()
+        app.state.snapshot_watcher = None
+
+
+@app.on_event("shutdown")
+async def stop_change_feeds():
+    for change_feed in change_feeds:
+        await change_feed.stop()
+
+
+@app.on_event("shutdown")
+async def stop_short_code_filter_load():
+    loader = getattr(app.state, "filter_loader", None)
+
+    if loader is not None and not loader.done():
+        loader.cancel()
+
+
+@app.on_event("shutdown")
+async def stop_click_aggregator():
+    # flushes buffered clicks so a graceful shutdown loses none
+    await click_aggregator.stop()
+
+
 @app.get("/")
 async def root(request: Request):
     return RedirectResponse(
@@ -126,107 +496,403 @@ async def root(request: Request):
         status_code=status.HTTP_308_PERMANENT_REDIRECT)
 
 
+def short_code_of(row) -> str:
+    return row.short_code
+
+
+def code_point_order(router: ShardRouter):
+    # the shards' rows are merged in python's code point order, so the databases must sort
+    # and compare cursors the same way, postgres goes by its locale unless told otherwise,
+    # sqlite compares code points already
+    if router.shards[0].primary_engine.dialect.name == 'postgresql':
+        return ShortURLModel.short_code.collate('C')
+
+    return ShortURLModel.short_code
+
+
+async def merge_sorted(results: list, key):
+    # k way merge of async results that are each sorted by key, reading ahead one row
+    # of each
+    heap = []
+    iterators = [result.__aiter__() for result in results]
+
+    async def advance(i: int) -> None:
+        try:
+            row = await iterators[i].__anext__()
+
+        except StopAsyncIteration:
+            return
+
+        heapq.heappush(heap, (key(row), i, row))
+
+    for i in range(len(iterators)):
+        await advance(i)
+
+    while heap:
+        _, i, row = heapq.heappop(heap)
+        yield row
+        await advance(i)
+
+
 @app.get("/all_short_codes")
 async def get_all_records(
-        db: Session = Depends(get_db),
-        session: SessionContainer = Depends(verify_session(session_required=False))):
+        after: Optional[str] = None,
+        limit: int = page_size,
+        stream: bool = False,
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
 
     user_id = get_user_id(session)
-    url_records = db.execute(select(ShortURLModel).where(
-        ShortURLModel.owner_id == user_id)).scalars().all()
-    url_records = [url_record.to_dict() for url_record in url_records]
-    return JSONResponse(url_records)
+    # keyset pagination, walks the (owner_id, short_code) index of every shard from the
+    # cursor, the shards' records are merged in short code order
+    short_code = code_point_order(router)
+    query = select(*(
+        getattr(ShortURLModel, column) for column in ShortURLModel.json_columns)).where(
+        ShortURLModel.owner_id == user_id).order_by(short_code)
+
+    if after is not None:
+        query = query.where(short_code > after)
+
+    if stream:
+        # the sessions stay open until the response is sent, rows come off a server side
+        # cursor on every shard so memory does not grow with the number of records
+        async def results():
+            dbs = [shard.read_session(user_id) for shard in router.shards]
+
+            try:
+                url_records = await asyncio.gather(*(
+                    db.stream(query.execution_options(yield_per=page_size)) for db in dbs))
+
+                async for url_record in merge_sorted(url_records, short_code_of):
+                    yield orjson.dumps(url_record._asdict()) + b"\n"
+
+            finally:
+                for db in dbs:
+                    await db.close()
+
+        return StreamingResponse(results(), media_type="application/x-ndjson")
+
+    limit = max(1, min(limit, page_size_max))
+
+    async def page(shard: ReadWriteRouter) -> list:
+        async with shard.read_session(user_id) as db:
+            return (await db.execute(query.limit(limit))).all()
+
+    url_records = list(heapq.merge(
+        *await on_every_shard(router, page), key=short_code_of))[:limit]
+    url_records = [url_record._asdict() for url_record in url_records]
+    headers = {}
+
+    if len(url_records) == limit:
+        headers["X-Next-Cursor"] = url_records[-1]["short_code"]
+
+    return ORJSONResponse(url_records, headers=headers)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(
+        metrics.registry.render(),
+        media_type="text/plain; version=0.0.4")
+
+
+@app.get("/click_stats")
+async def get_click_stats(
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
+
+    user_id = get_user_id(session)
+
+    # clicks are on the shard of their short code, so the join stays on one shard
+    async def clicks(shard: ReadWriteRouter) -> list:
+        async with shard.read_session(user_id) as db:
+            return (await db.execute(
+                select(
+                    ShortURLModel.short_code,
+                    ShortURLModel.url,
+                    ClickStatsModel.clicks,
+                    ClickStatsModel.last_access).join(
+                    ClickStatsModel,
+                    ClickStatsModel.short_code == ShortURLModel.short_code).where(
+                    ShortURLModel.owner_id == user_id).order_by(
+                    code_point_order(router)))).all()
+
+    click_records = heapq.merge(*await on_every_shard(router, clicks), key=short_code_of)
+
+    return ORJSONResponse([{
+        "short_code": short_code,
+        "url": url,
+        "clicks": clicks,
+        "last_access": last_access.isoformat() if last_access else None
+    } for short_code, url, clicks, last_access in click_records])
 
 
 @app.get("/{short_code}")
 async def go_to_url(
         short_code: str,
-        db: Session = Depends(get_db)):
+        router: ShardRouter = Depends(get_db_router)):
 
-    url_record = db.get(ShortURLModel, (short_code))
+    redirect = redirect_cache.get(short_code)
 
-    if url_record is None:
-        return json_response_not_found(short_code)
+    if redirect is None and redirect_snapshot is not None:
+        redirect = redirect_snapshot.get(short_code)
 
-    else:
-        return RedirectResponse(
-            url=url_record.url, status_code=status.HTTP_307_TEMPORARY_REDIRECT)
+        if redirect == DELETED:
+            return json_response_not_found(short_code)
+
+    if redirect is None:
+        if not short_code_filter.might_contain(short_code):
+            return json_response_not_found(short_code)
+
+        url_record = await read_short_code(router, short_code)
+
+        if url_record is None:
+            return json_response_not_found(short_code)
+
+        redirect = (url_record.url, url_record.cache_max_age)
+        redirect_cache.set(short_code, redirect)
+
+    click_aggregator.record(short_code)
+    url, cache_max_age = redirect
+    status_code, cache_control = redirect_policy(cache_max_age)
+    return RedirectResponse(
+        url=url, status_code=status_code, headers={"Cache-Control": cache_control})
 
 # all endpoints with form data
 
 
-@app.post("/create_short_code")
+@app.post("/create_short_code", dependencies=[Depends(admit_write)])
 async def create_short_code(
         create_request: CreateRequest,
-        db: Session = Depends(get_db),
-        session: SessionContainer = Depends(verify_session(session_required=False))):
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
 
     user_id = get_user_id(session)
 
     if create_request.url == '':
         return json_response_missing("a url")
 
-    url_record = db.execute(
-        select(ShortURLModel).where(
-            ShortURLModel.url == create_request.url,
-            ShortURLModel.owner_id == user_id)).scalars().first()
+    # retries and double submits already running on this worker wait for the first one
+    url_record, created = await create_flights.run(
+        (user_id, create_request.url),
+        lambda: create_owned_record(router, user_id, create_request))
 
-    if url_record is None:
-        short_code = codec.encode(create_request.url, user_id, db)
+    if created:
+        return json_response_created(url_record)
 
-    else:
-        return json_response_already_reported(url_record)
+    return json_response_already_reported(url_record)
 
-    if isinstance(short_code, str):
-        url_record = db.get(ShortURLModel, (short_code))
-        return json_response_created(url_record)
 
-    else:
-        return json_response_failure()
+async def create_owned_record(
+        router: ShardRouter,
+        user_id: str,
+        create_request: CreateRequest) -> tuple:
+    # finds the owner's record of the url on any shard, or inserts it in one statement on
+    # the shard of the new short code, another worker creating the same url meets the
+    # unique index
+    url_record, created = await codec.encode_canonical_async(
+        create_request.url, user_id, router, create_request.cache_max_age)
+
+    if created:
+        track_created(router, user_id, {
+            url_record.short_code: (url_record.url, url_record.cache_max_age)})
+
+    return url_record, created
+
+
+async def ndjson_lines(request: Request):
+    # the lines of an ndjson body as they arrive, the body is never held whole
+    pending = b""
+
+    async for chunk in request.stream():
+        *lines, pending = (pending + chunk).split(b"\n")
+
+        for line in lines:
+            if line.strip():
+                yield line
+
+    if pending.strip():
+        yield pending
+
+
+async def read_batch(request: Request, parse_line, parse_body) -> tuple:
+    # the items of a json body, or of an ndjson body with one item per line, and how many
+    # were sent, lines past batch_max_size are counted but not parsed
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        items, count = [], 0
+
+        async for line in ndjson_lines(request):
+            count += 1
+
+            if count <= batch_max_size:
+                items.append(parse_line(line))
+
+        return items, count
+
+    items = parse_body(await request.body())
+    return items, len(items)
+
+
+async def read_batch_urls(request: Request) -> tuple:
+    # one {"url": ...} object per line
+    return await read_batch(
+        request, lambda line: CreateRequest.parse_raw(line).url,
+        lambda body: CreateBatchRequest.parse_raw(body).urls)
+
+
+async def read_batch_short_codes(request: Request) -> tuple:
+    # one {"short_code": ...} object per line
+    return await read_batch(
+        request, lambda line: UrlRequest.parse_raw(line).short_code,
+        lambda body: DeleteBatchRequest.parse_raw(body).short_codes)
+
+
+async def read_batch_modifications(request: Request) -> tuple:
+    # one {"short_code": ..., "new_short_code": ...} object per line
+    return await read_batch(
+        request, ModificiationRequest.parse_raw,
+        lambda body: ModifyBatchRequest.parse_raw(body).modifications)
+
+
+def ndjson_results(results, lines_per_send: int = 1000) -> StreamingResponse:
+    # lines are sent as they are serialized, by an async generator so none of them runs
+    # in a worker thread, lines_per_send at a time to keep the sends few
+    async def body():
+        lines = []
+
+        for result in results:
+            lines.append(orjson.dumps(result) + b"\n")
+
+            if len(lines) == lines_per_send:
+                yield b"".join(lines)
+                lines = []
+
+        if lines:
+            yield b"".join(lines)
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+
+@app.post("/create_short_codes", dependencies=[Depends(admit_write)])
+async def create_short_codes(
+        request: Request,
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
+
+    user_id = get_user_id(session)
+
+    try:
+        urls, count = await read_batch_urls(request)
+
+    except ValidationError:
+        return json_response_missing("a list of urls")
+
+    if count > batch_max_size:
+        return json_response_too_many(count)
+
+    valid_urls = list(dict.fromkeys(
+        url for url in urls if url != '' and len(url) <= 2000))
+
+    # dedup against the owner's existing records in one query per shard
+    short_codes = {}
+
+    async def owned_records(shard: ReadWriteRouter) -> list:
+        async with shard.primary() as db:
+            return (await db.execute(
+                select(ShortURLModel.url, ShortURLModel.short_code).where(
+                    ShortURLModel.owner_id == user_id,
+                    ShortURLModel.url_hash.in_([url_hash(url) for url in valid_urls])))).all()
+
+    if valid_urls:
+        wanted = set(valid_urls)
+        short_codes = {url: short_code
+                       for url_records in await on_every_shard(router, owned_records)
+                       for url, short_code in url_records if url in wanted}
+
+    new_urls = [url for url in valid_urls if url not in short_codes]
+    created = set(new_urls)
+
+    if new_urls:
+        new_short_codes = await codec.encode_batch_async(new_urls, user_id, router)
+        short_codes.update(zip(new_urls, new_short_codes))
+        track_created(router, user_id, {
+            short_code: (url, None) for short_code, url in zip(new_short_codes, new_urls)})
+
+    def results():
+        for url in urls:
+            if url not in short_codes:
+                result = {"url": url,
+                          "message": "url must be 1 to 2000 characters",
+                          "status": status.HTTP_406_NOT_ACCEPTABLE}
+
+            elif url in created:
+                # repeats of a url within the batch are reported like a second create
+                created.discard(url)
+                result = {"owner_id": user_id, "url": url,
+                          "short_code": short_codes[url],
+                          "status": status.HTTP_201_CREATED}
+
+            else:
+                result = {"owner_id": user_id, "url": url,
+                          "short_code": short_codes[url],
+                          "status": status.HTTP_208_ALREADY_REPORTED}
+
+            yield result
+
+    return ndjson_results(results())
 
 
-@app.post("/create_custom_short_code")
+@app.post("/create_custom_short_code", dependencies=[Depends(admit_write)])
 async def create_custom_short_code(
         create_custom_request: CreateCustomRequest,
-        db: Session = Depends(get_db),
-        session: SessionContainer = Depends(verify_session(session_required=False))):
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
 
     user_id = get_user_id(session)
 
     if create_custom_request.short_code == '' or create_custom_request.url == '':
         return json_response_missing("a url and short code")
 
-    url_record = db.get(ShortURLModel, (create_custom_request.short_code))
+    async with router.shard(create_custom_request.short_code).primary() as db:
+        url_record = await db.get(ShortURLModel, (create_custom_request.short_code))
 
-    if url_record is not None and url_record.url == create_custom_request.url and url_record.owner_id == user_id:
-        return json_response_already_reported(url_record)
+        if url_record is not None and url_record.url == create_custom_request.url and url_record.owner_id == user_id:
+            return json_response_already_reported(url_record)
 
-    if url_record is not None:
-        return json_response_in_use(url_record.short_code)
+        if url_record is not None:
+            return json_response_in_use(url_record.short_code)
 
-    try:
-        url_record = ShortURLModel(
-            owner_id=user_id,
-            url=create_custom_request.url,
-            short_code=create_custom_request.short_code)
-        db.add(url_record)
-        db.commit()
-        return json_response_created(url_record)
+        try:
+            url_record = ShortURLModel(
+                owner_id=user_id,
+                url=create_custom_request.url,
+                short_code=create_custom_request.short_code,
+                cache_max_age=create_custom_request.cache_max_age)
+            db.add(url_record)
+            log_changes(db, CREATE, url_record.short_code)
+            await db.commit()
+            track_created(
+                router, user_id,
+                {url_record.short_code: (url_record.url, url_record.cache_max_age)})
+            return json_response_created(url_record)
 
-    except IntegrityError:
-        db.rollback()
-        return json_response_in_use(create_custom_request.short_code)
+        except IntegrityError:
+            await db.rollback()
+            return json_response_in_use(create_custom_request.short_code)
 
 
 @app.post("/short_code")
 async def Get_short_code_url(
         url_request: UrlRequest,
-        db: Session = Depends(get_db)):
+        router: ShardRouter = Depends(get_db_router)):
 
     if url_request.short_code == '':
         return json_response_missing("a short code")
 
-    url_record = db.get(ShortURLModel, (url_request.short_code))
+    if not short_code_filter.might_contain(url_request.short_code):
+        return json_response_not_found(url_request.short_code)
+
+    url_record = await read_short_code(router, url_request.short_code)
 
     if url_record is None:
         return json_response_not_found(url_request.short_code)
@@ -235,107 +901,598 @@ async def Get_short_code_url(
         return json_response_record(url_record)
 
 
-@app.get("/short_code/{short_code}")
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # weak comparison, as If-None-Match asks for
+    return any(tag.strip() in ('*', etag, f"W/{etag}") for tag in if_none_match.split(','))
+
+
+@app.api_route("/short_code/{short_code}", methods=["GET", "HEAD"])
 async def get_short_code_url(
         short_code: str,
-        db: Session = Depends(get_db)):
-    url_record = db.get(ShortURLModel, (short_code))
+        request: Request,
+        router: ShardRouter = Depends(get_db_router)):
+
+    if not short_code_filter.might_contain(short_code):
+        return json_response_not_found(short_code)
+
+    url_record = await read_short_code(router, short_code)
 
     if url_record is None:
         return json_response_not_found(short_code)
 
-    else:
-        return json_response_record(url_record)
+    body = orjson.dumps(url_record.to_json())
+    # caches may keep the record but must ask again, an unchanged record costs a 304
+    headers = {
+        "ETag": f'"{blake2b(body, digest_size=16).hexdigest()}"',
+        "Cache-Control": "no-cache"}
+
+    if etag_matches(request.headers.get("if-none-match", ""), headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if request.method == "HEAD":
+        headers["Content-Length"] = str(len(body))
+        return Response(media_type="application/json", headers=headers)
+
+    return Response(body, media_type="application/json", headers=headers)
+
+
+async def delete_owned_short_code(router: ShardRouter, user_id: str, short_code: str):
+    links = ShortURLModel.__table__
 
+    async with router.shard(short_code).primary() as db:
+        try:
+            # ownership is checked by the delete itself, nothing is read first
+            deleted = (await db.execute(delete(links).where(
+                links.c.short_code == short_code,
+                links.c.owner_id == user_id).returning(links.c.url))).first()
 
-@app.delete("/delete_short_code")
+            # its clicks go with it, by the foreign key of link_clicks
+            if deleted is not None:
+                log_changes(db, DELETE, short_code)
+                await db.commit()
+
+        except Exception:
+            await db.rollback()
+            return json_response_failure()
+
+        # nothing deleted, tell a missing short code from one owned by someone else
+        if deleted is None:
+            if await db.get(ShortURLModel, (short_code)) is None:
+                return json_response_not_found(short_code)
+
+            return json_response_not_owned(short_code)
+
+    track_deleted(router, user_id, short_code)
+    return json_response_deleted(short_code, deleted.url)
+
+
+@app.delete("/delete_short_code", dependencies=[Depends(admit_write)])
 async def Delete_url_short_code(
         url_request: UrlRequest,
-        db: Session = Depends(get_db),
-        session: SessionContainer = Depends(verify_session(session_required=False))):
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
 
     user_id = get_user_id(session)
 
     if url_request.short_code == '':
         return json_response_missing("a short code")
 
-    url_record = db.get(ShortURLModel, (url_request.short_code))
+    return await delete_owned_short_code(router, user_id, url_request.short_code)
 
-    if url_record is None:
-        return json_response_not_found(url_request.short_code)
 
-    if url_record.owner_id != user_id:
-        return json_response_not_owned(url_record.short_code)
+@app.delete("/delete_short_code/{short_code}", dependencies=[Depends(admit_write)])
+async def delete_url_short_code(
+        short_code: str,
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
+
+    return await delete_owned_short_code(router, get_user_id(session), short_code)
+
+
+def by_shard(router: ShardRouter, short_codes: list) -> dict:
+    # the ReadWriteRouter of every shard holding any of short_codes -> its short codes
+    shards = {}
+
+    for short_code in short_codes:
+        shards.setdefault(router.shard(short_code), []).append(short_code)
+
+    return shards
+
+
+async def select_records(router: ShardRouter, short_codes: list, *columns) -> list:
+    # rows of columns of the records of short_codes, one query per shard, all at once
+    async def read(shard: ReadWriteRouter, short_codes: list) -> list:
+        async with shard.primary() as db:
+            return (await db.execute(select(*columns).where(
+                ShortURLModel.short_code.in_(short_codes)))).all()
+
+    return [row for rows in await asyncio.gather(*(
+        read(shard, short_codes) for shard, short_codes in by_shard(router, short_codes).items()))
+        for row in rows]
 
-    try:
-        url = url_record.url
-        db.delete(url_record)
-        db.commit()
-        return json_response_deleted(url_request.short_code, url)
 
-    except Exception as e:
-        db.rollback()
-        return json_response_failure()
+def rename_statement(user_id: str):
+    # renames one of user_id's short codes, matching no row when the short code is gone or
+    # its new short code is taken, so a conflict is seen without aborting the transaction
+    links = ShortURLModel.__table__
+    taken = links.alias()
+    return update(links).where(
+        links.c.short_code == bindparam("b_short_code"),
+        links.c.owner_id == user_id,
+        ~exists().where(taken.c.short_code == bindparam("b_new_short_code"))).values(
+        short_code=bindparam("b_new_short_code"))
+
+
+def renames_statement(user_id: str, moves: list):
+    # renames many of user_id's short codes in one statement, returning the moves made, new
+    # short codes are checked against the table as it was before the statement
+    links = ShortURLModel.__table__
+    taken = links.alias()
+    renames = values(
+        column("short_code", String), column("new_short_code", String), name="renames").data(
+        moves)
+    return update(links).where(
+        links.c.short_code == renames.c.short_code,
+        links.c.owner_id == user_id,
+        ~exists().where(taken.c.short_code == renames.c.new_short_code)).values(
+        short_code=renames.c.new_short_code).returning(
+        renames.c.short_code, renames.c.new_short_code)
+
+
+def move_parameters(moves: list) -> list:
+    return [{"b_short_code": short_code, "b_new_short_code": new_short_code}
+            for short_code, new_short_code in moves]
+
+
+async def move_within_shard(
+        shard: ReadWriteRouter,
+        user_id: str,
+        moves: list,
+        chunk_size: int = 5000) -> tuple:
+    # returns the moves made and the moves whose new short code was taken, the rest were
+    # not made because their short code is gone
+    rename = rename_statement(user_id)
+    freed = {short_code for short_code, _ in moves}
+    # a move onto a short code an earlier move frees has to see that move made
+    chained = any(new_short_code in freed for _, new_short_code in moves)
+
+    async with shard.primary() as db:
+        made = None
+
+        # postgres drivers can not count the rows of an executemany, one update from a
+        # list of values per chunk instead, chunks keep bound parameters under driver limits
+        if shard.primary_engine.dialect.name == 'postgresql' and not chained:
+            renamed = set()
+
+            for start in range(0, len(moves), chunk_size):
+                renamed.update(tuple(row) for row in await db.execute(
+                    renames_statement(user_id, moves[start:start + chunk_size])))
+
+            made = [move for move in moves if move in renamed]
+
+        # one executemany, run in order so each move sees the ones before it, on the
+        # tables rather than the models so the orm runs them as written, each move
+        # matches one row unless something changed since the batch was checked
+        elif shard.primary_engine.dialect.supports_sane_multi_rowcount:
+            if (await db.execute(rename, move_parameters(moves))).rowcount == len(moves):
+                made = moves
+
+            else:
+                await db.rollback()
+
+        # one at a time to tell which moves matched, as chained moves on postgres always are
+        if made is None:
+            made = [move for move in moves
+                    if (await db.execute(rename, move_parameters([move]))).rowcount]
+
+        taken = []
+
+        if len(made) < len(moves):
+            links, made_moves = ShortURLModel.__table__, set(made)
+            left = [move for move in moves if move not in made_moves]
+            in_use = set((await db.execute(select(links.c.short_code).where(
+                links.c.short_code.in_([new_short_code for _, new_short_code in left])))
+                ).scalars())
+            taken = [move for move in left if move[1] in in_use]
+
+        if made:
+            changes = []
+
+            for short_code, new_short_code in made:
+                changes += change_rows(DELETE, [short_code]) + change_rows(
+                    CREATE, [new_short_code])
+
+            # clicks follow each link to its new short code by the foreign key of link_clicks
+            await db.execute(insert(ShortCodeChangeModel.__table__), changes)
+            await db.commit()
+
+    return made, taken
+
+
+async def move_across_shards(
+        source: ReadWriteRouter,
+        target: ReadWriteRouter,
+        user_id: str,
+        moves: list) -> tuple:
+    # returns the records moved, under their new short codes, and the moves whose new
+    # short code was taken on the target
+    renamed = dict(moves)
+    links, clicks = ShortURLModel.__table__, ClickStatsModel.__table__
+    dialect = postgresql if target.primary_engine.dialect.name == 'postgresql' else sqlite
+
+    # deleted from the source first and committed last, a failure on the target rolls the
+    # source back, one in between the commits leaves the old short code in place as well
+    async with source.primary() as source_db, target.primary() as target_db:
+        owned = select(links.c.short_code).where(
+            links.c.short_code.in_(renamed), links.c.owner_id == user_id)
+        # ahead of the links, whose delete takes their clicks with it
+        click_rows = (await source_db.execute(delete(clicks).where(
+            clicks.c.short_code.in_(owned)).returning(*clicks.columns))).mappings().all()
+        deleted = (await source_db.execute(delete(links).where(
+            links.c.short_code.in_(renamed),
+            links.c.owner_id == user_id).returning(*links.columns))).mappings().all()
+
+        if not deleted:
+            return [], []
+
+        # new short codes taken on the target are skipped, not an error
+        inserted = set((await target_db.execute(
+            dialect.insert(links).on_conflict_do_nothing(
+                index_elements=[links.c.short_code]).returning(links.c.short_code),
+            [{**record, "short_code": renamed[record["short_code"]]}
+             for record in deleted])).scalars())
+        records = [{**record, "short_code": renamed[record["short_code"]]}
+                   for record in deleted if renamed[record["short_code"]] in inserted]
+        kept = [dict(record) for record in deleted
+                if renamed[record["short_code"]] not in inserted]
+
+        kept_clicks = [dict(row) for row in click_rows
+                       if renamed[row["short_code"]] not in inserted]
+
+        # those stay on the source as they were
+        if kept:
+            await source_db.execute(insert(links), kept)
+
+        if kept_clicks:
+            await source_db.execute(insert(clicks), kept_clicks)
+
+        taken = [(record["short_code"], renamed[record["short_code"]]) for record in kept]
+
+        if records:
+            moved = [record["short_code"] for record in deleted
+                     if renamed[record["short_code"]] in inserted]
+            moved_clicks = [{**row, "short_code": renamed[row["short_code"]]}
+                            for row in click_rows if renamed[row["short_code"]] in inserted]
+
+            if moved_clicks:
+                await target_db.execute(clicks_upsert(target.primary_engine), moved_clicks)
+
+            await target_db.execute(insert(ShortCodeChangeModel.__table__), change_rows(
+                CREATE, [record["short_code"] for record in records]))
+            await source_db.execute(
+                insert(ShortCodeChangeModel.__table__), change_rows(DELETE, moved))
+
+        await target_db.commit()
+        await source_db.commit()
+
+    return records, taken
+
+
+async def rename_short_code(
+        router: ShardRouter,
+        user_id: str,
+        short_code: str,
+        new_short_code: str) -> tuple:
+    # returns the record renamed, none when user_id has no short_code, and whether
+    # new_short_code was taken
+    source, target = router.shard(short_code), router.shard(new_short_code)
+
+    if source is not target:
+        records, taken = await move_across_shards(
+            source, target, user_id, [(short_code, new_short_code)])
+        return records, bool(taken)
 
+    links = ShortURLModel.__table__
 
-@app.delete("/delete_short_code/{short_code}")
-async def delete_url_short_code(
-        short_code: str,
-        db: Session = Depends(get_db),
-        session: SessionContainer = Depends(verify_session(session_required=False))):
+    async with source.primary() as db:
+        # ownership and the new short code are checked by the update itself
+        try:
+            records = (await db.execute(update(links).where(
+                links.c.short_code == short_code, links.c.owner_id == user_id).values(
+                short_code=new_short_code).returning(*links.columns))).mappings().all()
 
-    user_id = get_user_id(session)
+        except IntegrityError:
+            return [], True
 
-    url_record = db.get(ShortURLModel, (short_code))
+        # clicks follow by the foreign key of link_clicks, both changes in one insert
+        if records:
+            await db.execute(insert(ShortCodeChangeModel.__table__).values(
+                change_rows(DELETE, [short_code]) + change_rows(CREATE, [new_short_code])))
+            await db.commit()
 
-    if url_record is None:
-        return json_response_not_found(short_code)
+        return records, False
 
-    if url_record.owner_id != user_id:
-        return json_response_not_owned(url_record.short_code)
 
-    try:
-        url = url_record.url
-        db.delete(url_record)
-        db.commit()
-        return json_response_deleted(short_code, url)
+async def move_short_codes(router: ShardRouter, user_id: str, moves: list) -> tuple:
+    """
+    move_short_codes: renames user_id's short codes, (short_code, new_short_code) moves
+        checked in order beforehand, returns the set of moves made and the set of moves
+        not made because their new short code was taken meanwhile, the others were not
+        made because their short code is gone. Moves between the same two shards are made
+        together, in one transaction when both are the same shard. When a batch takes a
+        short code that it also frees, only consecutive moves are made together so the
+        order is kept.
+    """
+    freed = {short_code for short_code, _ in moves}
+    ordered = any(new_short_code in freed for _, new_short_code in moves)
+    groups = []
+
+    for short_code, new_short_code in moves:
+        shards = (router.shard(short_code), router.shard(new_short_code))
+
+        if ordered:
+            group = groups[-1] if groups and groups[-1][0] == shards else None
+
+        else:
+            group = next((group for group in groups if group[0] == shards), None)
+
+        if group is None:
+            group = (shards, [])
+            groups.append(group)
+
+        group[1].append((short_code, new_short_code))
+
+    async def move_group(source: ReadWriteRouter, target: ReadWriteRouter, group: list):
+        if source is target:
+            return await move_within_shard(source, user_id, group)
+
+        records, taken = await move_across_shards(source, target, user_id, group)
+        moved = {record["short_code"] for record in records}
+        return [move for move in group if move[1] in moved], taken
+
+    made, taken = set(), set()
+
+    for (source, target), group in groups:
+        try:
+            group_made, group_taken = await move_group(source, target, group)
+
+        # a new short code was taken by a write racing this one, the group was not changed,
+        # so each move is tried on its own
+        except IntegrityError:
+            group_made, group_taken = [], []
+
+            for move in group:
+                try:
+                    move_made, move_taken = await move_group(source, target, [move])
+
+                except IntegrityError:
+                    move_made, move_taken = [], [move]
+
+                group_made += move_made
+                group_taken += move_taken
+
+        made.update(group_made)
+        taken.update(group_taken)
 
-    except Exception as e:
-        db.rollback()
-        print
-        return json_response_failure()
+    return made, taken
 
 
-@app.post("/modify_short_code")
+@app.post("/modify_short_code", dependencies=[Depends(admit_write)])
 async def modify_url_short_code(
         mod_request: ModificiationRequest,
-        db: Session = Depends(get_db),
-        session: SessionContainer = Depends(verify_session(session_required=False))):
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
 
     user_id = get_user_id(session)
 
     if mod_request.short_code == '' or mod_request.new_short_code == '':
         return json_response_missing("a short code and a new short code")
 
-    url_record = db.get(ShortURLModel, (mod_request.short_code))
-    conflict_url_record = db.get(ShortURLModel, (mod_request.new_short_code))
-
-    if url_record is None:
-        return json_response_not_found(mod_request.short_code)
+    # renaming a short code to itself would change nothing, the short code is in use
+    if mod_request.new_short_code == mod_request.short_code:
+        return json_response_in_use(mod_request.new_short_code)
 
-    if url_record.owner_id != user_id:
-        return json_response_not_owned(url_record.short_code)
+    records, taken = await rename_short_code(
+        router, user_id, mod_request.short_code, mod_request.new_short_code)
 
-    if conflict_url_record is not None:
+    if taken:
         return json_response_in_use(mod_request.new_short_code)
 
+    # nothing renamed, tell a missing short code from one owned by someone else
+    if not records:
+        async with router.shard(mod_request.short_code).primary() as db:
+            if await db.get(ShortURLModel, (mod_request.short_code)) is None:
+                return json_response_not_found(mod_request.short_code)
+
+        return json_response_not_owned(mod_request.short_code)
+
+    record = records[0]
+    track_renamed(router, user_id, mod_request.short_code, mod_request.new_short_code,
+                  (record["url"], record["cache_max_age"]))
+    return ORJSONResponse(
+        {column: record[column] for column in ShortURLModel.json_columns},
+        status_code=status.HTTP_202_ACCEPTED)
+
+
+@app.delete("/delete_short_codes", dependencies=[Depends(admit_write)])
+async def delete_url_short_codes(
+        request: Request,
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
+
+    user_id = get_user_id(session)
+
     try:
-        url_record.short_code = mod_request.new_short_code
-        db.commit()
-        return JSONResponse(
-            url_record.to_dict(),
-            status_code=status.HTTP_202_ACCEPTED)
-
-    except IntegrityError:
-        db.rollback()
-        return json_response_in_use(mod_request.new_short_code)
+        short_codes, count = await read_batch_short_codes(request)
+
+    except ValidationError:
+        return json_response_missing("a list of short codes")
+
+    if count > batch_max_size:
+        return json_response_too_many(count)
+
+    wanted = list(dict.fromkeys(short_code for short_code in short_codes if short_code != ''))
+    links = ShortURLModel.__table__
+
+    async def delete_owned(shard: ReadWriteRouter, short_codes: list) -> list:
+        # ownership is checked by the delete itself, nothing is read first, returns the
+        # (short_code, url) rows deleted, None when the shard failed
+        try:
+            async with shard.primary() as db:
+                deleted = (await db.execute(delete(links).where(
+                    links.c.short_code.in_(short_codes),
+                    links.c.owner_id == user_id).returning(
+                    links.c.short_code, links.c.url))).all()
+
+                if deleted:
+                    await db.execute(insert(ShortCodeChangeModel.__table__), change_rows(
+                        DELETE, [short_code for short_code, _ in deleted]))
+                    await db.commit()
+
+        except Exception:
+            return None
+
+        # as soon as it is committed, whatever happens on the other shards
+        track_deleted(router, user_id, *(short_code for short_code, _ in deleted))
+        return deleted
+
+    # one transaction per shard, all shards at once, a shard that fails leaves the
+    # deletes of the others in place
+    shards = by_shard(router, wanted)
+    deleted, failed = {}, set()
+
+    for short_codes_of_shard, rows in zip(shards.values(), await asyncio.gather(*(
+            delete_owned(shard, short_codes_of_shard)
+            for shard, short_codes_of_shard in shards.items()))):
+        if rows is None:
+            failed.update(short_codes_of_shard)
+
+        else:
+            deleted.update(rows)
+
+    # only short codes that were not deleted are read, to tell missing from not owned
+    records = {short_code: owner_id for short_code, owner_id in await select_records(
+        router, [short_code for short_code in wanted
+                 if short_code not in deleted and short_code not in failed],
+        ShortURLModel.short_code, ShortURLModel.owner_id)}
+
+    results = []
+
+    for short_code in short_codes:
+        if short_code == '':
+            results.append({"short_code": short_code,
+                            "message": "you must supply a short code",
+                            "status": status.HTTP_406_NOT_ACCEPTABLE})
+
+        elif short_code in deleted:
+            # repeats of a short code within the batch are reported deleted as well
+            results.append({"short_code": short_code, "url": deleted[short_code],
+                            "status": status.HTTP_200_OK})
+
+        elif short_code in failed:
+            results.append({"short_code": short_code,
+                            "message": "something went wrong...",
+                            "status": status.HTTP_500_INTERNAL_SERVER_ERROR})
+
+        elif short_code not in records:
+            results.append({"short_code": short_code,
+                            "message": f"{short_code} not found",
+                            "status": status.HTTP_404_NOT_FOUND})
+
+        else:
+            results.append({"short_code": short_code,
+                            "message": f"{short_code} not owned by you",
+                            "status": status.HTTP_403_FORBIDDEN})
+
+    return ndjson_results(results)
+
+
+@app.post("/modify_short_codes", dependencies=[Depends(admit_write)])
+async def modify_url_short_codes(
+        request: Request,
+        router: ShardRouter = Depends(get_db_router),
+        session: UserSession = Depends(optional_session)):
+
+    user_id = get_user_id(session)
+
+    try:
+        modifications, count = await read_batch_modifications(request)
+
+    except ValidationError:
+        return json_response_missing("a list of short codes and new short codes")
+
+    if count > batch_max_size:
+        return json_response_too_many(count)
+
+    wanted = list(dict.fromkeys(
+        short_code for modification in modifications
+        for short_code in (modification.short_code, modification.new_short_code)
+        if short_code != ''))
+    # owners of every short code and new short code in one query per shard
+    records = {short_code: (owner_id, url, cache_max_age)
+               for short_code, owner_id, url, cache_max_age in await select_records(
+                   router, wanted, ShortURLModel.short_code, ShortURLModel.owner_id,
+                   ShortURLModel.url, ShortURLModel.cache_max_age)}
+
+    # modifications are checked in order against the codes as the earlier ones left them,
+    # so a code freed by one can be taken by a later one
+    results = []
+    moves = []
+
+    for modification in modifications:
+        short_code, new_short_code = modification.short_code, modification.new_short_code
+        result = {"short_code": short_code, "new_short_code": new_short_code}
+
+        if short_code == '' or new_short_code == '':
+            result.update(message="you must supply a short code and a new short code",
+                          status=status.HTTP_406_NOT_ACCEPTABLE)
+
+        elif short_code not in records:
+            result.update(message=f"{short_code} not found",
+                          status=status.HTTP_404_NOT_FOUND)
+
+        elif records[short_code][0] != user_id:
+            result.update(message=f"{short_code} not owned by you",
+                          status=status.HTTP_403_FORBIDDEN)
+
+        elif new_short_code in records:
+            result.update(message=f"{new_short_code} already in use",
+                          status=status.HTTP_409_CONFLICT)
+
+        else:
+            records[new_short_code] = records.pop(short_code)
+            _, url, cache_max_age = records[new_short_code]
+            result = {"short_code": new_short_code, "owner_id": user_id, "url": url,
+                      "cache_max_age": cache_max_age, "status": status.HTTP_202_ACCEPTED}
+            moves.append((short_code, new_short_code, (url, cache_max_age), result))
+
+        results.append(result)
+
+    made, taken = await move_short_codes(router, user_id, [
+        (short_code, new_short_code) for short_code, new_short_code, _, _ in moves])
+
+    for short_code, new_short_code, redirect, result in moves:
+        if (short_code, new_short_code) in made:
+            track_renamed(router, user_id, short_code, new_short_code, redirect)
+            continue
+
+        result.clear()
+        result.update(short_code=short_code, new_short_code=new_short_code)
+
+        # the new short code was taken while the batch was checked, this one was not moved
+        if (short_code, new_short_code) in taken:
+            result.update(message=f"{new_short_code} already in use",
+                          status=status.HTTP_409_CONFLICT)
+
+        # deleted while the batch was checked
+        else:
+            result.update(message=f"{short_code} not found",
+                          status=status.HTTP_404_NOT_FOUND)
+
+    return ndjson_results(results)
+
+
+# serve this instead of app to answer redirects ahead of the middleware stack
+redirect_app = RedirectFastPath(
+    app, async_engine, redirect_cache, clicks=click_aggregator, bloom=short_code_filter,
+    router=db_router, snapshot=redirect_snapshot)
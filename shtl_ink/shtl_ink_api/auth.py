@@ -0,0 +1,182 @@
+"""
+auth.py: session handling scoped to the management routes
+"""
+
+from typing import Protocol
+from fastapi import Request
+from .cache import LRUCache
+from .config import app_name, base_url, frontend_base_url, cookie_domain
+from .config import supertokens_conn_uri, supertokens_api_key
+
+# routes that use sessions, entries ending in _ are prefixes, the others match themselves
+# and the paths below them. /click_stats lists the records of the session's owner like
+# /all_short_codes
+MANAGEMENT_PATHS = (
+    "/create_",
+    "/delete_",
+    "/modify_short_code",
+    "/modify_short_codes",
+    "/all_short_codes",
+    "/click_stats",
+    "/auth")
+
+# routes the frontend calls from its own origin, the short code lookups are anonymous, so
+# they get CORS without the session middleware
+CORS_PATHS = MANAGEMENT_PATHS + ("/short_code",)
+
+
+class UserSession(Protocol):
+    """
+    UserSession: the part of a supertokens SessionContainer the routes use, annotations
+        name it so supertokens is only imported by init_auth() and the first request
+    """
+
+    def get_user_id(self) -> str:
+        ...
+
+
+def init_auth() -> None:
+    """
+    init_auth: initializes supertokens, run when a worker starts rather than on import, it
+        resolves the api and website domains, which can take a network round trip
+    """
+    from supertokens_python import init, InputAppInfo, SupertokensConfig
+    from supertokens_python.recipe import emailpassword, session
+
+    init(
+        app_info=InputAppInfo(
+            app_name=app_name,
+            api_domain=base_url,
+            website_domain=frontend_base_url,
+            api_base_path="/auth",
+            website_base_path="/auth"
+        ),
+        supertokens_config=SupertokensConfig(
+            connection_uri=supertokens_conn_uri,
+            api_key=supertokens_api_key
+        ),
+        framework='fastapi',
+        recipe_list=[
+            session.init(cookie_domain=cookie_domain),  # initializes session features
+            emailpassword.init()
+        ],
+        mode='asgi'  # use wsgi if you are running using gunicorn
+    )
+
+
+def supertokens_middleware(app):
+    """
+    supertokens_middleware: the supertokens ASGI middleware around app
+    """
+    from supertokens_python.framework.fastapi import get_middleware
+
+    return get_middleware()(app)
+
+
+def deferred_verify_session(**options):
+    """
+    deferred_verify_session: dependency that runs verify_session(**options) of supertokens,
+        built on the first request
+    """
+    verify = None
+
+    async def func(request: Request) -> UserSession:
+        nonlocal verify
+
+        if verify is None:
+            from supertokens_python.recipe.session.framework.fastapi import verify_session
+            verify = verify_session(**options)
+
+        return await verify(request)
+
+    return func
+
+
+def is_management_path(path: str, paths: tuple = MANAGEMENT_PATHS) -> bool:
+    for scoped in paths:
+        if scoped.endswith('_'):
+            if path.startswith(scoped):
+                return True
+
+        elif path == scoped or path.startswith(scoped + '/'):
+            return True
+
+    return False
+
+
+class PathScopedMiddleware:
+    """
+    PathScopedMiddleware: ASGI middleware that runs middleware, built with options, only for
+        requests to paths, see is_management_path(), every other request goes straight to
+        the wrapped app. Redirects take the lean stack, without the session and CORS work.
+        middleware is built on the first request to paths, so a worker that never gets one
+        does not import it.
+    """
+
+    def __init__(self, app, middleware, paths: tuple = MANAGEMENT_PATHS, **options):
+        self.app = app
+        self.middleware = middleware
+        self.options = options
+        self.scoped = None
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] in ('http', 'websocket') and is_management_path(
+                scope['path'], self.paths):
+            if self.scoped is None:
+                self.scoped = self.middleware(self.app, **self.options)
+
+            return await self.scoped(scope, receive, send)
+
+        await self.app(scope, receive, send)
+
+
+def session_cache_key(request: Request):
+    access_token = request.cookies.get('sAccessToken')
+
+    if access_token is None or request.cookies.get('sIdRefreshToken') is None:
+        return None
+
+    # the anti csrf check only runs for non GET requests, and only passes with the header
+    # it was verified with, so both are part of the key
+    return (
+        access_token,
+        request.headers.get('anti-csrf'),
+        request.headers.get('rid') is not None,
+        request.method == 'GET')
+
+
+def cached_session(cache: LRUCache, verify):
+    """
+    cached_session: wraps verify, a dependency like deferred_verify_session(), so a session
+        verified for a set of tokens is reused for cache.ttl seconds. Sessions whose tokens
+        were refreshed or cleared during verification are never cached, the response has
+        to carry the new cookies. A revoked or expired session can still be served until
+        its entry expires, keep the ttl short.
+    """
+
+    async def func(request: Request) -> UserSession:
+        key = session_cache_key(request)
+
+        if key is not None:
+            session = cache.get(key)
+
+            if session is not None:
+                from supertokens_python.framework.fastapi.fastapi_request import FastApiRequest
+
+                # the supertokens middleware reads the session back from the request
+                FastApiRequest(request).set_session(session)
+                return session
+
+        session = await verify(request)
+
+        if (key is not None and session is not None and not session.remove_cookies
+                and session.new_access_token_info is None
+                and session.new_refresh_token_info is None
+                and session.new_id_refresh_token_info is None
+                and session.new_anti_csrf_token is None):
+            cache.set(key, session)
+
+        return session
+
+    return func
@@ -0,0 +1,64 @@
+"""
+bloom.py: negative lookup filter for short codes
+"""
+
+from hashlib import blake2b
+from math import ceil, exp, log
+
+
+class BloomFilter:
+    """
+    BloomFilter: fixed size set membership filter with no false negatives.
+    A key that was added is always reported as present, a key that was never added is
+        reported as present with probability about error_rate while no more than capacity
+        keys are in the filter. Keys can not be removed.
+    BloomFilter.reset() empties the filter and sizes it for a new capacity
+    BloomFilter.add() adds a key
+    BloomFilter.might_contain() is False only for keys that were never added, it is always
+        True until the filter is marked loaded
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.error_rate = error_rate
+        self.loaded = False
+        self.reset(capacity)
+
+    def reset(self, capacity: int) -> None:
+        self.capacity = max(1, capacity)
+        # optimal bit and hash counts for the capacity and error rate
+        self.size = ceil(-self.capacity * log(self.error_rate) / log(2) ** 2)
+        self.hashes = max(1, round(self.size / self.capacity * log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self.bits)
+
+    def false_positive_rate(self) -> float:
+        return (1 - exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def _positions(self, key: str):
+        digest = blake2b(key.encode('utf-8'), digest_size=16).digest()
+        # double hashing, k positions from two 64 bit hashes
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(key))
+
+    def might_contain(self, key: str) -> bool:
+        return not self.loaded or key in self
@@ -0,0 +1,285 @@
+"""
+bulk.py: streaming import and export of the short_code_to_url table
+"""
+
+import csv
+import io
+import sys
+import orjson
+from itertools import islice
+from time import perf_counter
+from sqlalchemy import select, insert
+from sqlalchemy.orm import Session
+from .models import ShortURLModel, ShortCodeChangeModel, url_hash
+from .changes import CREATE, change_rows
+from .codec import Codec
+from .routing import HashRing
+
+FORMATS = ('txt', 'csv', 'ndjson')
+# columns of an export and of an import in csv or ndjson, only url is required
+COLUMNS = ('short_code', 'owner_id', 'url')
+
+
+def format_of(path: str) -> str:
+    """
+    the format a file name implies, plain text with one url per line by default
+    """
+    if path.endswith('.csv'):
+        return 'csv'
+
+    if path.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+
+    return 'txt'
+
+
+def read_records(file, format: str, owner_id: str = "anonymous"):
+    """
+    read_records: yields a (short_code, owner_id, url) record for every line of a text
+        file, short_code is None when the line does not name one and a code should be
+        allocated, owner_id defaults to owner_id
+    """
+    if format == 'txt':
+        for line in file:
+            line = line.strip()
+
+            if line:
+                yield (None, owner_id, line)
+
+    elif format == 'csv':
+        for row in csv.DictReader(file):
+            yield (row.get('short_code') or None, row.get('owner_id') or owner_id, row['url'])
+
+    elif format == 'ndjson':
+        for line in file:
+            if line.strip():
+                row = orjson.loads(line)
+                yield (row.get('short_code') or None, row.get('owner_id') or owner_id,
+                       row['url'])
+
+    else:
+        raise ValueError(f"unknown format {format}, expected one of {', '.join(FORMATS)}")
+
+
+def write_records(file, format: str, records) -> None:
+    """
+    write_records: writes (short_code, owner_id, url) records to a text file, plain text
+        keeps the urls only
+    """
+    if format == 'txt':
+        for short_code, owner_id, url in records:
+            file.write(f"{url}\n")
+
+    elif format == 'csv':
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        writer.writerows(records)
+
+    elif format == 'ndjson':
+        for record in records:
+            file.write(orjson.dumps(dict(zip(COLUMNS, record))).decode('utf-8') + "\n")
+
+    else:
+        raise ValueError(f"unknown format {format}, expected one of {', '.join(FORMATS)}")
+
+
+class Progress:
+    """
+    Progress: reports rows done and rows per second to a text stream, at most once every
+        interval seconds
+    Progress.update() adds rows done and reports when the interval has passed
+    Progress.done() reports the totals
+    """
+
+    def __init__(self, label: str, stream=sys.stderr, interval: float = 1.0):
+        self.label = label
+        self.stream = stream
+        self.interval = interval
+        self.rows = 0
+        self.started = self.reported = perf_counter()
+
+    def rate(self) -> float:
+        return self.rows / max(perf_counter() - self.started, 1e-9)
+
+    def update(self, rows: int) -> None:
+        self.rows += rows
+
+        if perf_counter() - self.reported >= self.interval:
+            self.reported = perf_counter()
+            print(f"{self.label} {self.rows} rows, {self.rate():.0f} rows/sec",
+                  file=self.stream)
+
+    def done(self) -> None:
+        print(f"{self.label} {self.rows} rows in {perf_counter() - self.started:.1f}s, "
+              f"{self.rate():.0f} rows/sec", file=self.stream)
+
+
+def batches(iterable, size: int):
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(islice(iterator, size))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+def taken_short_codes(connection, short_codes: list, chunk_size: int = 500) -> set:
+    taken = set()
+
+    # chunks keep bound parameters under driver limits
+    for start in range(0, len(short_codes), chunk_size):
+        taken.update(connection.execute(select(ShortURLModel.short_code).where(
+            ShortURLModel.short_code.in_(short_codes[start:start + chunk_size]))).scalars())
+
+    return taken
+
+
+def copy_rows(connection, table, rows: list) -> None:
+    """
+    copy_rows: writes rows, dicts keyed by column, to table with COPY on postgres and an
+        executemany insert otherwise
+    """
+    if not rows:
+        return
+
+    if connection.dialect.name != 'postgresql':
+        connection.execute(insert(table), rows)
+        return
+
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([row[column] for column in columns] for row in rows)
+    buffer.seek(0)
+    # the raw psycopg2 connection, inside the transaction of connection
+    with connection.connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def import_records(
+        engines: list,
+        records,
+        names: list = None,
+        codec: Codec = None,
+        batch_size: int = 10000,
+        progress: Progress = None) -> tuple:
+    """
+    import_records: writes (short_code, owner_id, url) records to short_code_to_url on the
+        shards of engines, each on the one a routing.HashRing of names places its short
+        code on, names can be left out for a single engine. One transaction per shard per
+        batch_size records, allocating short codes for records without one. Records with
+        a short code that is already taken on its shard, or a url that is empty or too
+        long, are skipped. Every short code written is logged in short_code_changes so
+        running workers pick it up. Returns the number of records written and skipped.
+    """
+    ring = HashRing(names or ["default"])
+    codec = codec or Codec()
+    imported = skipped = 0
+
+    # short code blocks are reserved on the first shard, like the workers do
+    with Session(engines[0]) as session:
+        for batch in batches(records, batch_size):
+            valid = [record for record in batch if 0 < len(record[2]) <= 2000]
+            skipped += len(batch) - len(valid)
+            named = set()
+            pending = []
+
+            for short_code, owner_id, url in valid:
+                # named by an earlier record of this batch
+                if short_code is not None and short_code in named:
+                    skipped += 1
+                    continue
+
+                if short_code is not None:
+                    named.add(short_code)
+
+                pending.append(({'short_code': short_code, 'owner_id': owner_id,
+                                 'url': url, 'url_hash': url_hash(url)}, short_code is None))
+
+            while pending:
+                for row, allocated in pending:
+                    # allocated codes only collide with custom short codes
+                    while allocated and (
+                            row['short_code'] is None or row['short_code'] in named):
+                        codec.collisions += row['short_code'] is not None
+                        row['short_code'] = codec.allocator.next_short_code(session)
+
+                by_node = {}
+
+                for row, allocated in pending:
+                    by_node.setdefault(ring.node(row['short_code']), []).append(
+                        (row, allocated))
+
+                pending = []
+
+                for node, shard_rows in by_node.items():
+                    with engines[node].begin() as connection:
+                        taken = taken_short_codes(
+                            connection, [row['short_code'] for row, _ in shard_rows])
+                        rows = []
+
+                        for row, allocated in shard_rows:
+                            if row['short_code'] not in taken:
+                                rows.append(row)
+
+                            elif allocated:
+                                # taken by a custom short code, allocate another
+                                codec.collisions += 1
+                                row['short_code'] = None
+                                pending.append((row, allocated))
+
+                            else:
+                                skipped += 1
+
+                        copy_rows(connection, ShortURLModel.__table__, rows)
+                        copy_rows(connection, ShortCodeChangeModel.__table__, change_rows(
+                            CREATE, [row['short_code'] for row in rows]))
+
+                    imported += len(rows)
+
+            if progress is not None:
+                progress.update(len(batch))
+
+    if progress is not None:
+        progress.done()
+
+    return imported, skipped
+
+
+def export_records(
+        engines: list,
+        file,
+        format: str,
+        batch_size: int = 10000,
+        progress: Progress = None) -> int:
+    """
+    export_records: streams every record of short_code_to_url on the shards of engines to a
+        text file, reading batch_size rows at a time so memory stays flat however large the
+        table is, returns the number of records written
+    """
+    exported = 0
+
+    def rows():
+        nonlocal exported
+
+        for engine in engines:
+            with engine.connect() as connection:
+                result = connection.execution_options(yield_per=batch_size).execute(select(
+                    ShortURLModel.short_code, ShortURLModel.owner_id, ShortURLModel.url))
+
+                for partition in result.partitions():
+                    yield from partition
+                    exported += len(partition)
+
+                    if progress is not None:
+                        progress.update(len(partition))
+
+    write_records(file, format, rows())
+
+    if progress is not None:
+        progress.done()
+
+    return exported
@@ -0,0 +1,104 @@
+"""
+cache.py: in-process caches for the redirect hot path, and coalescing of identical calls
+"""
+
+import asyncio
+from collections import OrderedDict
+from time import monotonic
+
+
+class LRUCache:
+    """
+    LRUCache: bounded least recently used cache with a per entry time to live.
+    LRUCache.get() returns the cached value for a key or None if the key is
+        absent or expired, and counts the lookup as a hit or a miss
+    LRUCache.set() stores a value, evicting the least recently used entry when full
+    LRUCache.invalidate() drops a key, if it is cached
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        value, expires = entry
+
+        if expires < monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value) -> None:
+        if self.max_size <= 0:
+            return
+
+        self._entries[key] = (value, monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *keys) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+class SingleFlight:
+    """
+    SingleFlight: coalesces concurrent identical calls on the event loop, while a call for
+        a key is running every other caller with the same key waits for it and gets its
+        result, or its exception, instead of making the call again.
+    SingleFlight.run() awaits call() for key, or the call for key already running. The
+        call keeps running for the others when the caller that started it is cancelled.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def run(self, key, call):
+        future = self._calls.get(key)
+
+        if future is not None:
+            self.coalesced += 1
+
+        else:
+            future = asyncio.ensure_future(call())
+            self._calls[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future) -> None:
+        if self._calls.get(key) is future:
+            del self._calls[key]
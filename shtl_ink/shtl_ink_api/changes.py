@@ -0,0 +1,203 @@
+"""
+changes.py: append only log of short code changes that workers follow to invalidate
+their in process caches
+"""
+
+import asyncio
+import logging
+from time import monotonic
+from sqlalchemy import select, delete, func, or_
+from sqlalchemy.ext.asyncio import AsyncEngine
+from .models import ShortCodeChangeModel
+
+log = logging.getLogger(__name__)
+
+CREATE = 'create'
+DELETE = 'delete'
+
+
+def log_changes(session, op: str, *short_codes: str) -> None:
+    """
+    log_changes: adds change log entries to a sync or async session, they are written by
+        the same commit as the change itself
+    """
+    session.add_all([
+        ShortCodeChangeModel(op=op, short_code=short_code) for short_code in short_codes])
+
+
+def change_rows(op: str, short_codes: list) -> list:
+    return [{'op': op, 'short_code': short_code} for short_code in short_codes]
+
+
+def hole_ranges(holes) -> list:
+    """
+    hole_ranges: the runs of consecutive sequence numbers in holes, as (first, last) pairs
+    """
+    ranges = []
+
+    for seq in sorted(holes):
+        if ranges and ranges[-1][1] == seq - 1:
+            ranges[-1] = (ranges[-1][0], seq)
+
+        else:
+            ranges.append((seq, seq))
+
+    return ranges
+
+
+class ChangeFeed:
+    """
+    ChangeFeed: follows the short_code_changes table and calls apply(op, short_code, seq)
+        for every entry written after it started, in sequence order.
+    Sequence numbers are handed out before commit, so an entry can show up after entries
+        with higher numbers. Numbers skipped over are kept as holes and asked for again
+        until hole_ttl seconds pass, long enough for any transaction to commit or roll
+        back, so a late entry is applied too. apply should only invalidate, then replaying
+        an entry out of order is harmless. Holes are asked for as ranges of consecutive
+        numbers, ranges_per_query at a time, so a rolled back batch of any size never
+        outgrows the bound parameter limit of the driver.
+    When entries the feed has not seen were compacted away, reset() is called instead, it
+        should drop everything cached.
+    ChangeFeed.poll() applies new entries and returns how many
+    ChangeFeed.compact() deletes all but the newest retain entries
+    ChangeFeed.start() starts at the newest entry, or applies every entry after since
+        first, and polls every interval seconds in the background, compacting every
+        compact_interval seconds
+    ChangeFeed.stop() stops the background task
+    ChangeFeed.since is the seq every entry after which was applied, or will be
+    """
+
+    def __init__(
+            self,
+            engine: AsyncEngine,
+            apply,
+            reset,
+            interval: float,
+            retain: int,
+            compact_interval: float,
+            batch_size: int = 1000,
+            hole_ttl: float = 60.0,
+            ranges_per_query: int = 100):
+        self.engine = engine
+        self.apply = apply
+        self.reset = reset
+        self.interval = interval
+        self.retain = retain
+        self.compact_interval = compact_interval
+        self.batch_size = batch_size
+        self.hole_ttl = hole_ttl
+        self.ranges_per_query = ranges_per_query
+        self.last_seq = 0
+        self.since = 0
+        self.applied = 0
+        self.resets = 0
+        self._holes = {}
+        self._task = None
+
+    async def seek_end(self) -> None:
+        async with self.engine.connect() as connection:
+            self.last_seq = (await connection.execute(
+                select(func.max(ShortCodeChangeModel.seq)))).scalar() or 0
+
+        self.since = self.last_seq
+        self._holes = {}
+
+    async def catch_up(self) -> None:
+        # a full batch means more are waiting
+        while await self.poll() >= self.batch_size:
+            pass
+
+    async def poll(self) -> int:
+        now = monotonic()
+        self._holes = {
+            seq: seen for seq, seen in self._holes.items() if now - seen < self.hole_ttl}
+        ranges = hole_ranges(self._holes)
+        entries = select(
+            ShortCodeChangeModel.seq, ShortCodeChangeModel.op, ShortCodeChangeModel.short_code)
+        late = []
+
+        async with self.engine.connect() as connection:
+            first = (await connection.execute(
+                select(func.min(ShortCodeChangeModel.seq)))).scalar()
+
+            for start in range(0, len(ranges), self.ranges_per_query):
+                late.extend((await connection.execute(entries.where(or_(*(
+                    ShortCodeChangeModel.seq.between(low, high)
+                    for low, high in ranges[start:start + self.ranges_per_query]))))).all())
+
+            changes = (await connection.execute(
+                entries.where(ShortCodeChangeModel.seq > self.last_seq).order_by(
+                    ShortCodeChangeModel.seq).limit(self.batch_size))).all()
+
+        # compacted past this feed, what it missed can not be replayed
+        if first is not None and first > self.last_seq + 1:
+            self.reset()
+            self.resets += 1
+            self._holes = {}
+            self.last_seq = self.since = first - 1
+
+        for seq, op, short_code in late:
+            self._holes.pop(seq, None)
+            self.apply(op, short_code, seq)
+
+        for seq, op, short_code in changes:
+            for hole in range(self.last_seq + 1, seq):
+                self._holes[hole] = now
+
+            self.last_seq = seq
+            self.apply(op, short_code, seq)
+
+        self.applied += len(late) + len(changes)
+        return len(late) + len(changes)
+
+    async def compact(self) -> int:
+        async with self.engine.begin() as connection:
+            newest = (await connection.execute(
+                select(func.max(ShortCodeChangeModel.seq)))).scalar()
+
+            if newest is None or newest <= self.retain:
+                return 0
+
+            return (await connection.execute(delete(ShortCodeChangeModel).where(
+                ShortCodeChangeModel.seq <= newest - self.retain))).rowcount
+
+    async def _run(self) -> None:
+        compacted = monotonic()
+
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.catch_up()
+
+                if monotonic() - compacted >= self.compact_interval:
+                    compacted = monotonic()
+                    await self.compact()
+
+            # the database is unavailable, try again next interval
+            except Exception:
+                log.warning("following the change log failed, retrying", exc_info=True)
+
+    async def start(self, since: int = None) -> None:
+        if self._task is None:
+            if since is None:
+                await self.seek_end()
+
+            else:
+                self.last_seq = self.since = since
+                self._holes = {}
+                await self.catch_up()
+
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+            try:
+                await self._task
+
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
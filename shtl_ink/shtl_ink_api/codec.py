@@ -1,81 +1,333 @@
 # python3
 # -*- coding: utf-8 -*-
 
-import random
-from .models import ShortURLModel, Base
-from sqlalchemy import delete
+import asyncio
+from typing import List
+from .models import ShortURLModel, ShortCodeChangeModel, url_hash
+from .changes import CREATE, log_changes, change_rows
+from .allocator import ShortCodeAllocator
+from .routing import ReadWriteRouter, ShardRouter
+from .config import short_code_key, short_code_block_size
+from sqlalchemy import select, insert, exists, literal
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 
 
+def canonical_insert(engine, record: dict):
+    """
+    canonical_insert: INSERT ... SELECT of record, a canonical record of short_code_to_url,
+        in the dialect of a sync or async engine, returning it. Nothing is inserted or
+        returned when the owner already has a record of the url, and when another
+        request added the owner's canonical record of the url meanwhile that record is
+        returned instead.
+    """
+    links = ShortURLModel.__table__
+    dialect = postgresql if engine.dialect.name == 'postgresql' else sqlite
+    # url comparison rules out digest collisions
+    owned = select(links.c.short_code).where(
+        links.c.owner_id == record['owner_id'],
+        links.c.url_hash == record['url_hash'],
+        links.c.url == record['url'])
+    statement = dialect.insert(links).from_select(list(record), select(
+        *(literal(value, links.c[column].type) for column, value in record.items())).where(
+        ~exists(owned)))
+    # a no-op update, do nothing would return no row for the record that is already there
+    return statement.on_conflict_do_update(
+        index_elements=[links.c.owner_id, links.c.url_hash],
+        index_where=links.c.canonical.is_(True),
+        set_={'canonical': statement.excluded.canonical}).returning(
+        *(links.c[column] for column in ShortURLModel.json_columns))
+
+
+def canonical_key(owner_id: str, url: str) -> str:
+    """
+    canonical_key: the key whose shard holds the owner's canonical record of url, so every
+        worker inserts it where the unique index of the canonical records can see it
+    """
+    return f"{owner_id}\n{url_hash(url)}"
+
+
 class Codec:
     """
     Codec: Shortens long urls and returns original urls, urls are stored in a database.
-    Codec.url_encode() takes a long url, a sqlalchemy.orm.Session object, and
-        a multiplier returns a unique short code
-    Codec.encode() takes a url string and a sqlalchemy.orm.Session object, overwrites or adds
-        the record and returns the short code
+    Codec.url_encode() takes a long url, an owner id and a sqlalchemy.orm.Session object,
+        adds the record under the next allocated short code and returns the short code,
+        a cache_max_age makes it a permanent redirect
+    Codec.encode() takes a url string, an owner id and a sqlalchemy.orm.Session object,
+        adds the record and returns the short code
     Codec.decode() takes a shortened url string and a sqlalchemy.orm.Session object, queries
         database for shortened url, returns original url or None
+    Codec.url_encode_async(), Codec.encode_async() and Codec.decode_async() do the same
+        with a routing.ShardRouter, or a routing.ReadWriteRouter for a single database,
+        and must be awaited, records are written to the shard of their short code and
+        short codes are allocated on the first shard
+    Codec.encode_canonical_async() takes a url, an owner id and a routing.ShardRouter, adds
+        the owner's canonical record of the url in one INSERT ... ON CONFLICT on the shard
+        of its canonical_key(), unless the owner has a record of the url already or another
+        request, on any worker, added it first, and returns the record and whether it was
+        added. Its short code is allocated until one lands on that shard, the others are
+        kept for later canonical records on their shards. With more than one shard every
+        shard is asked for a record of the url first, batch creates, imports and rebalances
+        place records by their short code.
+    Codec.encode_batch_async() takes a list of urls, an owner id and a routing.ShardRouter,
+        adds all records in one transaction per shard and returns their short codes in the
+        same order
+    Every record added is logged in short_code_changes by the same commit
     """
 
     def __init__(self):
         # no vowels, no visually ambiguous characters
         self.alphabet = '23456789bcdfghjkmnpqrstvwxyzBCDFGHJKLMNPQRSTVWXYZ'
-        self.base = len(self.alphabet) - 1
-        # short code is 6 characters
-        self.shifts = range(2, 8)
-        self.shift_bits = 12
-        self.multiplier = 333
+        # short code is 6 characters, 49 ** 6 = 13,841,287,201 available codes
+        self.length = 6
+        # allocated codes never collide with each other, only with custom short codes
+        self.max_retries = 16
+        # rows per multi row insert statement, keeps bound parameters under driver limits
+        self.insert_batch_size = 500
+        self.collisions = 0
+        self.retries = 0
+        # shard -> allocated short codes not used yet
+        self.spare_short_codes = {}
+        self.allocator = ShortCodeAllocator(
+            self.alphabet, self.length, short_code_key, short_code_block_size)
 
     def url_encode(
             self,
             url: str,
             owner_id: str,
-            multiplier: int,
-            session: Session) -> str:
-        shift_bits = self.shift_bits
-        short_code = ''
-        # The number of available urls in this config is 13,983,816 by nCk(nChoosek)
-        # where n is the total number of characters available and k is the number
-        # of characters in the short code.  Don't know if it's possible to have
-        # a bijective algorithim with fixed output length.
-        # TODO: research bijective algorithm with fixed output length
-
-        seed = random.randint(3333, 13983816)
-        key = seed * multiplier
-
-        for _ in self.shifts:
-            short_code += self.alphabet[(key >> shift_bits) & self.base]
-            shift_bits -= 2
-
-        try:
-            session.add(ShortURLModel(
-                url=url, owner_id=owner_id, short_code=short_code))
-            session.commit()
-            return short_code
-
-        # collision
-        except IntegrityError:
-            session.rollback()
-
-            session.execute(delete(ShortURLModel).where(
-                ShortURLModel.url == url, ShortURLModel.owner_id == owner_id))
-            short_code = self.url_encode(
-                url,
-                multiplier +
-                random.choice(
-                    self.shifts),
-                session)
-            return short_code
-
-    def encode(self, url: str, owner_id: str, session: Session) -> str:
+            session: Session,
+            cache_max_age: int = None) -> str:
+
+        for _ in range(self.max_retries):
+            short_code = self.allocator.next_short_code(session)
+
+            try:
+                session.add(ShortURLModel(
+                    url=url, owner_id=owner_id, short_code=short_code,
+                    cache_max_age=cache_max_age))
+                log_changes(session, CREATE, short_code)
+                session.commit()
+                return short_code
+
+            # collision with a custom short code, try the next id
+            except IntegrityError:
+                session.rollback()
+                self.collisions += 1
+                self.retries += 1
+
+        raise Exception("could not allocate a free short code")
+
+    async def next_short_codes_async(self, count: int, router: ShardRouter) -> List[str]:
+        # the allocation counter is on the first shard, the session only connects when a
+        # new block of ids has to be reserved
+        async with router.shards[0].primary() as session:
+            return [await self.allocator.next_short_code_async(session) for _ in range(count)]
+
+    async def next_short_code_on_async(
+            self,
+            shard: ReadWriteRouter,
+            router: ShardRouter) -> str:
+        spare = self.spare_short_codes.setdefault(shard, [])
+
+        # about one in every len(router.shards) short codes lands on shard
+        while not spare:
+            for short_code in await self.next_short_codes_async(len(router.shards), router):
+                self.spare_short_codes.setdefault(router.shard(short_code), []).append(
+                    short_code)
+
+        return spare.pop()
+
+    async def url_encode_async(
+            self,
+            url: str,
+            owner_id: str,
+            router: ShardRouter,
+            cache_max_age: int = None) -> str:
+
+        for _ in range(self.max_retries):
+            short_code, = await self.next_short_codes_async(1, router)
+
+            async with router.shard(short_code).primary() as session:
+                try:
+                    session.add(ShortURLModel(
+                        url=url, owner_id=owner_id, short_code=short_code,
+                        cache_max_age=cache_max_age))
+                    log_changes(session, CREATE, short_code)
+                    await session.commit()
+                    return short_code
+
+                # collision with a custom short code, try the next id
+                except IntegrityError:
+                    await session.rollback()
+                    self.collisions += 1
+                    self.retries += 1
+
+        raise Exception("could not allocate a free short code")
+
+    async def owned_record_async(
+            self,
+            url: str,
+            owner_id: str,
+            shard: ReadWriteRouter) -> ShortURLModel:
+        # index probe on (owner_id, url_hash), url comparison rules out digest collisions
+        async with shard.primary() as session:
+            return (await session.execute(select(ShortURLModel).where(
+                ShortURLModel.owner_id == owner_id,
+                ShortURLModel.url_hash == url_hash(url),
+                ShortURLModel.url == url))).scalars().first()
+
+    async def encode_canonical_async(
+            self,
+            url: str,
+            owner_id: str,
+            router: ShardRouter,
+            cache_max_age: int = None) -> tuple:
+        self.check_url(url)
+        shard = router.shard(canonical_key(owner_id, url))
+        others = [other for other in router.shards if other is not shard]
+
+        # records not made here are on the shard of their short code, one probe per shard,
+        # all at once, the canonical record first
+        if others:
+            for record in await asyncio.gather(*(
+                    self.owned_record_async(url, owner_id, probed)
+                    for probed in [shard] + others)):
+                if record is not None:
+                    return record, False
+
+        for _ in range(self.max_retries):
+            short_code = await self.next_short_code_on_async(shard, router)
+
+            async with shard.primary() as session:
+                try:
+                    record = (await session.execute(canonical_insert(session.bind, {
+                        'short_code': short_code, 'owner_id': owner_id, 'url': url,
+                        'url_hash': url_hash(url), 'cache_max_age': cache_max_age,
+                        'canonical': True}))).one_or_none()
+
+                    # the owner has a record of the url on this shard already
+                    if record is None:
+                        await session.rollback()
+                        return await self.owned_record_async(url, owner_id, shard), False
 
+                    # a digest collision with another url of the owner, not a duplicate
+                    if record.url != url:
+                        await session.rollback()
+                        return ShortURLModel(
+                            owner_id=owner_id, url=url, cache_max_age=cache_max_age,
+                            short_code=await self.url_encode_async(
+                                url, owner_id, router, cache_max_age)), True
+
+                    created = record.short_code == short_code
+
+                    if created:
+                        log_changes(session, CREATE, short_code)
+
+                    await session.commit()
+                    return ShortURLModel(**record._mapping), created
+
+                # collision with a custom short code, try the next id
+                except IntegrityError:
+                    await session.rollback()
+                    self.collisions += 1
+                    self.retries += 1
+
+        raise Exception("could not allocate a free short code")
+
+    async def insert_batch_async(
+            self,
+            urls: List[str],
+            owner_id: str,
+            placed: list,
+            shard: ReadWriteRouter) -> list:
+        # placed are the (index in urls, short code) pairs of one shard, returns the ones
+        # written, none when a custom short code was taken while inserting
+        async with shard.primary() as session:
+            # one query for all candidates that are already taken by custom short codes
+            taken = set((await session.execute(
+                select(ShortURLModel.short_code).where(
+                    ShortURLModel.short_code.in_([short_code for _, short_code in placed]))
+            )).scalars())
+            self.collisions += len(taken)
+            free = [(index, short_code) for index, short_code in placed
+                    if short_code not in taken]
+            rows = [dict(url=urls[index], url_hash=url_hash(urls[index]), owner_id=owner_id,
+                         short_code=short_code)
+                    for index, short_code in free]
+
+            try:
+                for start in range(0, len(rows), self.insert_batch_size):
+                    await session.execute(insert(ShortURLModel).values(
+                        rows[start:start + self.insert_batch_size]))
+                    await session.execute(insert(ShortCodeChangeModel).values(change_rows(
+                        CREATE, [row['short_code'] for row in
+                                 rows[start:start + self.insert_batch_size]])))
+                await session.commit()
+                return free
+
+            except IntegrityError:
+                await session.rollback()
+                self.collisions += 1
+                self.retries += 1
+                return []
+
+    async def encode_batch_async(
+            self,
+            urls: List[str],
+            owner_id: str,
+            router: ShardRouter) -> List[str]:
+
+        for url in urls:
+            self.check_url(url)
+
+        short_codes = [None] * len(urls)
+        pending = list(range(len(urls)))
+
+        for _ in range(self.max_retries):
+            shards = {}
+
+            for index, short_code in zip(
+                    pending, await self.next_short_codes_async(len(pending), router)):
+                shards.setdefault(router.shard(short_code), []).append((index, short_code))
+
+            # one transaction per shard, all shards at once
+            for written in await asyncio.gather(*(
+                    self.insert_batch_async(urls, owner_id, placed, shard)
+                    for shard, placed in shards.items())):
+                for index, short_code in written:
+                    short_codes[index] = short_code
+
+            # urls whose short code was taken get new ones
+            pending = [index for index in pending if short_codes[index] is None]
+
+            if not pending:
+                return short_codes
+
+        raise Exception("could not allocate free short codes")
+
+    def check_url(self, url: str) -> None:
         if len(url) > 2000:
             raise Exception(
                 "URL is too long, de facto max length is 2000 characters.")
 
-        return self.url_encode(url, owner_id, self.multiplier, session)
+    def encode(
+            self,
+            url: str,
+            owner_id: str,
+            session: Session,
+            cache_max_age: int = None) -> str:
+        self.check_url(url)
+        return self.url_encode(url, owner_id, session, cache_max_age)
+
+    async def encode_async(
+            self,
+            url: str,
+            owner_id: str,
+            router: ShardRouter,
+            cache_max_age: int = None) -> str:
+        self.check_url(url)
+        return await self.url_encode_async(url, owner_id, router, cache_max_age)
 
     def decode(self, short_code: str, session: Session) -> str:
         url_record = session.get(ShortURLModel, (short_code))
@@ -85,3 +337,13 @@ class Codec:
 
         else:
             return url_record.url
+
+    async def decode_async(self, short_code: str, router: ShardRouter) -> str:
+        async with router.shard(short_code).read_session(short_code) as session:
+            url_record = await session.get(ShortURLModel, (short_code))
+
+        if url_record is None:
+            return None
+
+        else:
+            return url_record.url
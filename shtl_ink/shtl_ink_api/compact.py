@@ -0,0 +1,239 @@
+"""
+compact.py: copies short_code_to_url into the compact schema, allocated short codes keyed
+by a fixed width integer, custom short codes in a table of their own, owners and urls
+stored once and referred to by integer keys
+"""
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+from .models import ShortURLModel, OwnerModel, UrlBodyModel, CompactLinkModel
+from .models import CustomLinkModel, url_hash
+from .database import CompactBase
+from .bulk import Progress, taken_short_codes
+from .codec import Codec
+
+
+class ShortCodeKeys:
+    """
+    ShortCodeKeys: fixed width integer keys of the short codes of length characters of
+        alphabet, the ones the allocator hands out, a short code is read as a number in
+        base len(alphabet). The digits are in code point order, so keys sort like their
+        short codes and an index on them walks an owner's short codes in the order of
+        /all_short_codes. Custom short codes of any other shape have no key.
+    ShortCodeKeys.key() returns the key of a short code, None when it has none
+    ShortCodeKeys.short_code() returns the short code of a key
+    """
+
+    def __init__(self, alphabet: str, length: int):
+        self.digits = ''.join(sorted(alphabet))
+        self.values = {digit: value for value, digit in enumerate(self.digits)}
+        self.length = length
+
+    def key(self, short_code: str) -> int:
+        if len(short_code) != self.length:
+            return None
+
+        key = 0
+
+        for digit in short_code:
+            value = self.values.get(digit)
+
+            if value is None:
+                return None
+
+            key = key * len(self.digits) + value
+
+        return key
+
+    def short_code(self, key: int) -> str:
+        digits = []
+
+        for _ in range(self.length):
+            key, value = divmod(key, len(self.digits))
+            digits.append(self.digits[value])
+
+        return ''.join(reversed(digits))
+
+
+def short_code_keys(codec: Codec = None) -> ShortCodeKeys:
+    """
+    the keys of the short codes codec allocates
+    """
+    codec = codec or Codec()
+    return ShortCodeKeys(codec.alphabet, codec.length)
+
+
+def insert_or_skip(connection, table, rows: list, index_elements: list) -> None:
+    # rows already there, by index_elements, are left as they are
+    if rows:
+        dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+        connection.execute(
+            dialect.insert(table).on_conflict_do_nothing(index_elements=index_elements), rows)
+
+
+def upsert(connection, table, rows: list, index_elements: list) -> None:
+    # rows already there, by index_elements, get the values of rows
+    if rows:
+        dialect = postgresql if connection.dialect.name == 'postgresql' else sqlite
+        statement = dialect.insert(table)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in rows[0]
+                  if column not in index_elements}), rows)
+
+
+def owner_keys(connection, owner_ids: set, chunk_size: int = 500) -> dict:
+    """
+    owner_keys: owner id -> integer key of every one of owner_ids, adding the missing ones
+    """
+    owners = OwnerModel.__table__
+    owner_ids = sorted(owner_ids)
+    keys = {}
+
+    # chunks keep bound parameters under driver limits
+    for start in range(0, len(owner_ids), chunk_size):
+        chunk = owner_ids[start:start + chunk_size]
+        insert_or_skip(connection, owners, [{'owner_id': owner_id} for owner_id in chunk],
+                       [owners.c.owner_id])
+        keys.update((owner_id, key) for key, owner_id in connection.execute(
+            select(owners.c.id, owners.c.owner_id).where(owners.c.owner_id.in_(chunk))))
+
+    return keys
+
+
+def url_ids(connection, urls: set, chunk_size: int = 500) -> dict:
+    """
+    url_ids: url -> integer key of the url body of every one of urls, adding the missing
+        ones, raises ValueError on a digest collision of two urls
+    """
+    bodies = UrlBodyModel.__table__
+    digests = sorted({bytes.fromhex(url_hash(url)): url for url in urls}.items())
+    ids = {}
+
+    for start in range(0, len(digests), chunk_size):
+        chunk = dict(digests[start:start + chunk_size])
+        insert_or_skip(connection, bodies, [
+            {'url_hash': digest, 'url': url} for digest, url in chunk.items()],
+            [bodies.c.url_hash])
+
+        for id, digest, url in connection.execute(
+                select(bodies.c.id, bodies.c.url_hash, bodies.c.url).where(
+                    bodies.c.url_hash.in_(list(chunk)))):
+            if url != chunk[digest]:
+                raise ValueError(f"{url} and {chunk[digest]} have the same digest")
+
+            ids[url] = id
+
+    return ids
+
+
+def copy_compact(connection, keys: ShortCodeKeys, records: list) -> None:
+    """
+    copy_compact: writes records, rows of short_code_to_url, to the compact schema,
+        replacing what it has of their short codes
+    """
+    owners = owner_keys(connection, {
+        record.owner_id for record in records if record.owner_id is not None})
+    urls = url_ids(connection, {record.url for record in records if record.url is not None})
+    links, custom_links = [], []
+
+    for record in records:
+        row = {'owner_key': owners.get(record.owner_id), 'url_id': urls.get(record.url),
+               'cache_max_age': record.cache_max_age}
+        key = keys.key(record.short_code)
+
+        if key is None:
+            custom_links.append({'short_code': record.short_code, **row})
+
+        else:
+            links.append({'short_code_key': key, **row, 'canonical': record.canonical})
+
+    upsert(connection, CompactLinkModel.__table__, links,
+           [CompactLinkModel.__table__.c.short_code_key])
+    upsert(connection, CustomLinkModel.__table__, custom_links,
+           [CustomLinkModel.__table__.c.short_code])
+
+
+def remove_missing(engine: Engine, keys: ShortCodeKeys, batch_size: int) -> int:
+    """
+    remove_missing: deletes the links of the compact schema whose short codes are gone
+        from short_code_to_url, returns how many
+    """
+    removed = 0
+
+    for table, column, short_code_of in (
+            (CompactLinkModel.__table__, 'short_code_key', keys.short_code),
+            (CustomLinkModel.__table__, 'short_code', str)):
+        after = None
+
+        while True:
+            # keyset walk, deleting rows behind the cursor does not disturb it
+            with engine.begin() as connection:
+                query = select(table.c[column]).order_by(table.c[column]).limit(batch_size)
+
+                if after is not None:
+                    query = query.where(table.c[column] > after)
+
+                batch = connection.execute(query).scalars().all()
+
+                if not batch:
+                    break
+
+                after = batch[-1]
+                short_codes = {short_code_of(value): value for value in batch}
+                taken = taken_short_codes(connection, list(short_codes))
+                gone = [value for short_code, value in short_codes.items()
+                        if short_code not in taken]
+
+                if gone:
+                    connection.execute(delete(table).where(table.c[column].in_(gone)))
+                    removed += len(gone)
+
+    return removed
+
+
+def migrate_compact(
+        engine: Engine,
+        keys: ShortCodeKeys = None,
+        batch_size: int = 10000,
+        progress: Progress = None) -> tuple:
+    """
+    migrate_compact: creates the compact schema on a sync engine when it is missing and
+        copies every record of short_code_to_url into it, batch_size records per transaction, then deletes the compact links
+        of short codes no longer in short_code_to_url. Every run brings the compact schema
+        up to date with short_code_to_url, so run it again right before moving reads and
+        writes over. Url bodies no longer linked are kept. Returns the number of records
+        copied and the number of links deleted.
+    """
+    keys = keys or short_code_keys()
+    links = ShortURLModel.__table__
+    CompactBase.metadata.create_all(bind=engine)
+    copied = 0
+    after = ''
+
+    while True:
+        # keyset walk of the primary key, each batch starts where the last one stopped
+        with engine.begin() as connection:
+            records = connection.execute(select(
+                links.c.short_code, links.c.owner_id, links.c.url, links.c.cache_max_age,
+                links.c.canonical).where(links.c.short_code > after).order_by(
+                links.c.short_code).limit(batch_size)).all()
+
+            if not records:
+                break
+
+            copy_compact(connection, keys, records)
+
+        after = records[-1].short_code
+        copied += len(records)
+
+        if progress is not None:
+            progress.update(len(records))
+
+    removed = remove_missing(engine, keys, batch_size)
+
+    if progress is not None:
+        progress.done()
+
+    return copied, removed
@@ -1,5 +1,8 @@
+import logging
 import os
 
+log = logging.getLogger(__name__)
+
 _app_name = 'APP_NAME'
 _base_url = 'BASE_URL'
 _frontend_base_url = 'FRONTEND_BASE_URL'
@@ -10,6 +13,34 @@ _db_host = 'DB_HOST'
 _db_name = 'DB_NAME'
 _db_user = 'DB_USER'
 _db_pass = 'DB_PASS'
+_db_replica_hosts = 'DB_REPLICA_HOSTS'
+_db_shards = 'DB_SHARDS'
+_shard_fallback = 'SHARD_FALLBACK'
+_read_your_writes_window = 'READ_YOUR_WRITES_WINDOW'
+_short_code_key = 'SHORT_CODE_KEY'
+_short_code_block_size = 'SHORT_CODE_BLOCK_SIZE'
+_batch_max_size = 'BATCH_MAX_SIZE'
+_page_size = 'PAGE_SIZE'
+_page_size_max = 'PAGE_SIZE_MAX'
+_click_flush_interval = 'CLICK_FLUSH_INTERVAL'
+_click_flush_size = 'CLICK_FLUSH_SIZE'
+_bloom_filter = 'BLOOM_FILTER'
+_bloom_capacity = 'BLOOM_CAPACITY'
+_bloom_error_rate = 'BLOOM_ERROR_RATE'
+_redirect_cache_size = 'REDIRECT_CACHE_SIZE'
+_redirect_cache_ttl = 'REDIRECT_CACHE_TTL'
+_session_cache_size = 'SESSION_CACHE_SIZE'
+_session_cache_ttl = 'SESSION_CACHE_TTL'
+_migrate_on_startup = 'MIGRATE_ON_STARTUP'
+_snapshot_path = 'SNAPSHOT_PATH'
+_snapshot_refresh_interval = 'SNAPSHOT_REFRESH_INTERVAL'
+_change_feed_interval = 'CHANGE_FEED_INTERVAL'
+_change_feed_retain = 'CHANGE_FEED_RETAIN'
+_change_feed_compact_interval = 'CHANGE_FEED_COMPACT_INTERVAL'
+_write_rate = 'WRITE_RATE'
+_write_burst = 'WRITE_BURST'
+_write_concurrency = 'WRITE_CONCURRENCY'
+_trusted_proxies = 'TRUSTED_PROXIES'
 
 if _app_name in os.environ:
     app_name = os.environ[_app_name]
@@ -24,7 +55,7 @@ else:
     base_url = "http://localapi.shtl.ink:8000"
     frontend_base_url = "http://shtl.ink:3000"
     cookie_domain = ".shtl.ink"
-    print('URL environment variables not set, falling back to demo mode')
+    log.warning('URL environment variables not set, falling back to demo mode')
 
 if _supertokens_conn_uri in os.environ and _supertokens_api_key in os.environ:
     supertokens_conn_uri = os.environ[_supertokens_conn_uri]
@@ -32,7 +63,7 @@ if _supertokens_conn_uri in os.environ and _supertokens_api_key in os.environ:
 else:
     supertokens_conn_uri = "try.supertokens.com"
     supertokens_api_key = None
-    print('Supertokens environment variables not set, falling back to try.supertokens.com')
+    log.warning('Supertokens environment variables not set, falling back to try.supertokens.com')
 
 if _db_host in os.environ and _db_name in os.environ and _db_user in os.environ and _db_pass in os.environ:
     db_host = os.environ[_db_host]
@@ -41,4 +72,184 @@ if _db_host in os.environ and _db_name in os.environ and _db_user in os.environ
     db_pass = os.environ[_db_pass]
 else:
     db_host, db_name, db_user, db_pass = None, None, None, None
-    print('DB environment variables not set, falling back to sqlite')
+    log.warning('DB environment variables not set, falling back to sqlite')
+
+# comma separated hosts of read replicas, sharing the primary's name, user and password
+if _db_replica_hosts in os.environ and db_host is not None:
+    db_replica_hosts = [
+        host.strip() for host in os.environ[_db_replica_hosts].split(',') if host.strip()]
+else:
+    db_replica_hosts = []
+
+# comma separated shards after the first, name=host with hosts sharing the primary's
+# name, user and password, or name=file for sqlite files without DB_HOST, short codes are
+# spread over all of them by name, only the first one, shard0, has read replicas
+if _db_shards in os.environ:
+    db_shards = [shard.strip() for shard in os.environ[_db_shards].split(',') if shard.strip()]
+else:
+    db_shards = []
+
+# look up short codes missing from their shard on every other shard, turn on while
+# python -m shtl_ink_api rebalance moves short codes after shards are added
+if _shard_fallback in os.environ:
+    shard_fallback = os.environ[_shard_fallback].lower() in ('1', 'true', 'yes')
+else:
+    shard_fallback = False
+
+# seconds reads of something a worker just wrote go to the primary instead of a replica
+if _read_your_writes_window in os.environ:
+    read_your_writes_window = float(os.environ[_read_your_writes_window])
+else:
+    read_your_writes_window = 5.0
+
+# secret key for the short code permutation, changing it reshuffles every code
+# that has not been allocated yet, so set it once per deployment
+if _short_code_key in os.environ:
+    short_code_key = os.environ[_short_code_key]
+else:
+    short_code_key = "shtl.ink"
+    log.warning('Short code key environment variable not set, falling back to demo key')
+
+# number of ids each worker reserves from the database at a time
+if _short_code_block_size in os.environ:
+    short_code_block_size = int(os.environ[_short_code_block_size])
+else:
+    short_code_block_size = 1000
+
+# most urls accepted by a single batch create request
+if _batch_max_size in os.environ:
+    batch_max_size = int(os.environ[_batch_max_size])
+else:
+    batch_max_size = 10000
+
+# records per page of /all_short_codes when no limit is given, and the largest limit allowed
+if _page_size in os.environ:
+    page_size = int(os.environ[_page_size])
+else:
+    page_size = 1000
+
+if _page_size_max in os.environ:
+    page_size_max = int(os.environ[_page_size_max])
+else:
+    page_size_max = 10000
+
+# number of short code -> url entries each worker keeps in memory, 0 disables
+if _redirect_cache_size in os.environ:
+    redirect_cache_size = int(os.environ[_redirect_cache_size])
+else:
+    redirect_cache_size = 10000
+
+# seconds a cached redirect is served before it is read from the database again
+if _redirect_cache_ttl in os.environ:
+    redirect_cache_ttl = float(os.environ[_redirect_cache_ttl])
+else:
+    redirect_cache_ttl = 60.0
+
+# seconds between flushes of buffered click counts to the database
+if _click_flush_interval in os.environ:
+    click_flush_interval = float(os.environ[_click_flush_interval])
+else:
+    click_flush_interval = 5.0
+
+# number of distinct short codes buffered before a flush is triggered early
+if _click_flush_size in os.environ:
+    click_flush_size = int(os.environ[_click_flush_size])
+else:
+    click_flush_size = 1000
+
+# bloom filter of existing short codes, lookups of codes it rules out skip the database,
+# off by default, with several workers a code created on another one is not found until
+# this worker reads it from the change log
+if _bloom_filter in os.environ:
+    bloom_filter = os.environ[_bloom_filter].lower() in ('1', 'true', 'yes')
+else:
+    bloom_filter = False
+
+# short codes the filter is sized for at startup and its target false positive rate
+if _bloom_capacity in os.environ:
+    bloom_capacity = int(os.environ[_bloom_capacity])
+else:
+    bloom_capacity = 1000000
+
+if _bloom_error_rate in os.environ:
+    bloom_error_rate = float(os.environ[_bloom_error_rate])
+else:
+    bloom_error_rate = 0.01
+
+# number of verified sessions each worker keeps in memory, 0 disables
+if _session_cache_size in os.environ:
+    session_cache_size = int(os.environ[_session_cache_size])
+else:
+    session_cache_size = 10000
+
+# seconds a verified session is reused, a revoked session is accepted this long at most
+if _session_cache_ttl in os.environ:
+    session_cache_ttl = float(os.environ[_session_cache_ttl])
+else:
+    session_cache_ttl = 5.0
+
+# create and upgrade the schema when a worker starts, instead of with the migrate command,
+# on by default only for the sqlite demo database
+if _migrate_on_startup in os.environ:
+    migrate_on_startup = os.environ[_migrate_on_startup].lower() in ('1', 'true', 'yes')
+else:
+    migrate_on_startup = db_host is None
+
+# redirect snapshot written by python -m shtl_ink_api snapshot, redirects are answered
+# from it before the database is asked, unset disables it
+if _snapshot_path in os.environ:
+    snapshot_path = os.environ[_snapshot_path]
+else:
+    snapshot_path = None
+
+# seconds between checks for a new snapshot or delta
+if _snapshot_refresh_interval in os.environ:
+    snapshot_refresh_interval = float(os.environ[_snapshot_refresh_interval])
+else:
+    snapshot_refresh_interval = 10.0
+
+# seconds between reads of the change log, bounds how long another worker's change can
+# be served stale from this worker's caches
+if _change_feed_interval in os.environ:
+    change_feed_interval = float(os.environ[_change_feed_interval])
+else:
+    change_feed_interval = 1.0
+
+# change log entries kept, a worker that falls further behind drops its caches
+if _change_feed_retain in os.environ:
+    change_feed_retain = int(os.environ[_change_feed_retain])
+else:
+    change_feed_retain = 100000
+
+# seconds between deletes of change log entries past the retained ones
+if _change_feed_compact_interval in os.environ:
+    change_feed_compact_interval = float(os.environ[_change_feed_compact_interval])
+else:
+    change_feed_compact_interval = 300.0
+
+# writes per second each owner, or each anonymous client address, may sustain, 0 disables
+if _write_rate in os.environ:
+    write_rate = float(os.environ[_write_rate])
+else:
+    write_rate = 10.0
+
+# writes an owner may make at once after being idle
+if _write_burst in os.environ:
+    write_burst = float(os.environ[_write_burst])
+else:
+    write_burst = 20.0
+
+# writes each worker runs at once, below the 15 connections of the default pool so
+# redirects always find one free, 0 disables
+if _write_concurrency in os.environ:
+    write_concurrency = int(os.environ[_write_concurrency])
+else:
+    write_concurrency = 10
+
+# addresses or networks of the proxies in front of the workers, anonymous writers are
+# limited by the address these proxies put in X-Forwarded-For, * trusts every peer
+if _trusted_proxies in os.environ:
+    trusted_proxies = tuple(
+        proxy.strip() for proxy in os.environ[_trusted_proxies].split(',') if proxy.strip())
+else:
+    trusted_proxies = ()
@@ -1,22 +1,92 @@
-from sqlite3 import connect
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from .config import db_host, db_name, db_user, db_pass
+from sqlite3 import Connection as SQLiteConnection
+from sqlalchemy import create_engine, event
+from sqlalchemy.dialects.sqlite.aiosqlite import AsyncAdapt_aiosqlite_connection
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base, sessionmaker
+from .config import db_host, db_name, db_user, db_pass, db_replica_hosts, db_shards
+
+
+@event.listens_for(Engine, "connect")
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # sqlite leaves foreign keys off unless every connection asks, link_clicks follows
+    # short_code_to_url through them
+    if isinstance(dbapi_connection, (SQLiteConnection, AsyncAdapt_aiosqlite_connection)):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
+def database_urls(shard: str) -> tuple:
+    """
+    the sync and async database urls of a shard's target, a postgres host or a sqlite file
+    """
+    if db_host is not None:
+        return (f"postgresql://{db_user}:{db_pass}@{shard}/{db_name}",
+                f"postgresql+asyncpg://{db_user}:{db_pass}@{shard}/{db_name}")
+
+    return f"sqlite:///{shard}", f"sqlite+aiosqlite:///{shard}"
+
+
+def named_shards(entries: list) -> list:
+    """
+    the (name, target) of every shard after the first from DB_SHARDS entries, name=target
+        or a bare target named after its position, shard1 for the first. Short codes are
+        placed by name, so a shard keeps its short codes when its target changes.
+    """
+    shards = []
+
+    for position, entry in enumerate(entries, 1):
+        name, named, target = entry.partition('=')
+        shards.append((name.strip(), target.strip()) if named else (f"shard{position}", entry))
+
+    return shards
 
 
 if db_host is not None:
-    SQLALCHEMY_DATABASE_URL = f"postgresql://{db_user}:{db_pass}@{db_host}/{db_name}"
     connect_args = {}
 
 else:
-    SQLALCHEMY_DATABASE_URL = "sqlite:///sqlite.db"
     connect_args = {"check_same_thread": False}
 
+# shards by name, the first is the primary database and holds the short code allocation
+# counter, routing.ShardRouter places short codes on them by their names, never by their
+# hosts or files, which can change on a failover
+shards = [("shard0", db_host or "sqlite.db")] + named_shards(db_shards)
+shard_names = [name for name, _ in shards]
+SQLALCHEMY_DATABASE_URL, ASYNC_SQLALCHEMY_DATABASE_URL = database_urls(shards[0][1])
+
+# sync engine, used for schema creation and scripts
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args=connect_args
 )
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# async engine, used by the api so database round trips never block the event loop
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL, connect_args=connect_args
+)
+
+# async engines for the read replicas, reads are spread over them by routing.ReadWriteRouter
+replica_engines = [
+    create_async_engine(
+        f"postgresql+asyncpg://{db_user}:{db_pass}@{host}/{db_name}", connect_args=connect_args)
+    for host in db_replica_hosts]
+
+# sync and async engines of every shard, the first ones are engine and async_engine
+shard_engines = [engine] + [
+    create_engine(database_urls(target)[0], connect_args=connect_args)
+    for _, target in shards[1:]]
+async_shard_engines = [async_engine] + [
+    create_async_engine(database_urls(target)[1], connect_args=connect_args)
+    for _, target in shards[1:]]
+
+# records are serialized after commit, so don't expire them
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
+
+# the compact schema is on metadata of its own, only the compact command creates it
+CompactBase = declarative_base()
@@ -0,0 +1,169 @@
+"""
+fastpath.py: raw ASGI redirect handling in front of the FastAPI app
+"""
+
+import orjson
+from time import perf_counter
+from urllib.parse import quote
+from sqlalchemy import select, bindparam
+from sqlalchemy.ext.asyncio import AsyncEngine
+from .models import ShortURLModel
+from .cache import LRUCache
+from .analytics import ClickAggregator
+from .bloom import BloomFilter
+from .routing import ShardRouter
+from .snapshot import Snapshot, DELETED
+from .metrics import observe_request, requests_in_flight
+
+
+def redirect_policy(cache_max_age: int) -> tuple:
+    """
+    the status and Cache-Control header of a redirect, a permanent redirect is kept by
+    browsers and caches for cache_max_age seconds, so repeat clicks on it are not counted,
+    a temporary one is never stored
+    """
+    if cache_max_age is None:
+        return 307, "no-store"
+
+    return 308, f"public, max-age={cache_max_age}"
+
+
+class RedirectFastPath:
+    """
+    RedirectFastPath: ASGI app that answers GET /{short_code} itself and hands every other
+        request to the wrapped app. Redirects skip middleware, dependency injection, the
+        ORM session and model hydration: the url column is read with a single prepared
+        statement on a pooled connection and the response is written as raw ASGI messages.
+    Paths of the wrapped app's own routes without path parameters, like /all_short_codes
+        or /docs, are never treated as short codes. Redirects carry the cache policy of
+        their link, see redirect_policy(). Redirects are counted with clicks, an
+        analytics.ClickAggregator, when one is given. Codes a bloom.BloomFilter, when given,
+        rules out are answered as not found without a database round trip. With a
+        routing.ShardRouter or routing.ReadWriteRouter, lookups go to a read replica of
+        the short code's shard and misses are retried on its primary, otherwise they go
+        to engine. A snapshot.Snapshot, when given, is
+        asked after the cache and before the filter and the database.
+    """
+
+    statement = select(ShortURLModel.url, ShortURLModel.cache_max_age).where(
+        ShortURLModel.short_code == bindparam('short_code'))
+
+    def __init__(
+            self,
+            app,
+            engine: AsyncEngine,
+            cache: LRUCache,
+            clicks: ClickAggregator = None,
+            bloom: BloomFilter = None,
+            router: ShardRouter = None,
+            snapshot: Snapshot = None):
+        self.app = app
+        self.engine = engine
+        self.cache = cache
+        self.clicks = clicks
+        self.bloom = bloom
+        self.router = router
+        self.snapshot = snapshot
+        self._reserved = None
+
+    def reserved(self) -> set:
+        # routes are registered after this is created, so collect them on first use
+        if self._reserved is None:
+            self._reserved = {
+                route.path for route in getattr(self.app, 'routes', [])
+                if '{' not in route.path}
+
+        return self._reserved
+
+    async def select(self, engine: AsyncEngine, short_code: str) -> tuple:
+        async with engine.connect() as connection:
+            row = (await connection.execute(
+                self.statement, {'short_code': short_code})).first()
+
+        return None if row is None else tuple(row)
+
+    async def lookup(self, short_code: str) -> tuple:
+        # (url, cache_max_age) of the short code, or None
+        redirect = self.cache.get(short_code)
+
+        if redirect is None and self.snapshot is not None:
+            redirect = self.snapshot.get(short_code)
+
+            if redirect == DELETED:
+                return None
+
+        if redirect is None:
+            if self.bloom is not None and not self.bloom.might_contain(short_code):
+                return None
+
+            if self.router is None:
+                redirect = await self.select(self.engine, short_code)
+
+            else:
+                shard = self.router.shard(short_code)
+                engine = shard.read_engine(short_code)
+                redirect = await self.select(engine, short_code)
+
+                if redirect is None and shard.is_replica(engine):
+                    redirect = await self.select(shard.primary_engine, short_code)
+
+                for other in self.router.fallbacks(short_code):
+                    if redirect is not None:
+                        break
+
+                    redirect = await self.select(other.primary_engine, short_code)
+
+            if redirect is not None:
+                self.cache.set(short_code, redirect)
+
+        return redirect
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get('path', '')
+
+        if (scope['type'] != 'http' or scope['method'] != 'GET'
+                or path.count('/') != 1 or path == '/'
+                or path in self.reserved()):
+            return await self.app(scope, receive, send)
+
+        start = perf_counter()
+        requests_in_flight.inc()
+
+        try:
+            status = await self.redirect(path[1:], send)
+
+        finally:
+            requests_in_flight.dec()
+
+        observe_request('redirect_fast_path', 'GET', status, perf_counter() - start)
+
+    async def redirect(self, short_code: str, send) -> int:
+        redirect = await self.lookup(short_code)
+
+        if redirect is None:
+            body = orjson.dumps({"message": f"{short_code} not found"})
+            await send({
+                'type': 'http.response.start',
+                'status': 404,
+                'headers': [
+                    (b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode('latin-1'))]})
+            await send({'type': 'http.response.body', 'body': body})
+            return 404
+
+        if self.clicks is not None:
+            self.clicks.record(short_code)
+
+        url, cache_max_age = redirect
+        status, cache_control = redirect_policy(cache_max_age)
+        # same quoting as starlette.responses.RedirectResponse
+        location = quote(url, safe=":/%#?=@[]!$&'()*+,;").encode('latin-1')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'location', location),
+                (b'cache-control', cache_control.encode('latin-1')),
+                (b'content-length', b'0')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return status
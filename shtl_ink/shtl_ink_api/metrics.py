@@ -0,0 +1,263 @@
+"""
+metrics.py: in process metrics rendered in the Prometheus text format
+"""
+
+from bisect import bisect_left
+from time import perf_counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labelnames: tuple, labelvalues: tuple, extra: str = '') -> str:
+    labels = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+
+    if extra:
+        labels.append(extra)
+
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Metric:
+    """
+    Metric: a named family of samples keyed by label values. Updates are plain dict
+        operations, the api runs on one event loop per worker so no locking is needed.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {}
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+        for labelvalues, value in self.values.items():
+            lines.append(
+                f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}")
+
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def set(self, value: float, *labelvalues) -> None:
+        # for counters kept elsewhere and copied in at scrape time
+        self.values[labelvalues] = value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labelvalues, amount: float = 1) -> None:
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount: float = 1) -> None:
+        self.values[labelvalues] = self.values.get(labelvalues, 0) - amount
+
+    def set(self, value: float, *labelvalues) -> None:
+        self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labelnames: tuple = (),
+            buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labelvalues) -> None:
+        series = self.values.get(labelvalues)
+
+        if series is None:
+            # one count per bucket plus +Inf, then the sum
+            series = self.values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+        for labelvalues, series in self.values.items():
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                labels = format_labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+
+class Registry:
+    """
+    Registry: holds metrics and renders them for a scrape.
+    Registry.add_collector() registers a function called before every render, for values
+        that are cheaper to read at scrape time than to track on every change
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector) -> None:
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+
+        lines = []
+
+        for metric in self.metrics:
+            lines += metric.render()
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+request_duration = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time to answer a request, by route handler.',
+    ('handler', 'method', 'status')))
+requests_in_flight = registry.register(Gauge(
+    'http_requests_in_flight', 'Requests being answered right now.'))
+query_duration = registry.register(Histogram(
+    'db_query_duration_seconds', 'Time spent executing database statements.',
+    ('engine', 'statement')))
+pool_checkouts = registry.register(Counter(
+    'db_pool_checkouts_total', 'Connections checked out of the pool.', ('engine',)))
+pool_size = registry.register(Gauge(
+    'db_pool_size', 'Configured pool size.', ('engine',)))
+pool_checked_out = registry.register(Gauge(
+    'db_pool_checked_out', 'Connections currently checked out.', ('engine',)))
+pool_overflow = registry.register(Gauge(
+    'db_pool_overflow', 'Connections open beyond the pool size.', ('engine',)))
+short_code_collisions = registry.register(Counter(
+    'short_code_collisions_total',
+    'Allocated short codes that were already taken by a custom short code.'))
+short_code_retries = registry.register(Counter(
+    'short_code_retries_total', 'Inserts retried after a short code collision.'))
+creates_coalesced = registry.register(Counter(
+    'creates_coalesced_total',
+    'Creates of a url that shared the result of the same create already running.'))
+redirect_cache_hits = registry.register(Counter(
+    'redirect_cache_hits_total', 'Redirects answered from the cache.'))
+redirect_cache_misses = registry.register(Counter(
+    'redirect_cache_misses_total', 'Redirects that were not in the cache.'))
+redirect_cache_entries = registry.register(Gauge(
+    'redirect_cache_entries', 'Short codes in the redirect cache.'))
+clicks_buffered = registry.register(Gauge(
+    'clicks_buffered', 'Short codes with clicks waiting to be flushed.'))
+writes_in_flight = registry.register(Gauge(
+    'writes_in_flight', 'Writes admitted and still running.'))
+writes_rejected = registry.register(Counter(
+    'writes_rejected_total', 'Writes turned away by admission control.', ('reason',)))
+
+
+def handler_name(scope) -> str:
+    endpoint = scope.get('endpoint')
+
+    if endpoint is None:
+        return 'unmatched'
+
+    return getattr(endpoint, '__name__', type(endpoint).__name__)
+
+
+def observe_request(handler: str, method: str, status: int, seconds: float) -> None:
+    request_duration.observe(seconds, handler, method, str(status))
+
+
+class MetricsMiddleware:
+    """
+    MetricsMiddleware: ASGI middleware timing every http request into request_duration,
+        labeled with the handler the router matched, and counting requests_in_flight.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+            await send(message)
+
+        requests_in_flight.inc()
+
+        try:
+            await self.app(scope, receive, send_with_status)
+
+        finally:
+            requests_in_flight.dec()
+            observe_request(
+                handler_name(scope), scope['method'], status, perf_counter() - start)
+
+
+def instrument_engine(engine: Engine, name: str) -> None:
+    """
+    instrument_engine: times every statement run on a sync engine, or on the sync_engine
+        of an async engine, and reports its pool on every scrape
+    """
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault('query_start', []).append(perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        start = connection.info['query_start'].pop()
+        query_duration.observe(
+            perf_counter() - start, name, statement.lstrip().split(' ', 1)[0].upper())
+
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(context):
+        starts = context.connection.info.get('query_start') if context.connection else None
+
+        if starts:
+            starts.pop()
+
+    @event.listens_for(engine.pool, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_checkouts.inc(name)
+
+    def collect_pool():
+        pool = engine.pool
+
+        # only queue pools keep these numbers
+        if hasattr(pool, 'checkedout'):
+            pool_size.set(pool.size(), name)
+            pool_checked_out.set(pool.checkedout(), name)
+            pool_overflow.set(max(0, pool.overflow()), name)
+
+    registry.add_collector(collect_pool)
@@ -0,0 +1,145 @@
+"""
+migrations.py: in place upgrades for databases created by older versions
+"""
+
+from sqlalchemy import inspect, select, update, delete, bindparam, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import AddConstraint
+from .models import ShortURLModel, ClickStatsModel, Base, url_hash
+
+
+def add_url_hash(engine: Engine, batch_size: int = 1000) -> int:
+    """
+    add_url_hash: adds the url_hash column to short_code_to_url if it is missing,
+        backfills it for existing rows in batches and creates the (owner_id, url_hash)
+        index, returns the number of rows backfilled
+    """
+    table = ShortURLModel.__table__
+    columns = [column['name'] for column in inspect(engine).get_columns(table.name)]
+
+    if 'url_hash' not in columns:
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER TABLE {table.name} ADD COLUMN url_hash VARCHAR(32)"))
+
+    backfilled = 0
+    after = ''
+    fill = update(table).where(
+        table.c.short_code == bindparam('b_short_code')).values(
+        url_hash=bindparam('b_url_hash'))
+
+    while True:
+        # keyset walk of the primary key, each batch starts where the last one stopped
+        # instead of scanning the rows already backfilled again
+        with engine.begin() as connection:
+            rows = connection.execute(
+                select(table.c.short_code, table.c.url).where(
+                    table.c.short_code > after,
+                    table.c.url_hash.is_(None),
+                    table.c.url.isnot(None)).order_by(
+                    table.c.short_code).limit(batch_size)).all()
+
+            if not rows:
+                break
+
+            connection.execute(fill, [
+                {'b_short_code': short_code, 'b_url_hash': url_hash(url)}
+                for short_code, url in rows])
+            backfilled += len(rows)
+            after = rows[-1].short_code
+
+    create_index(engine, 'ix_short_code_to_url_owner_id_url_hash')
+    return backfilled
+
+
+def add_cache_max_age(engine: Engine) -> None:
+    """
+    add_cache_max_age: adds the cache_max_age column to short_code_to_url if it is missing,
+        existing rows stay temporary redirects
+    """
+    table = ShortURLModel.__table__
+    columns = [column['name'] for column in inspect(engine).get_columns(table.name)]
+
+    if 'cache_max_age' not in columns:
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER TABLE {table.name} ADD COLUMN cache_max_age INTEGER"))
+
+
+def add_canonical(engine: Engine) -> None:
+    """
+    add_canonical: adds the canonical column to short_code_to_url if it is missing and
+        creates its unique index, existing rows are left out of the index
+    """
+    table = ShortURLModel.__table__
+    columns = [column['name'] for column in inspect(engine).get_columns(table.name)]
+
+    if 'canonical' not in columns:
+        with engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER TABLE {table.name} ADD COLUMN canonical BOOLEAN"))
+
+    create_index(engine, 'ix_short_code_to_url_canonical_owner_id_url_hash')
+
+
+def add_clicks_foreign_key(engine: Engine) -> int:
+    """
+    add_clicks_foreign_key: makes link_clicks.short_code a foreign key of short_code_to_url
+        that follows renames and deletes if it is not one yet, counts of short codes no
+        longer in short_code_to_url are dropped, returns how many. sqlite can not add a
+        constraint to a table, so there link_clicks is copied into a new one.
+    """
+    clicks, links = ClickStatsModel.__table__, ShortURLModel.__table__
+
+    inspector = inspect(engine)
+
+    if clicks.name not in inspector.get_table_names() or inspector.get_foreign_keys(clicks.name):
+        return 0
+
+    orphans = delete(clicks).where(clicks.c.short_code.not_in(select(links.c.short_code)))
+
+    with engine.begin() as connection:
+        dropped = connection.execute(orphans).rowcount
+
+        if engine.dialect.name == 'postgresql':
+            connection.execute(AddConstraint(next(iter(clicks.foreign_key_constraints))))
+
+        else:
+            connection.execute(text(f"ALTER TABLE {clicks.name} RENAME TO {clicks.name}_old"))
+            clicks.create(bind=connection)
+            connection.execute(text(
+                f"INSERT INTO {clicks.name} SELECT short_code, clicks, last_access "
+                f"FROM {clicks.name}_old"))
+            connection.execute(text(f"DROP TABLE {clicks.name}_old"))
+
+    return dropped
+
+
+def create_index(engine: Engine, name: str) -> None:
+    """
+    create_index: creates one of the short_code_to_url indexes if it is missing
+    """
+    for index in ShortURLModel.__table__.indexes:
+        if index.name == name:
+            index.create(bind=engine, checkfirst=True)
+
+
+def upgrade(engine: Engine) -> None:
+    """
+    upgrade: runs every migration, each one is a no-op on an up to date database
+    """
+    add_url_hash(engine)
+    add_cache_max_age(engine)
+    create_index(engine, 'ix_short_code_to_url_owner_id_short_code')
+    create_index(engine, 'ix_short_code_to_url_owner_id_short_code_c')
+    add_canonical(engine)
+    add_clicks_foreign_key(engine)
+
+
+def migrate(engine: Engine) -> None:
+    """
+    migrate: creates missing tables and upgrades existing ones, run by the migrate command
+        before workers start, or by each worker when migrate_on_startup is set
+    """
+    Base.metadata.create_all(bind=engine)
+    upgrade(engine)
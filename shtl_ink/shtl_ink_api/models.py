@@ -3,23 +3,205 @@ models.py: models for url shortener
 """
 
 from email.policy import default
-from sqlalchemy import Column, String
+from hashlib import blake2b
+from operator import attrgetter
+from sqlalchemy import (
+    Column, String, BigInteger, Integer, Boolean, DateTime, Index, ForeignKey, LargeBinary)
+from sqlalchemy.orm import validates
 from sqlalchemy_serializer import SerializerMixin
-from .database import Base
+from .database import Base, CompactBase
+
+
+def url_hash(url: str) -> str:
+    """
+    url_hash: fixed width digest of a url, indexed so dedup lookups never scan url text
+    """
+    return blake2b(url.encode('utf-8'), digest_size=16).hexdigest()
 
 
 class ShortURLModel(Base, SerializerMixin):
     """
-    ShortURLModel: Schema for database table with three columns, id(the primary key),
-        url(the original url), and short_code, the shortened code keying the url
-        in the databse.
+    ShortURLModel: Schema for database table with six columns, owner_id, url(the original
+        url), url_hash(a fixed width digest of url), cache_max_age(seconds browsers and
+        caches may keep a permanent redirect, null for a temporary one), canonical(true on
+        the one record /create_short_code answers with for its owner and url, unique per
+        owner and url_hash) and short_code(the primary key), the shortened code keying the
+        url in the databse.
     """
     __tablename__ = 'short_code_to_url'
+    __table_args__ = (
+        Index('ix_short_code_to_url_owner_id_url_hash', 'owner_id', 'url_hash'),
+        Index('ix_short_code_to_url_owner_id_short_code', 'owner_id', 'short_code'),
+    )
+    serialize_rules = ('-url_hash', '-canonical')
+    # columns in api responses, read by one precompiled getter so to_json() skips the
+    # per call model reflection of SerializerMixin.to_dict()
+    json_columns = ('short_code', 'owner_id', 'url', 'cache_max_age')
+    _json_values = attrgetter(*json_columns)
     # 2000 characters is defacto max url length
     owner_id = Column(String(2000), unique=False, default="anonymous")
     url = Column(String(2000), unique=False)
+    url_hash = Column(String(32), unique=False)
     short_code = Column(String(2000), primary_key=True)
+    cache_max_age = Column(Integer, nullable=True)
+    # null on records from other routes and from before the column, so owners keep their
+    # custom short codes and batch creates for a url they already shortened
+    canonical = Column(Boolean, nullable=True)
+
+    @validates('url')
+    def validate_url(self, key, url):
+        self.url_hash = url_hash(url)
+        return url
+
+    def to_json(self) -> dict:
+        return dict(zip(self.json_columns, self._json_values(self)))
 
     def __repr__(self):
         return f"URL(url={self.url!r}, \
                  short_code={self.short_code!r})"
+
+
+# a second create of the same url by the same owner, on any worker, meets this index in
+# its INSERT ... ON CONFLICT
+Index('ix_short_code_to_url_canonical_owner_id_url_hash',
+      ShortURLModel.owner_id, ShortURLModel.url_hash, unique=True,
+      sqlite_where=ShortURLModel.canonical.is_(True),
+      postgresql_where=ShortURLModel.canonical.is_(True))
+
+# /all_short_codes pages on postgres sort and compare short codes by code point, see
+# app.code_point_order(), ix_short_code_to_url_owner_id_short_code is in locale order there
+Index('ix_short_code_to_url_owner_id_short_code_c',
+      ShortURLModel.owner_id, ShortURLModel.short_code.collate('C')).ddl_if(
+    dialect='postgresql')
+
+
+class ShortCodeBlockModel(Base):
+    """
+    ShortCodeBlockModel: Schema for the table holding the next unreserved id of each
+        short code allocator, workers reserve ids from it in blocks.
+    """
+    __tablename__ = 'short_code_blocks'
+    name = Column(String(50), primary_key=True)
+    next_id = Column(BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"ShortCodeBlock(name={self.name!r}, next_id={self.next_id!r})"
+
+
+class ClickStatsModel(Base, SerializerMixin):
+    """
+    ClickStatsModel: Schema for the table of per short code click counts and the time of
+        the last click, written in batches by analytics.ClickAggregator. Counts follow
+        their short code when it is renamed and go with it when it is deleted, by the
+        database itself.
+    """
+    __tablename__ = 'link_clicks'
+    short_code = Column(
+        String(2000),
+        ForeignKey('short_code_to_url.short_code', name='fk_link_clicks_short_code',
+                   ondelete='CASCADE', onupdate='CASCADE'),
+        primary_key=True)
+    clicks = Column(BigInteger, nullable=False, default=0)
+    last_access = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"ClickStats(short_code={self.short_code!r}, clicks={self.clicks!r})"
+
+
+class ShortCodeChangeModel(Base):
+    """
+    ShortCodeChangeModel: Schema for the append only log of short code changes, one row per
+        short code created or deleted, written in the same transaction as the change and
+        followed by every worker through changes.ChangeFeed.
+    """
+    __tablename__ = 'short_code_changes'
+    # sequence numbers must never be reused, even once every row was compacted away
+    __table_args__ = {'sqlite_autoincrement': True}
+    # sqlite only autoincrements integer primary keys
+    seq = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True,
+                 autoincrement=True)
+    op = Column(String(10), nullable=False)
+    short_code = Column(String(2000), nullable=False)
+
+    def __repr__(self):
+        return f"ShortCodeChange(seq={self.seq!r}, op={self.op!r}, short_code={self.short_code!r})"
+
+
+class OwnerModel(CompactBase):
+    """
+    OwnerModel: Schema for the owner ids of the compact schema, each owner id is stored
+        once and the compact link tables refer to it by its integer surrogate key.
+    """
+    __tablename__ = 'owners'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    owner_id = Column(String(2000), nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"Owner(id={self.id!r}, owner_id={self.owner_id!r})"
+
+
+class UrlBodyModel(CompactBase):
+    """
+    UrlBodyModel: Schema for the urls of the compact schema, content addressed by the
+        binary digest of the url (see url_hash()), so a url shortened by many owners is
+        stored once and the compact link tables refer to it by its integer surrogate key.
+    """
+    __tablename__ = 'url_bodies'
+    # sqlite only makes integer primary keys the rowid, without an index of their own
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True,
+                autoincrement=True)
+    url_hash = Column(LargeBinary(16), nullable=False, unique=True)
+    url = Column(String(2000), nullable=False)
+
+    def __repr__(self):
+        return f"UrlBody(id={self.id!r}, url={self.url!r})"
+
+
+class CompactLinkModel(CompactBase):
+    """
+    CompactLinkModel: Schema for the allocated short codes of the compact schema, keyed by
+        the fixed width integer of their short code, see compact.ShortCodeKeys, with
+        integer keys of their owner and url and the cache_max_age and canonical columns of
+        short_code_to_url.
+    """
+    __tablename__ = 'compact_short_codes'
+    __table_args__ = (
+        Index('ix_compact_short_codes_owner_key_url_id', 'owner_key', 'url_id'),
+        Index('ix_compact_short_codes_owner_key_short_code_key', 'owner_key', 'short_code_key'),
+    )
+    short_code_key = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True,
+                            autoincrement=False)
+    owner_key = Column(Integer, ForeignKey('owners.id'), nullable=True)
+    url_id = Column(BigInteger, ForeignKey('url_bodies.id'), nullable=True)
+    cache_max_age = Column(Integer, nullable=True)
+    canonical = Column(Boolean, nullable=True)
+
+    def __repr__(self):
+        return f"CompactLink(short_code_key={self.short_code_key!r}, url_id={self.url_id!r})"
+
+
+# canonical records always have allocated short codes, so the one per owner and url is
+# enforced on this table alone
+Index('ix_compact_short_codes_canonical_owner_key_url_id',
+      CompactLinkModel.owner_key, CompactLinkModel.url_id, unique=True,
+      sqlite_where=CompactLinkModel.canonical.is_(True),
+      postgresql_where=CompactLinkModel.canonical.is_(True))
+
+
+class CustomLinkModel(CompactBase):
+    """
+    CustomLinkModel: Schema for the custom short codes of the compact schema, the ones
+        that have no fixed width key, with integer keys of their owner and url.
+    """
+    __tablename__ = 'compact_custom_short_codes'
+    __table_args__ = (
+        Index('ix_compact_custom_short_codes_owner_key_url_id', 'owner_key', 'url_id'),
+        Index('ix_compact_custom_short_codes_owner_key_short_code', 'owner_key', 'short_code'),
+    )
+    short_code = Column(String(2000), primary_key=True)
+    owner_key = Column(Integer, ForeignKey('owners.id'), nullable=True)
+    url_id = Column(BigInteger, ForeignKey('url_bodies.id'), nullable=True)
+    cache_max_age = Column(Integer, nullable=True)
+
+    def __repr__(self):
+        return f"CustomLink(short_code={self.short_code!r}, url_id={self.url_id!r})"
@@ -0,0 +1,105 @@
+"""
+rebalance.py: moves short codes to the shard the hash ring places them on, run after
+shards are added or removed
+"""
+
+from sqlalchemy import select, delete
+from sqlalchemy.engine import Engine
+from .models import ShortURLModel, ClickStatsModel, ShortCodeChangeModel
+from .changes import CREATE, DELETE, change_rows
+from .analytics import clicks_upsert
+from .bulk import Progress, copy_rows, taken_short_codes
+from .routing import HashRing
+
+
+def move_short_codes(source: Engine, target: Engine, short_codes: list) -> tuple:
+    """
+    move_short_codes: copies the records and clicks of short_codes from the source shard to
+        the target shard, then deletes them from the source, both sides are logged in
+        short_code_changes so workers drop what they cached. Short codes the target
+        already has, created there since the shard was added, are left on the source.
+        Returns the number moved and the number left.
+    """
+    links, clicks = ShortURLModel.__table__, ClickStatsModel.__table__
+
+    with source.connect() as connection:
+        records = connection.execute(
+            select(links).where(links.c.short_code.in_(short_codes))).mappings().all()
+        click_rows = connection.execute(
+            select(clicks).where(clicks.c.short_code.in_(short_codes))).mappings().all()
+
+    # the record first, then the delete, a failure in between leaves a copy on both
+    # shards and the next run finishes the move
+    with target.begin() as connection:
+        taken = taken_short_codes(connection, short_codes)
+        records = [dict(record) for record in records if record['short_code'] not in taken]
+        moved = [record['short_code'] for record in records]
+        copy_rows(connection, links, records)
+        click_rows = [dict(row) for row in click_rows if row['short_code'] in set(moved)]
+
+        # workers flush clicks to the new shard as soon as they know it, add them up
+        if click_rows:
+            connection.execute(clicks_upsert(target), click_rows)
+
+        copy_rows(connection, ShortCodeChangeModel.__table__, change_rows(CREATE, moved))
+
+    with source.begin() as connection:
+        if moved:
+            # their clicks go with them, by the foreign key of link_clicks
+            connection.execute(delete(links).where(links.c.short_code.in_(moved)))
+            copy_rows(connection, ShortCodeChangeModel.__table__, change_rows(DELETE, moved))
+
+    return len(moved), len(short_codes) - len(moved)
+
+
+def rebalance(
+        engines: list,
+        names: list,
+        batch_size: int = 10000,
+        progress: Progress = None) -> tuple:
+    """
+    rebalance: walks the short codes of every shard, sync engines named by names like the
+        shards of routing.ShardRouter, batch_size at a time, and moves the ones placed on
+        another shard there, see move_short_codes(). Consistent hashing only places about 1/N of
+        the short codes on a shard that was added, so only those are copied. Safe to run
+        again, short codes already in place are skipped. Returns the number moved and the
+        number left because their shard already has them.
+    """
+    ring = HashRing(names)
+    links = ShortURLModel.__table__
+    moved = left = 0
+
+    for source, engine in enumerate(engines):
+        after = ''
+
+        while True:
+            # keyset walk, deleting moved rows behind the cursor does not disturb it
+            with engine.connect() as connection:
+                short_codes = connection.execute(
+                    select(links.c.short_code).where(links.c.short_code > after).order_by(
+                        links.c.short_code).limit(batch_size)).scalars().all()
+
+            if not short_codes:
+                break
+
+            after = short_codes[-1]
+            targets = {}
+
+            for short_code in short_codes:
+                target = ring.node(short_code)
+
+                if target != source:
+                    targets.setdefault(target, []).append(short_code)
+
+            for target, misplaced in targets.items():
+                done, kept = move_short_codes(engine, engines[target], misplaced)
+                moved += done
+                left += kept
+
+            if progress is not None:
+                progress.update(len(short_codes))
+
+    if progress is not None:
+        progress.done()
+
+    return moved, left
@@ -0,0 +1,168 @@
+"""
+routing.py: placement of short codes on shards, and read/write splitting between each
+shard's primary database and its read replicas
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+from hashlib import blake2b
+from itertools import cycle
+from time import monotonic
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+
+class ReadWriteRouter:
+    """
+    ReadWriteRouter: hands out sessions on the primary for mutations and on the replicas,
+        in turn, for reads. Without replicas every session is on the primary.
+    ReadWriteRouter.primary() returns a session on the primary
+    ReadWriteRouter.written() records that the given keys, short codes or owner ids, were
+        just changed on the primary
+    ReadWriteRouter.read_session() returns a session on the next replica, or on the primary
+        when any of the given keys was written less than window seconds ago, so a client
+        reads its own writes while the replicas catch up
+    ReadWriteRouter.read_engine() does the same for an engine, for reads without a session
+    Writes are only tracked per worker, so a read that misses on a replica should be
+        retried on the primary, see ReadWriteRouter.is_replica()
+    A ReadWriteRouter is also a ShardRouter of a single shard, itself, so code that takes
+        a ShardRouter works on an unsharded database as it is
+    """
+
+    def __init__(self, primary: AsyncEngine, replicas: list = (), window: float = 5.0):
+        self.primary_engine = primary
+        self.replica_engines = list(replicas)
+        self.window = window
+        # records are serialized after commit, so don't expire them
+        self._primary = async_sessionmaker(
+            bind=primary, autoflush=False, expire_on_commit=False)
+        self._replicas = [
+            async_sessionmaker(bind=replica, autoflush=False, expire_on_commit=False)
+            for replica in self.replica_engines]
+        self._turns = cycle(range(len(self.replica_engines)))
+        # key -> time of its last write, oldest first
+        self._written = OrderedDict()
+
+    @property
+    def replicated(self) -> bool:
+        return len(self.replica_engines) > 0
+
+    def primary(self) -> AsyncSession:
+        return self._primary()
+
+    def written(self, *keys: str) -> None:
+        now = monotonic()
+
+        for key in keys:
+            self._written.pop(key, None)
+            self._written[key] = now
+
+        # forget writes the replicas have had time to catch up with
+        while self._written and now - next(iter(self._written.values())) >= self.window:
+            self._written.popitem(last=False)
+
+    def recently_written(self, *keys: str) -> bool:
+        now = monotonic()
+
+        for key in keys:
+            written = self._written.get(key)
+
+            if written is not None and now - written < self.window:
+                return True
+
+        return False
+
+    def read_session(self, *keys: str) -> AsyncSession:
+        if not self.replicated or self.recently_written(*keys):
+            return self._primary()
+
+        return self._replicas[next(self._turns)]()
+
+    def read_engine(self, *keys: str) -> AsyncEngine:
+        if not self.replicated or self.recently_written(*keys):
+            return self.primary_engine
+
+        return self.replica_engines[next(self._turns)]
+
+    def is_replica(self, bind) -> bool:
+        return bind is not self.primary_engine
+
+    @property
+    def shards(self) -> list:
+        return [self]
+
+    def shard(self, short_code: str) -> 'ReadWriteRouter':
+        return self
+
+    def fallbacks(self, short_code: str) -> list:
+        return []
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    HashRing: consistent hashing of keys onto named nodes. Every node is put on a ring of
+        64 bit hashes at vnodes points hashed from its name, and a key belongs to the node
+        of the first point at or after the key's own hash. Adding a node only takes over
+        the keys landing just before its points, about 1/N of them, and every other key
+        stays where it was, the same goes for removing one. Placement depends on the
+        names only, not on their order.
+    HashRing.node() returns the index in names of the node a key belongs to
+    """
+
+    def __init__(self, names: list, vnodes: int = 128):
+        if not names or len(set(names)) != len(names):
+            raise ValueError("a hash ring needs one or more distinct node names")
+
+        points = sorted(
+            (ring_hash(f"{name}#{point}"), node)
+            for node, name in enumerate(names) for point in range(vnodes))
+        self.names = list(names)
+        self.points = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key: str) -> int:
+        # past the last point wraps around to the first
+        return self.nodes[bisect_left(self.points, ring_hash(key)) % len(self.nodes)]
+
+
+class ShardRouter:
+    """
+    ShardRouter: spreads short codes over several databases, each behind its own
+        ReadWriteRouter, by consistent hashing of the short code over the shard names, see
+        HashRing. A short code's record, its clicks and its change log entries all live on
+        its shard, so every lookup or change of one short code goes to one database.
+        The first shard also holds the short code allocation counter. Reads by owner, like
+        /all_short_codes, ask every shard in parallel and merge the results.
+    ShardRouter.shard() returns the ReadWriteRouter of the shard a short code belongs to
+    ShardRouter.shards are the ReadWriteRouters of every shard, the first one first
+    ShardRouter.written() records written keys on every shard, owner ids are read back
+        from all of them
+    ShardRouter.fallbacks() returns the other shards when fallback is set, a short code
+        missing from its shard is looked up on them while python -m shtl_ink_api
+        rebalance moves short codes after shards are added
+    """
+
+    def __init__(self, shards: list, names: list, fallback: bool = False, vnodes: int = 128):
+        if len(shards) != len(names):
+            raise ValueError("every shard needs a name")
+
+        self.shards = list(shards)
+        self.ring = HashRing(names, vnodes)
+        self.fallback = fallback
+
+    def shard(self, short_code: str) -> ReadWriteRouter:
+        return self.shards[self.ring.node(short_code)]
+
+    def written(self, *keys: str) -> None:
+        for shard in self.shards:
+            shard.written(*keys)
+
+    def fallbacks(self, short_code: str) -> list:
+        if not self.fallback:
+            return []
+
+        shard = self.shard(short_code)
+        return [other for other in self.shards if other is not shard]
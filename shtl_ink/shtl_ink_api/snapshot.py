@@ -0,0 +1,470 @@
+"""
+snapshot.py: memory mapped short code -> (url, cache max age) snapshots that redirects
+are served from
+"""
+
+import mmap
+import os
+import struct
+import uuid
+from hashlib import blake2b
+from time import time
+from sqlalchemy import select, func
+from .models import ShortURLModel, ShortCodeChangeModel
+
+# version 2 added the cache max age to every record, version 3 the change log watermarks
+MAGIC = b'SHTLSNP3'
+# magic, snapshot id, id of the base snapshot a delta applies to, creation time,
+# bucket count, entry count, watermark count
+HEADER = struct.Struct('<8s16s16sdQQQ')
+# newest change log seq of a shard before the rows were read, one per shard after the
+# header
+WATERMARK = struct.Struct('<Q')
+# hash of the short code, file offset of its record, 0 marks an empty bucket
+SLOT = struct.Struct('<QQ')
+# short code length and url length in bytes and the cache max age, -1 for a temporary
+# redirect, followed by both strings
+RECORD = struct.Struct('<HIi')
+NO_BASE = bytes(16)
+# redirect of a short code deleted since the base snapshot, no real url is empty
+DELETED = ('', None)
+
+
+def key_hash(short_code: bytes) -> int:
+    return int.from_bytes(blake2b(short_code, digest_size=8).digest(), 'little')
+
+
+def write_snapshot(
+        path: str,
+        rows,
+        count: int,
+        base_id: bytes = NO_BASE,
+        created: float = None,
+        watermarks: list = ()) -> bytes:
+    """
+    write_snapshot: writes (short_code, url, cache_max_age) rows to path as an open
+        addressing hash table, a header, fixed size buckets and a heap of the records,
+        sized for count rows with the load factor at most one half. The file is written
+        next to path and renamed over it, so readers see the old snapshot or the new one,
+        never a partial file. created is when the rows were read, now by default, and
+        watermarks the newest change log seq of every shard before they were read.
+        Returns the id of the new snapshot.
+    """
+    bucket_count = 1 << max(4, (2 * count - 1).bit_length())
+    mask = bucket_count - 1
+    buckets = bytearray(bucket_count * SLOT.size)
+    offset = HEADER.size + len(watermarks) * WATERMARK.size + len(buckets)
+    snapshot_id = uuid.uuid4().bytes
+    created = time() if created is None else created
+    entries = 0
+    temporary = f"{path}.{os.getpid()}.tmp"
+
+    try:
+        with open(temporary, 'wb') as file:
+            file.seek(offset)
+
+            for short_code, url, cache_max_age in rows:
+                short_code = short_code.encode('utf-8')
+                url = url.encode('utf-8')
+                entries += 1
+
+                # rows added after count was taken still fit while buckets are free
+                if entries >= bucket_count:
+                    raise ValueError(f"more than {count} rows, the snapshot is full")
+
+                hashed = key_hash(short_code)
+                index = hashed & mask
+
+                while SLOT.unpack_from(buckets, index * SLOT.size)[1] != 0:
+                    index = (index + 1) & mask
+
+                SLOT.pack_into(buckets, index * SLOT.size, hashed, offset)
+                record = RECORD.pack(
+                    len(short_code), len(url),
+                    -1 if cache_max_age is None else cache_max_age) + short_code + url
+                file.write(record)
+                offset += len(record)
+
+            file.seek(0)
+            file.write(HEADER.pack(
+                MAGIC, snapshot_id, base_id, created, bucket_count, entries, len(watermarks)))
+            file.write(b''.join(WATERMARK.pack(watermark) for watermark in watermarks))
+            file.write(buckets)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temporary, path)
+
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+    return snapshot_id
+
+
+class SnapshotFile:
+    """
+    SnapshotFile: read only view of a file written by write_snapshot(). The file is
+        mapped, not read, so every worker on a host shares one copy in the page cache.
+    SnapshotFile.get() returns the (url, cache_max_age) redirect of a short code, DELETED
+        for a tombstone in a delta, or None when the file does not have the short code
+    SnapshotFile.items() yields every (short_code, url, cache_max_age) in the file
+    SnapshotFile.watermarks is the newest change log seq of every shard when it was written
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self.inode = os.fstat(file.fileno()).st_ino
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.id, self.base_id, self.created, self.bucket_count, self.entries, \
+            shard_count = HEADER.unpack_from(self.map, 0)
+
+        if magic != MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not a short code snapshot")
+
+        self.watermarks = [
+            WATERMARK.unpack_from(self.map, HEADER.size + shard * WATERMARK.size)[0]
+            for shard in range(shard_count)]
+        self.mask = self.bucket_count - 1
+        self.buckets = HEADER.size + shard_count * WATERMARK.size
+        self.heap = self.buckets + self.bucket_count * SLOT.size
+
+    def __len__(self):
+        return self.entries
+
+    def get(self, short_code: str) -> tuple:
+        short_code = short_code.encode('utf-8')
+        hashed = key_hash(short_code)
+        index = hashed & self.mask
+
+        while True:
+            slot_hash, offset = SLOT.unpack_from(self.map, self.buckets + index * SLOT.size)
+
+            if offset == 0:
+                return None
+
+            if slot_hash == hashed:
+                code_length, url_length, cache_max_age = RECORD.unpack_from(self.map, offset)
+                start = offset + RECORD.size
+
+                if self.map[start:start + code_length] == short_code:
+                    start += code_length
+                    return (self.map[start:start + url_length].decode('utf-8'),
+                            None if cache_max_age < 0 else cache_max_age)
+
+            index = (index + 1) & self.mask
+
+    def items(self):
+        offset = self.heap
+
+        while offset < len(self.map):
+            code_length, url_length, cache_max_age = RECORD.unpack_from(self.map, offset)
+            start = offset + RECORD.size
+            yield (self.map[start:start + code_length].decode('utf-8'),
+                   self.map[start + code_length:start + code_length + url_length].decode('utf-8'),
+                   None if cache_max_age < 0 else cache_max_age)
+            offset = start + code_length + url_length
+
+    def close(self) -> None:
+        self.map.close()
+
+
+def open_if_changed(path: str, current: SnapshotFile) -> SnapshotFile:
+    """
+    the file at path when it was swapped since current was opened, current otherwise, and
+    None when there is no file
+    """
+    try:
+        inode = os.stat(path).st_ino
+
+    except FileNotFoundError:
+        return None
+
+    if current is not None and current.inode == inode:
+        return current
+
+    return SnapshotFile(path)
+
+
+class Snapshot:
+    """
+    Snapshot: short code -> (url, cache_max_age) lookups from a base snapshot at path, a
+        delta at path.delta with the changes since the base was written, and an in memory
+        overlay of the changes this worker made since either was written.
+    Snapshot.refresh() picks up snapshot files swapped in since the last call and drops
+        overlay entries the newest file already covers, those whose change log seq is at
+        or below its watermark for their shard. Clocks of workers and the exporting host
+        can disagree, change log positions can not.
+    Snapshot.get() returns the (url, cache_max_age) redirect of a short code, DELETED for
+        a short code deleted since the snapshot, or None when the snapshot does not know
+        it and the database has to be asked
+    Snapshot.set() and Snapshot.delete() record a change this worker made in the overlay,
+        its seq is not known yet, it is kept until the change log feed replays it
+    Snapshot.invalidate() records the change log entry seq of shard, made by this or
+        another worker, the short code is looked up in the database until a newer
+        snapshot file covers it
+    Snapshot.watermarks is the newest change log seq of every shard when the newest loaded
+        file was written, a change log feed started there replays every later change
+    Snapshot.ignore() stops lookups in the files until newer ones are swapped in, for
+        when the changes since the watermarks can not be replayed, and drops the changes
+        of this worker the feed may never replay
+    Other workers learn of a change through the change log, or once it is in a delta or
+        a new base snapshot.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.delta_path = f"{path}.delta"
+        self.base = None
+        self.delta = None
+        self.overlay = {}
+        self.ignored = False
+
+    @property
+    def loaded(self) -> bool:
+        return self.base is not None
+
+    @property
+    def watermarks(self) -> list:
+        newest = self.delta if self.delta is not None else self.base
+        return None if newest is None else newest.watermarks
+
+    def ignore(self) -> None:
+        self.ignored = True
+        self.overlay = {
+            short_code: entry for short_code, entry in self.overlay.items()
+            if entry[1] is not None}
+
+    def refresh(self) -> None:
+        base = open_if_changed(self.path, self.base)
+        delta = open_if_changed(self.delta_path, self.delta)
+
+        # a delta left over from an older base would undo newer changes
+        if delta is not None and (base is None or delta.base_id != base.id):
+            if delta is not self.delta:
+                delta.close()
+            delta = None
+
+        # lookups never await, so no lookup is using the old files when they are closed
+        for old, new in ((self.base, base), (self.delta, delta)):
+            if old is not None and old is not new:
+                old.close()
+
+            if new is not None and old is not new:
+                self.ignored = False
+
+        self.base, self.delta = base, delta
+        watermarks = self.watermarks
+
+        # entries are (redirect, (shard, seq)), or (redirect, None) until the feed replays
+        # a change of this worker
+        if watermarks:
+            self.overlay = {
+                short_code: entry for short_code, entry in self.overlay.items()
+                if entry[1] is None or entry[1][0] >= len(watermarks)
+                or entry[1][1] > watermarks[entry[1][0]]}
+
+    def get(self, short_code: str) -> tuple:
+        entry = self.overlay.get(short_code)
+
+        if entry is not None:
+            return entry[0]
+
+        if self.ignored:
+            return None
+
+        if self.delta is not None:
+            redirect = self.delta.get(short_code)
+
+            if redirect is not None:
+                return redirect
+
+        if self.base is not None:
+            return self.base.get(short_code)
+
+        return None
+
+    def set(self, short_code: str, url: str, cache_max_age: int = None) -> None:
+        self.overlay[short_code] = ((url, cache_max_age), None)
+
+    def delete(self, short_code: str) -> None:
+        self.overlay[short_code] = (DELETED, None)
+
+    def invalidate(self, short_code: str, shard: int, seq: int) -> None:
+        self.overlay[short_code] = (None, (shard, seq))
+
+    def close(self) -> None:
+        for snapshot_file in (self.base, self.delta):
+            if snapshot_file is not None:
+                snapshot_file.close()
+
+        self.base = self.delta = None
+
+
+def change_log_watermarks(engines: list) -> list:
+    """
+    change_log_watermarks: the newest change log seq on every shard, 0 for an empty log
+    """
+    watermarks = []
+
+    for engine in engines:
+        with engine.connect() as connection:
+            watermarks.append(connection.execute(
+                select(func.max(ShortCodeChangeModel.seq))).scalar() or 0)
+
+    return watermarks
+
+
+def redirect_rows(engines: list, batch_size: int):
+    """
+    redirect_rows: yields the (short_code, url, cache_max_age) of every record of
+        short_code_to_url on every shard, batch_size rows at a time
+    """
+    for engine in engines:
+        with engine.connect() as connection:
+            yield from connection.execution_options(yield_per=batch_size).execute(
+                select(ShortURLModel.short_code, ShortURLModel.url, ShortURLModel.cache_max_age))
+
+
+def export_snapshot(engines: list, path: str, batch_size: int = 10000) -> int:
+    """
+    export_snapshot: writes every redirect of short_code_to_url on the shards of engines to
+        path, then removes the delta of the replaced snapshot, returns the number of rows
+        written
+    """
+    started = time()
+    # read before the rows, a change logged in between is in the rows and replayed too,
+    # which only invalidates it
+    watermarks = change_log_watermarks(engines)
+    count = 0
+
+    for engine in engines:
+        with engine.connect() as connection:
+            count += connection.execute(
+                select(func.count()).select_from(ShortURLModel)).scalar()
+
+    # a few rows of headroom for creates that land while the rows are read
+    write_snapshot(
+        path, redirect_rows(engines, batch_size), count + batch_size, created=started,
+        watermarks=watermarks)
+
+    if os.path.exists(f"{path}.delta"):
+        os.remove(f"{path}.delta")
+
+    return count
+
+
+def logged_short_codes(engines: list, watermarks: list) -> set:
+    """
+    logged_short_codes: the short codes logged in short_code_changes on every shard after
+        its watermark, None when a log was compacted past its watermark, then the changes
+        since can not be told from the log
+    """
+    short_codes = set()
+
+    for engine, watermark in zip(engines, watermarks):
+        with engine.connect() as connection:
+            short_codes.update(connection.execute(
+                select(ShortCodeChangeModel.short_code).where(
+                    ShortCodeChangeModel.seq > watermark)).scalars())
+            # after the entries, compaction only deletes the oldest ones, so the entries
+            # read were all there when the oldest left is at most one past the watermark
+            first = connection.execute(select(func.min(ShortCodeChangeModel.seq))).scalar()
+
+        if first is not None and first > watermark + 1:
+            return None
+
+    return short_codes
+
+
+def current_redirects(engines: list, short_codes: list, chunk_size: int = 500) -> dict:
+    """
+    current_redirects: short code -> (url, cache_max_age) of short_codes found on any of
+        the shards of engines
+    """
+    redirects = {}
+
+    for engine in engines:
+        with engine.connect() as connection:
+            # chunks keep bound parameters under driver limits
+            for start in range(0, len(short_codes), chunk_size):
+                redirects.update(
+                    (short_code, (url, cache_max_age))
+                    for short_code, url, cache_max_age in connection.execute(select(
+                        ShortURLModel.short_code, ShortURLModel.url,
+                        ShortURLModel.cache_max_age).where(ShortURLModel.short_code.in_(
+                            short_codes[start:start + chunk_size]))))
+
+    return redirects
+
+
+def scanned_changes(engines: list, base: SnapshotFile, batch_size: int) -> list:
+    """
+    scanned_changes: the redirects of every shard that differ from base and tombstones of
+        the short codes base has and the shards do not, found by reading every row, so time
+        and memory grow with the table
+    """
+    changes = []
+    seen = set()
+
+    for short_code, url, cache_max_age in redirect_rows(engines, batch_size):
+        seen.add(short_code)
+
+        if base.get(short_code) != (url, cache_max_age):
+            changes.append((short_code, url, cache_max_age))
+
+    return changes + [(short_code, *DELETED) for short_code, _, _ in base.items()
+                      if short_code not in seen]
+
+
+def export_delta(engines: list, path: str, batch_size: int = 10000) -> int:
+    """
+    export_delta: writes the short codes created, changed or deleted on the shards of
+        engines since the snapshot at path was written to path.delta, replacing the
+        previous delta, returns the number of changes written. The short codes logged in
+        short_code_changes after the watermarks of the snapshot are looked up, so the
+        export grows with the changes, not the table. When a log was compacted past its
+        watermark, or the shards are not the ones the snapshot was written for, every row
+        is read and compared instead.
+    """
+    base = SnapshotFile(path)
+    started = time()
+    watermarks = change_log_watermarks(engines)
+
+    try:
+        logged = None
+
+        if len(base.watermarks) == len(engines):
+            logged = logged_short_codes(engines, base.watermarks)
+
+        if logged is None:
+            changes = scanned_changes(engines, base, batch_size)
+
+        else:
+            logged = sorted(logged)
+            redirects = current_redirects(engines, logged)
+            changes = []
+
+            for short_code in logged:
+                redirect = redirects.get(short_code)
+
+                # gone since the snapshot, only a short code the snapshot has needs a
+                # tombstone
+                if redirect is None:
+                    if base.get(short_code) is not None:
+                        changes.append((short_code, *DELETED))
+
+                elif base.get(short_code) != redirect:
+                    changes.append((short_code, *redirect))
+
+        write_snapshot(
+            f"{path}.delta", changes, len(changes), base_id=base.id, created=started,
+            watermarks=watermarks)
+
+    finally:
+        base.close()
+
+    return len(changes)
@@ -0,0 +1,194 @@
+"""
+tests for admission.py and the admission control of the write routes
+"""
+
+import asyncio
+from time import perf_counter
+
+import httpx
+import shtl_ink_api.admission as admission_module
+from shtl_ink_api.admission import AdmissionController, Rejected, client_address
+from shtl_ink_api.routing import ReadWriteRouter
+import shtl_ink_api.app as app_module
+from shtl_ink_api.app import app, get_db_router, redirect_cache, admission
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from pytest import fixture, raises
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./admissiontest.db.sqlite"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./admissiontest.db.sqlite"
+
+
+@fixture
+def clock(monkeypatch) -> list:
+    """
+    test fixture to supply a clock the token buckets read, advanced by hand
+    """
+    now = [1000.0]
+    monkeypatch.setattr(admission_module, 'monotonic', lambda: now[0])
+    yield now
+
+
+@fixture
+def client(monkeypatch, empty_database, app_client) -> TestClient:
+    """
+    test fixture to supply a client for the app backed by an empty sqlite database, with
+    tight write limits
+    """
+    monkeypatch.setattr(admission, 'rate', 5.0)
+    monkeypatch.setattr(admission, 'burst', 5.0)
+    monkeypatch.setattr(admission, 'max_concurrent', 2)
+    return app_client(empty_database(SQLALCHEMY_DATABASE_URL, ASYNC_SQLALCHEMY_DATABASE_URL))
+
+
+def test_token_bucket_refills(clock) -> None:
+    """
+    test that an owner gets burst writes at once, then rate writes per second
+    """
+    controller = AdmissionController(rate=2, burst=3, max_concurrent=0)
+
+    for _ in range(3):
+        controller.enter("owner")
+        controller.exit()
+
+    with raises(Rejected) as rejected:
+        controller.enter("owner")
+
+    assert rejected.value.status == 429
+    assert rejected.value.headers() == {"Retry-After": "1"}
+    # other owners have their own bucket
+    controller.enter("someone else")
+    controller.exit()
+
+    clock[0] += 0.5
+    controller.enter("owner")
+    controller.exit()
+
+    with raises(Rejected):
+        controller.enter("owner")
+
+    assert controller.throttled == 2
+
+
+def test_concurrency_limit_sheds(clock) -> None:
+    """
+    test that writes past the concurrency limit are shed without spending a token
+    """
+    controller = AdmissionController(rate=1, burst=2, max_concurrent=1)
+    controller.enter("owner")
+
+    with raises(Rejected) as rejected:
+        controller.enter("owner")
+
+    assert rejected.value.status == 503
+    controller.exit()
+    controller.enter("owner")
+    assert controller.in_flight == 1
+    assert controller.shed == 1
+
+
+def test_client_address_behind_proxies() -> None:
+    """
+    test that the client address is read from X-Forwarded-For only past trusted proxies
+    """
+    proxies = ('10.0.0.0/8', '192.0.2.1')
+    # a direct client is its own address, whatever it forwards
+    assert client_address('203.0.113.9', '198.51.100.1', proxies) == '203.0.113.9'
+    # behind proxies, the first address from the right that is not one of them
+    assert client_address('10.1.2.3', '203.0.113.9', proxies) == '203.0.113.9'
+    assert client_address('10.1.2.3', '198.51.100.1, 203.0.113.9, 192.0.2.1', proxies) == \
+        '203.0.113.9'
+    # every hop a trusted proxy, the leftmost address is the client
+    assert client_address('10.1.2.3', '203.0.113.9, 10.4.5.6', proxies) == '203.0.113.9'
+    assert client_address('10.1.2.3', None, proxies) == '10.1.2.3'
+    assert client_address('10.1.2.3', '203.0.113.9', ()) == '10.1.2.3'
+    assert client_address('testclient', '203.0.113.9', ('*',)) == '203.0.113.9'
+
+
+def test_forwarded_clients_get_their_own_buckets(client, monkeypatch) -> None:
+    """
+    test that anonymous writers behind a trusted proxy are limited by their forwarded
+    address, not by the proxy's
+    """
+    monkeypatch.setattr(app_module, 'trusted_proxies', ('testclient',))
+
+    def create(i: int, forwarded_for: str) -> int:
+        return client.post(
+            "/create_short_code", json={"url": f"https://example.com/{forwarded_for}/{i}"},
+            headers={"x-forwarded-for": forwarded_for}).status_code
+
+    assert [create(i, "203.0.113.1") for i in range(6)] == [201] * 5 + [429]
+    assert [create(i, "203.0.113.2") for i in range(5)] == [201] * 5
+
+
+def test_rejected_write_route(client) -> None:
+    """
+    test that a write route answers 429 with Retry-After once the owner is out of tokens
+    """
+    statuses = [client.post("/create_short_code", json={"url": f"https://example.com/{i}"})
+                for i in range(6)]
+
+    assert [response.status_code for response in statuses] == [201] * 5 + [429]
+    assert int(statuses[-1].headers["retry-after"]) >= 1
+    assert "slow down" in statuses[-1].json()["message"]
+    assert admission.in_flight == 0
+
+
+def test_redirects_stay_fast_under_write_flood(client, monkeypatch) -> None:
+    """
+    test that redirects still get a pooled connection while a flood of slow writes is
+    running, the writes past the concurrency limit are turned away at once instead of
+    waiting for connections
+    """
+    short_code = client.post(
+        "/create_short_code", json={"url": "https://example.com"}).json()["short_code"]
+    # three connections, two for writes and one left for redirects
+    pooled_engine = create_async_engine(
+        ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=AsyncAdaptedQueuePool, pool_size=3,
+        max_overflow=0, pool_timeout=5)
+    router = ReadWriteRouter(pooled_engine)
+    app.dependency_overrides[get_db_router] = lambda: router
+    encode_canonical_async = app_module.codec.encode_canonical_async
+    release = asyncio.Event()
+
+    async def slow_encode_canonical_async(url, owner_id, router, *args):
+        # holds a pooled connection like a write stuck on a slow commit
+        async with router.primary() as session:
+            await session.connection()
+            await release.wait()
+
+        return await encode_canonical_async(url, owner_id, router, *args)
+
+    monkeypatch.setattr(app_module.codec, 'encode_canonical_async', slow_encode_canonical_async)
+
+    async def redirect_seconds(http) -> float:
+        redirect_cache.clear()
+        start = perf_counter()
+        response = await http.get(f"/{short_code}")
+        assert response.status_code == 307
+        return perf_counter() - start
+
+    async def flood():
+        async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=app), base_url="http://testserver") as http:
+            writes = [asyncio.ensure_future(http.post(
+                "/create_short_code", json={"url": f"https://example.com/{i}"}))
+                for i in range(50)]
+            # let every write reach the database or be turned away
+            await asyncio.sleep(0.2)
+            in_flight = admission.in_flight
+            seconds = [await asyncio.wait_for(redirect_seconds(http), 2) for _ in range(5)]
+            release.set()
+            statuses = [write.status_code for write in await asyncio.gather(*writes)]
+
+        await pooled_engine.dispose()
+        return in_flight, seconds, statuses
+
+    in_flight, seconds, statuses = client.portal.call(flood)
+
+    assert in_flight == admission.max_concurrent
+    assert statuses.count(201) == admission.max_concurrent
+    assert statuses.count(503) == 50 - admission.max_concurrent
+    # answered right away, not after the 5 second pool timeout
+    assert max(seconds) < 1
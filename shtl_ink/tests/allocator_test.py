@@ -0,0 +1,59 @@
+"""
+tests for allocator.py
+"""
+
+from shtl_ink_api.allocator import FeistelPermutation, ShortCodeAllocator
+from sqlalchemy.orm import Session
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./allocatortest.db.sqlite"
+
+
+def test_permutation_is_bijective() -> None:
+    """
+    test that every value in a domain that is not a power of two maps to a unique
+    value in the domain and back again
+    """
+    domain = 3 ** 7
+    permutation = FeistelPermutation(b"key", domain)
+    images = [permutation.permute(value) for value in range(domain)]
+
+    assert sorted(images) == list(range(domain))
+    assert all(permutation.invert(image) == value
+               for value, image in enumerate(images))
+
+
+def test_permutation_depends_on_key() -> None:
+    """
+    test that different keys give different permutations
+    """
+    first = FeistelPermutation(b"first", 49 ** 6)
+    second = FeistelPermutation(b"second", 49 ** 6)
+    assert [first.permute(i) for i in range(10)] != [
+        second.permute(i) for i in range(10)]
+
+
+def test_short_codes_are_fixed_length_and_reversible() -> None:
+    """
+    test that short codes are always the configured length and map back to their id
+    """
+    allocator = ShortCodeAllocator("abc", 4, "key", 10)
+
+    for id in range(allocator.capacity):
+        short_code = allocator.short_code(id)
+        assert len(short_code) == 4
+        assert allocator.short_code_id(short_code) == id
+
+
+def test_workers_reserve_disjoint_blocks(engine) -> None:
+    """
+    test that allocators sharing a database never hand out the same short code
+    """
+    workers = [ShortCodeAllocator("abcdefgh", 6, "key", 7) for _ in range(3)]
+    short_codes = []
+
+    with Session(engine) as session:
+        for _ in range(50):
+            for worker in workers:
+                short_codes.append(worker.next_short_code(session))
+
+    assert len(short_codes) == len(set(short_codes))
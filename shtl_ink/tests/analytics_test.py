@@ -0,0 +1,153 @@
+"""
+tests for analytics.ClickAggregator
+"""
+
+import asyncio
+
+from shtl_ink_api.models import ShortURLModel, ClickStatsModel
+from shtl_ink_api.analytics import ClickAggregator
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import create_async_engine
+from pytest import fixture, raises
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./analyticstest.db.sqlite"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./analyticstest.db.sqlite"
+
+
+@fixture
+def engine(engine):
+    """
+    test fixture to supply the empty sqlite database of conftest.engine with the short
+    codes abc and def
+    """
+    with Session(engine) as session:
+        session.add_all(ShortURLModel(url=f"https://example.com/{short_code}",
+                                      short_code=short_code) for short_code in ("abc", "def"))
+        session.commit()
+
+    yield engine
+
+
+def click_counts(engine) -> dict:
+    with engine.connect() as connection:
+        return dict(connection.execute(
+            select(ClickStatsModel.short_code, ClickStatsModel.clicks)).all())
+
+
+def test_flush_upserts_counts(engine) -> None:
+    """
+    test that buffered clicks are added to the stored counts on every flush
+    """
+    async def clicks():
+        aggregator = ClickAggregator(
+            create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL), 60, 100)
+
+        for _ in range(3):
+            aggregator.record("abc")
+        aggregator.record("def")
+        assert await aggregator.flush() == 2
+        assert len(aggregator) == 0
+
+        aggregator.record("abc")
+        assert await aggregator.flush() == 1
+        assert await aggregator.flush() == 0
+        await aggregator.engine.dispose()
+
+    asyncio.run(clicks())
+    assert click_counts(engine) == {"abc": 4, "def": 1}
+
+
+def test_flush_drops_counts_of_missing_short_codes(engine) -> None:
+    """
+    test that counts of short codes that are gone, or discarded once deleted, are not
+    written
+    """
+    async def clicks():
+        aggregator = ClickAggregator(
+            create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL), 60, 100)
+        aggregator.record("abc")
+        aggregator.record("def")
+        aggregator.record("gone")
+        aggregator.discard("def", "unknown")
+        assert len(aggregator) == 2
+        assert await aggregator.flush() == 2
+        await aggregator.engine.dispose()
+
+    asyncio.run(clicks())
+    assert click_counts(engine) == {"abc": 1}
+
+
+def test_rename_moves_buffered_counts() -> None:
+    """
+    test that the buffered counts of a renamed short code are kept under its new short code
+    """
+    aggregator = ClickAggregator(None, 60, 100)
+    aggregator.record("old")
+    aggregator.record("old")
+    aggregator.record("new")
+    aggregator.rename("old", "new")
+    aggregator.rename("unknown", "other")
+
+    assert len(aggregator) == 1
+    assert aggregator._pending["new"][0] == 3
+
+
+def test_stop_flushes_buffered_counts(engine) -> None:
+    """
+    test that stopping the background task writes what is still buffered
+    """
+    async def clicks():
+        aggregator = ClickAggregator(
+            create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL), 60, 100)
+        aggregator.start()
+        aggregator.record("abc")
+        await aggregator.stop()
+        await aggregator.engine.dispose()
+
+    asyncio.run(clicks())
+    assert click_counts(engine) == {"abc": 1}
+
+
+def test_size_threshold_triggers_flush(engine) -> None:
+    """
+    test that the background task flushes early once enough short codes are buffered
+    """
+    async def clicks():
+        aggregator = ClickAggregator(
+            create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL), 60, 2)
+        aggregator.start()
+        aggregator.record("abc")
+        aggregator.record("def")
+
+        for _ in range(100):
+            if aggregator.flushes:
+                break
+            await asyncio.sleep(0.01)
+
+        assert aggregator.flushes == 1
+        await aggregator.stop()
+        await aggregator.engine.dispose()
+
+    asyncio.run(clicks())
+    assert click_counts(engine) == {"abc": 1, "def": 1}
+
+
+def test_failed_flush_keeps_counts() -> None:
+    """
+    test that counts are kept for the next flush when the database write fails
+    """
+    async def clicks():
+        aggregator = ClickAggregator(
+            create_async_engine("sqlite+aiosqlite:///./missingtable.db.sqlite"), 60, 100)
+        aggregator.record("abc")
+        aggregator.record("abc")
+
+        with raises(Exception):
+            await aggregator.flush()
+
+        assert len(aggregator) == 1
+        assert aggregator._pending["abc"][0] == 2
+        await aggregator.engine.dispose()
+
+    asyncio.run(clicks())
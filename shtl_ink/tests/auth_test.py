@@ -0,0 +1,148 @@
+"""
+tests for auth.py
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from shtl_ink_api.auth import PathScopedMiddleware, cached_session, is_management_path
+from shtl_ink_api.auth import CORS_PATHS
+from shtl_ink_api.cache import LRUCache
+from shtl_ink_api.config import frontend_base_url
+from shtl_ink_api.app import app
+from fastapi.testclient import TestClient
+from starlette.requests import Request
+
+
+def a_request(method: str = "POST", cookies: str = "sAccessToken=abc; sIdRefreshToken=def",
+              anti_csrf: str = "token") -> Request:
+    headers = [(b"cookie", cookies.encode())]
+
+    if anti_csrf is not None:
+        headers.append((b"anti-csrf", anti_csrf.encode()))
+
+    return Request({"type": "http", "method": method, "path": "/create_short_code",
+                    "headers": headers})
+
+
+def a_session() -> SimpleNamespace:
+    return SimpleNamespace(
+        user_id="someone", remove_cookies=False, new_access_token_info=None,
+        new_refresh_token_info=None, new_id_refresh_token_info=None, new_anti_csrf_token=None)
+
+
+def test_management_paths() -> None:
+    """
+    test that management routes are matched and short codes are not
+    """
+    for path in ("/create_short_code", "/create_short_codes", "/delete_short_code/abc",
+                 "/modify_short_code", "/all_short_codes", "/click_stats", "/auth/signin",
+                 "/auth"):
+        assert is_management_path(path)
+
+    for path in ("/abc123", "/", "/short_code", "/short_code/abc", "/short_codes",
+                 "/authors", "/metrics"):
+        assert not is_management_path(path)
+
+
+def test_cors_paths() -> None:
+    """
+    test that the short code lookups get CORS without being management routes
+    """
+    for path in ("/short_code", "/short_code/abc", "/create_short_code", "/auth/signin"):
+        assert is_management_path(path, CORS_PATHS)
+
+    for path in ("/abc123", "/short_codes", "/metrics"):
+        assert not is_management_path(path, CORS_PATHS)
+
+
+def test_short_code_lookups_answer_cross_origin_preflights() -> None:
+    """
+    test that the frontend's preflights for short code lookups are allowed and that
+    redirects are left without CORS
+    """
+    client = TestClient(app)
+
+    for path, method in (("/short_code", "POST"), ("/short_code/abc", "GET")):
+        response = client.options(path, headers={
+            "origin": frontend_base_url, "access-control-request-method": method})
+        assert response.status_code == 200
+        assert response.headers["access-control-allow-origin"] == frontend_base_url
+        assert response.headers["access-control-allow-credentials"] == "true"
+
+    response = client.options("/abc123", headers={
+        "origin": frontend_base_url, "access-control-request-method": "GET"})
+    assert "access-control-allow-origin" not in response.headers
+
+
+def test_path_scoped_middleware() -> None:
+    """
+    test that the scoped middleware only sees requests to the given paths
+    """
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append(("app", scope.get("path")))
+
+    class Recorder:
+        def __init__(self, app, name):
+            self.app = app
+            self.name = name
+
+        async def __call__(self, scope, receive, send):
+            seen.append((self.name, scope["path"]))
+            await self.app(scope, receive, send)
+
+    middleware = PathScopedMiddleware(app, Recorder, name="auth")
+    asyncio.run(middleware({"type": "http", "path": "/abc123"}, None, None))
+    # built on the first request it scopes
+    assert middleware.scoped is None
+    asyncio.run(middleware({"type": "http", "path": "/all_short_codes"}, None, None))
+    asyncio.run(middleware({"type": "lifespan"}, None, None))
+    assert seen == [
+        ("app", "/abc123"), ("auth", "/all_short_codes"), ("app", "/all_short_codes"),
+        ("app", None)]
+
+
+def test_cached_session_reused() -> None:
+    """
+    test that a session is verified once per set of tokens while cached
+    """
+    calls = []
+
+    async def verify(request):
+        calls.append(request)
+        return a_session()
+
+    dependency = cached_session(LRUCache(max_size=10, ttl=60), verify)
+    first = asyncio.run(dependency(a_request()))
+    second = asyncio.run(dependency(a_request()))
+    assert second is first
+    assert len(calls) == 1
+
+    # different anti csrf header, method or tokens are verified again
+    asyncio.run(dependency(a_request(anti_csrf="other")))
+    asyncio.run(dependency(a_request(method="GET")))
+    asyncio.run(dependency(a_request(cookies="sAccessToken=xyz; sIdRefreshToken=def")))
+    assert len(calls) == 4
+
+
+def test_cached_session_skips_refreshed_tokens() -> None:
+    """
+    test that sessions with new tokens to set on the response are not cached, and that
+    requests without tokens are never cached
+    """
+    calls = []
+
+    async def verify(request):
+        calls.append(request)
+        session = a_session()
+        session.new_access_token_info = {"token": "new", "expiry": 0}
+        return session
+
+    dependency = cached_session(LRUCache(max_size=10, ttl=60), verify)
+    asyncio.run(dependency(a_request()))
+    asyncio.run(dependency(a_request()))
+    asyncio.run(dependency(a_request(cookies="")))
+    asyncio.run(dependency(a_request(cookies="")))
+    assert len(calls) == 4
@@ -0,0 +1,56 @@
+"""
+tests for bloom.BloomFilter
+"""
+
+from shtl_ink_api.bloom import BloomFilter
+
+
+def test_no_false_negatives() -> None:
+    """
+    test that every added key is reported as present
+    """
+    bloom = BloomFilter(capacity=10000, error_rate=0.01)
+    keys = [f"code{i}" for i in range(10000)]
+
+    for key in keys:
+        bloom.add(key)
+
+    assert all(key in bloom for key in keys)
+    assert len(bloom) == 10000
+
+
+def test_false_positive_rate() -> None:
+    """
+    test that keys that were never added are reported present at about the target rate,
+    100,000 codes at 1% measures about 1.0%
+    """
+    bloom = BloomFilter(capacity=100000, error_rate=0.01)
+
+    for i in range(100000):
+        bloom.add(f"code{i}")
+
+    false_positives = sum(f"other{i}" in bloom for i in range(100000))
+    assert false_positives / 100000 < 0.015
+    assert abs(bloom.false_positive_rate() - 0.01) < 0.001
+
+
+def test_memory_per_million_codes() -> None:
+    """
+    test the size of a filter for a million codes, about 9.6 bits (1.2 MB) per million at
+    1% and 14.4 bits (1.8 MB) per million at 0.1%
+    """
+    assert 1.1e6 < BloomFilter(1000000, 0.01).size_bytes < 1.3e6
+    assert 1.7e6 < BloomFilter(1000000, 0.001).size_bytes < 1.9e6
+
+
+def test_might_contain_until_loaded() -> None:
+    """
+    test that an unloaded filter rules nothing out
+    """
+    bloom = BloomFilter(capacity=10, error_rate=0.01)
+    assert bloom.might_contain("anything")
+
+    bloom.loaded = True
+    assert not bloom.might_contain("anything")
+    bloom.add("anything")
+    assert bloom.might_contain("anything")
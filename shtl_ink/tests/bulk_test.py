@@ -0,0 +1,119 @@
+"""
+tests for bulk.py and the import and export commands
+"""
+
+import io
+import os
+import subprocess
+import sys
+
+import orjson
+from shtl_ink_api.models import ShortURLModel, ShortCodeChangeModel, url_hash
+from shtl_ink_api.bulk import read_records, import_records, export_records
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+PACKAGE_PATH = os.path.join(os.path.dirname(__file__), '..')
+URLS_PATH = os.path.join(PACKAGE_PATH, '..', 'data', 'input_urls.txt')
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./bulktest.db.sqlite"
+
+
+def stored(engine) -> dict:
+    with engine.connect() as connection:
+        return {short_code: (owner_id, url, hash) for short_code, owner_id, url, hash in
+                connection.execute(select(
+                    ShortURLModel.short_code, ShortURLModel.owner_id, ShortURLModel.url,
+                    ShortURLModel.url_hash))}
+
+
+def test_import_urls_in_batches(engine) -> None:
+    """
+    test that every url of a text file is written under an allocated short code and
+    logged as created
+    """
+    with open(URLS_PATH, 'r') as file:
+        urls = file.read().splitlines()
+
+    with open(URLS_PATH, 'r') as file:
+        assert import_records(
+            [engine], read_records(file, 'txt'), batch_size=300) == (len(urls), 0)
+
+    records = stored(engine)
+    assert sorted(url for _, url, _ in records.values()) == sorted(urls)
+    assert all(hash == url_hash(url) for _, url, hash in records.values())
+
+    with engine.connect() as connection:
+        assert connection.execute(
+            select(func.count()).select_from(ShortCodeChangeModel)).scalar() == len(urls)
+
+
+def test_import_skips_taken_short_codes(engine) -> None:
+    """
+    test that records naming a short code that is already taken, or a url that is too
+    long, are skipped and the rest are written
+    """
+    with Session(engine) as session:
+        session.add(ShortURLModel(owner_id="someone", url="https://old.com", short_code="old"))
+        session.commit()
+
+    file = io.StringIO(
+        "short_code,owner_id,url\n"
+        "old,,https://new.com\n"
+        "custom,owner,https://example.com/1\n"
+        "custom,,https://example.com/2\n"
+        f",,https://example.com/{'c' * 2000}\n"
+        ",,https://example.com/3\n")
+
+    assert import_records([engine], read_records(file, 'csv')) == (2, 3)
+    records = stored(engine)
+    assert records["old"][:2] == ("someone", "https://old.com")
+    assert records["custom"][:2] == ("owner", "https://example.com/1")
+    assert ("anonymous", "https://example.com/3") in [
+        record[:2] for record in records.values()]
+
+
+def test_export_round_trip(engine) -> None:
+    """
+    test that an export in every format reads back as the records written
+    """
+    records = [("abc", "owner", "https://example.com/1"),
+               ("def", "anonymous", "https://example.com/2,with,commas")]
+    import_records([engine], iter(records))
+
+    for format in ('csv', 'ndjson'):
+        file = io.StringIO(newline='')
+        assert export_records([engine], file, format, batch_size=1) == 2
+        file.seek(0)
+        assert sorted(read_records(file, format)) == records
+
+    file = io.StringIO()
+    export_records([engine], file, 'txt')
+    assert sorted(file.getvalue().splitlines()) == [url for _, _, url in records]
+
+
+def test_import_and_export_commands(tmp_path) -> None:
+    """
+    test that the import command reads a file and the export command streams it back
+    """
+    env = {key: value for key, value in os.environ.items() if not key.startswith('DB_')}
+    env['PYTHONPATH'] = os.path.abspath(PACKAGE_PATH)
+
+    def run(*args):
+        result = subprocess.run(
+            [sys.executable, '-m', 'shtl_ink_api'] + list(args), cwd=tmp_path, env=env,
+            capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+        return result
+
+    run('migrate')
+    (tmp_path / 'links.ndjson').write_text(
+        '{"short_code": "abc", "url": "https://example.com"}\n'
+        '{"url": "https://example.com/2", "owner_id": "owner"}\n')
+    assert 'imported 2 short codes, skipped 0' in run('import', 'links.ndjson').stderr
+
+    exported = [orjson.loads(line) for line in
+                run('export', '-', '--format', 'ndjson').stdout.splitlines()]
+    assert {"short_code": "abc", "owner_id": "anonymous",
+            "url": "https://example.com"} in exported
+    assert len(exported) == 2
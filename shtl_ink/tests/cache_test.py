@@ -0,0 +1,122 @@
+"""
+tests for cache.LRUCache and cache.SingleFlight
+"""
+
+import asyncio
+
+from shtl_ink_api.cache import LRUCache, SingleFlight
+from pytest import fixture, raises
+
+
+@fixture
+def a_cache() -> LRUCache:
+    """
+    test fixture to supply a small cache
+    """
+    cache = LRUCache(max_size=3, ttl=60)
+    yield cache
+
+
+def test_get_counts_hits_and_misses(a_cache) -> None:
+    """
+    test that lookups are counted as hits or misses
+    """
+    assert a_cache.get("abc") is None
+    a_cache.set("abc", "https://example.com")
+    assert a_cache.get("abc") == "https://example.com"
+    assert a_cache.hits == 1
+    assert a_cache.misses == 1
+
+
+def test_evicts_least_recently_used(a_cache) -> None:
+    """
+    test that the least recently used entry is evicted when the cache is full
+    """
+    for key in ("a", "b", "c"):
+        a_cache.set(key, key)
+
+    # touch "a" so "b" becomes the least recently used
+    a_cache.get("a")
+    a_cache.set("d", "d")
+
+    assert len(a_cache) == 3
+    assert a_cache.get("b") is None
+    assert a_cache.get("a") == "a"
+
+
+def test_expired_entries_are_misses() -> None:
+    """
+    test that entries past their time to live are not served
+    """
+    cache = LRUCache(max_size=3, ttl=-1)
+    cache.set("abc", "https://example.com")
+    assert cache.get("abc") is None
+    assert len(cache) == 0
+
+
+def test_invalidate(a_cache) -> None:
+    """
+    test that invalidated keys are no longer served
+    """
+    a_cache.set("abc", "https://example.com")
+    a_cache.set("def", "https://example.org")
+    a_cache.invalidate("abc", "def", "not_cached")
+    assert a_cache.get("abc") is None
+    assert a_cache.get("def") is None
+
+
+def test_zero_size_disables_cache() -> None:
+    """
+    test that a cache with no room stores nothing
+    """
+    cache = LRUCache(max_size=0, ttl=60)
+    cache.set("abc", "https://example.com")
+    assert cache.get("abc") is None
+
+
+def test_single_flight_coalesces() -> None:
+    """
+    test that concurrent calls with the same key share one call and its result, and that
+    a finished call is made again
+    """
+    flights = SingleFlight()
+    calls = []
+
+    async def call(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return f"{key}{calls.count(key)}"
+
+    async def run_all():
+        results = await asyncio.gather(
+            *(flights.run("a", lambda: call("a")) for _ in range(5)),
+            flights.run("b", lambda: call("b")))
+        return results, len(flights), await flights.run("a", lambda: call("a"))
+
+    results, running, again = asyncio.run(run_all())
+
+    assert results == ["a1"] * 5 + ["b1"]
+    assert calls == ["a", "b", "a"]
+    assert again == "a2"
+    assert flights.coalesced == 4
+    assert running == 0
+
+
+def test_single_flight_shares_exceptions() -> None:
+    """
+    test that every caller waiting on a call that fails gets its exception
+    """
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def run_all():
+        return await asyncio.gather(
+            *(flights.run("a", fail) for _ in range(3)), return_exceptions=True)
+
+    assert [str(result) for result in asyncio.run(run_all())] == ["failed"] * 3
+
+    with raises(ValueError):
+        asyncio.run(flights.run("a", fail))
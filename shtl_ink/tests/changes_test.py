@@ -0,0 +1,229 @@
+"""
+tests for changes.py
+"""
+
+import asyncio
+
+from shtl_ink_api.models import ShortCodeChangeModel
+from shtl_ink_api.changes import ChangeFeed, CREATE, DELETE, log_changes, hole_ranges
+from shtl_ink_api.codec import Codec
+from shtl_ink_api.routing import ReadWriteRouter
+from shtl_ink_api.app import app, get_db_router, redirect_cache
+from fastapi.testclient import TestClient
+from sqlalchemy import event, select, insert
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import create_async_engine
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./changestest.db.sqlite"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./changestest.db.sqlite"
+
+
+def logged(engine) -> list:
+    with engine.connect() as connection:
+        return connection.execute(select(
+            ShortCodeChangeModel.op, ShortCodeChangeModel.short_code).order_by(
+            ShortCodeChangeModel.seq)).all()
+
+
+def follow(steps, retain: int = 100) -> list:
+    """
+    runs steps(feed, write) against a feed that records what it applies, write logs
+    changes from another connection, returns what was applied and the feed
+    """
+    applied = []
+
+    async def run():
+        async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+        feed = ChangeFeed(
+            async_engine, lambda op, short_code, seq: applied.append((op, short_code)),
+            lambda: applied.append('reset'), 60, retain, 60)
+
+        async def write(*rows):
+            async with async_engine.begin() as connection:
+                await connection.execute(insert(ShortCodeChangeModel).values(list(rows)))
+
+        await steps(feed, write)
+        await async_engine.dispose()
+
+    asyncio.run(run())
+    return applied
+
+
+def test_poll_applies_new_entries_in_order(engine) -> None:
+    """
+    test that a feed applies the entries written after it started, oldest first
+    """
+    async def steps(feed, write):
+        await write({'op': CREATE, 'short_code': 'old'})
+        await feed.seek_end()
+        await write({'op': CREATE, 'short_code': 'abc'}, {'op': DELETE, 'short_code': 'abc'})
+        assert await feed.poll() == 2
+        assert await feed.poll() == 0
+
+    assert follow(steps) == [(CREATE, 'abc'), (DELETE, 'abc')]
+
+
+def test_late_entry_is_applied(engine) -> None:
+    """
+    test that an entry committed after one with a higher sequence number is still applied
+    """
+    async def steps(feed, write):
+        await write({'seq': 1, 'op': CREATE, 'short_code': 'first'},
+                    {'seq': 3, 'op': CREATE, 'short_code': 'third'})
+        assert await feed.poll() == 2
+        await write({'seq': 2, 'op': DELETE, 'short_code': 'second'})
+        assert await feed.poll() == 1
+        assert await feed.poll() == 0
+
+    assert follow(steps) == [
+        (CREATE, 'first'), (CREATE, 'third'), (DELETE, 'second')]
+
+
+def test_hole_ranges() -> None:
+    """
+    test that holes are grouped into runs of consecutive sequence numbers
+    """
+    assert hole_ranges([]) == []
+    assert hole_ranges({7: 0, 3: 0, 4: 0, 5: 0, 9: 0}) == [(3, 5), (7, 7), (9, 9)]
+
+
+def test_late_entries_of_many_holes_are_applied(engine) -> None:
+    """
+    test that a feed with more holes than a query can name still finds late entries in
+    them, a query at a time
+    """
+    parameters = []
+
+    def count_parameters(connection, cursor, statement, bound, context, executemany):
+        parameters.append(len(bound))
+
+    async def steps(feed, write):
+        feed.ranges_per_query = 10
+        # every other number skipped, 50 holes of their own and a run of 50000 after them
+        await write(*[{'seq': seq, 'op': CREATE, 'short_code': f'code{seq}'}
+                      for seq in range(1, 102, 2)])
+        await write({'seq': 50101, 'op': CREATE, 'short_code': 'last'})
+        await feed.catch_up()
+        assert len(hole_ranges(feed._holes)) == 51
+        event.listen(feed.engine.sync_engine, "before_cursor_execute", count_parameters)
+        await write({'seq': 2, 'op': DELETE, 'short_code': 'early'},
+                    {'seq': 98, 'op': DELETE, 'short_code': 'later'},
+                    {'seq': 40000, 'op': DELETE, 'short_code': 'batch'})
+        assert await feed.poll() == 3
+        assert await feed.poll() == 0
+
+    applied = follow(steps)
+    assert applied[-3:] == [(DELETE, 'early'), (DELETE, 'later'), (DELETE, 'batch')]
+    assert len(applied) == 55
+    # two numbers per range, whatever the number of holes
+    assert 0 < max(parameters) <= 2 * 10
+
+
+def test_failed_poll_is_logged(engine, caplog) -> None:
+    """
+    test that the background task logs a failed poll and keeps going
+    """
+    async def steps(feed, write):
+        feed.interval = 0.01
+        await feed.start()
+        engine.dispose()
+        ShortCodeChangeModel.__table__.drop(bind=engine)
+        await asyncio.sleep(0.1)
+        assert feed._task is not None and not feed._task.done()
+        await feed.stop()
+
+    follow(steps)
+    assert "following the change log failed" in caplog.text
+
+
+def test_compact_resets_lagging_feed(engine) -> None:
+    """
+    test that compaction keeps the newest entries and a feed behind them resets
+    """
+    async def steps(feed, write):
+        await feed.seek_end()
+        await write(*[{'op': CREATE, 'short_code': f'code{i}'} for i in range(5)])
+        assert await feed.compact() == 3
+        assert await feed.poll() == 2
+        assert feed.resets == 1
+
+    assert follow(steps, retain=2) == ['reset', (CREATE, 'code3'), (CREATE, 'code4')]
+    assert len(logged(engine)) == 2
+
+
+def test_start_replays_since(engine) -> None:
+    """
+    test that a feed started at a seq applies every entry after it before it returns, and
+    that one started behind compacted entries resets
+    """
+    async def steps(feed, write):
+        await write(*[{'op': CREATE, 'short_code': f'code{i}'} for i in range(4)])
+        await feed.start(2)
+        await feed.stop()
+        assert feed.since == 2
+        assert await feed.compact() == 2
+        await feed.start(1)
+        await feed.stop()
+        assert feed.since == 2
+
+    assert follow(steps, retain=2) == [
+        (CREATE, 'code2'), (CREATE, 'code3'), 'reset', (CREATE, 'code2'), (CREATE, 'code3')]
+
+
+def test_codec_logs_creates(engine) -> None:
+    """
+    test that encoding logs every short code created with the records
+    """
+    codec = Codec()
+
+    with Session(engine) as session:
+        short_code = codec.url_encode("https://example.com/sync", "anonymous", session)
+
+    async def encode():
+        async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+
+        short_codes = await codec.encode_batch_async(
+            ["https://example.com/1", "https://example.com/2"], "anonymous",
+            ReadWriteRouter(async_engine))
+
+        await async_engine.dispose()
+        return short_codes
+
+    short_codes = asyncio.run(encode())
+    assert logged(engine) == [(CREATE, code) for code in [short_code] + short_codes]
+
+
+def test_rolled_back_change_is_not_logged(engine) -> None:
+    """
+    test that change log entries are written by the commit of the change only
+    """
+    with Session(engine) as session:
+        log_changes(session, CREATE, "abc")
+        session.rollback()
+
+    assert logged(engine) == []
+
+
+def test_routes_log_changes(engine) -> None:
+    """
+    test that creating, modifying and deleting through the api logs every change
+    """
+    async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+    router = ReadWriteRouter(async_engine)
+    app.dependency_overrides[get_db_router] = lambda: router
+    app_router, app.state.db_router = app.state.db_router, router
+    redirect_cache.clear()
+
+    with TestClient(app) as client:
+        client.post(
+            "/create_custom_short_code",
+            json={"short_code": "before", "url": "https://example.com"})
+        client.post(
+            "/modify_short_code",
+            json={"short_code": "before", "new_short_code": "after"})
+        client.delete("/delete_short_code/after")
+
+    app.dependency_overrides.clear()
+    app.state.db_router = app_router
+    assert logged(engine) == [
+        (CREATE, 'before'), (DELETE, 'before'), (CREATE, 'after'), (DELETE, 'after')]
@@ -0,0 +1,135 @@
+"""
+tests for compact.py and the compact schema
+"""
+
+from shtl_ink_api.models import ShortURLModel, OwnerModel, UrlBodyModel, CompactLinkModel
+from shtl_ink_api.models import CustomLinkModel
+from shtl_ink_api.database import CompactBase
+from shtl_ink_api.compact import ShortCodeKeys, short_code_keys, migrate_compact
+from shtl_ink_api.migrations import migrate
+from sqlalchemy import inspect, select, delete, func
+from sqlalchemy.orm import Session
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./compacttest.db.sqlite"
+
+
+def add_records(engine, *records) -> None:
+    with Session(engine) as session:
+        session.add_all(ShortURLModel(
+            short_code=short_code, owner_id=owner_id, url=url, canonical=canonical)
+            for short_code, owner_id, url, canonical in records)
+        session.commit()
+
+
+def compact_records(engine) -> dict:
+    # short code -> (owner id, url) read back through the compact tables
+    keys = short_code_keys()
+
+    with engine.connect() as connection:
+        records = {}
+
+        for table, short_code_of in (
+                (CompactLinkModel.__table__, lambda row: keys.short_code(row[0])),
+                (CustomLinkModel.__table__, lambda row: row[0])):
+            for row in connection.execute(
+                    select(table.c[0], OwnerModel.owner_id, UrlBodyModel.url)
+                    .outerjoin(OwnerModel, OwnerModel.id == table.c.owner_key)
+                    .outerjoin(UrlBodyModel, UrlBodyModel.id == table.c.url_id)):
+                records[short_code_of(row)] = (row.owner_id, row.url)
+
+        return records
+
+
+def test_short_code_keys_roundtrip_in_order() -> None:
+    """
+    test that allocated short codes have a key that gives them back, in short code
+    order, and that other short codes have none
+    """
+    keys = short_code_keys()
+    short_codes = sorted(['222222', 'zzzzzz', 'ZZZZZZ', 'b2Xz9q', 'bcdfgh', '9ZZZZZ', 'B22222'])
+    assert [keys.short_code(keys.key(short_code)) for short_code in short_codes] == \
+        short_codes
+    assert [keys.key(short_code) for short_code in short_codes] == \
+        sorted(keys.key(short_code) for short_code in short_codes)
+    assert keys.key('222222') == 0
+    assert keys.key('zzzzzz') == len(keys.digits) ** 6 - 1
+    assert keys.key('custom') is None
+    assert keys.key('bcdfg') is None
+    assert keys.key('bcdfgh1') is None
+    assert ShortCodeKeys('ab', 3).short_code(5) == 'bab'
+
+
+def test_schema_is_left_to_the_compact_command(engine) -> None:
+    """
+    test that the schema every deployment creates has none of the compact tables and
+    that the migration creates them
+    """
+    migrate(engine)
+    assert not set(CompactBase.metadata.tables) & set(inspect(engine).get_table_names())
+
+    migrate_compact(engine)
+    assert set(CompactBase.metadata.tables) <= set(inspect(engine).get_table_names())
+
+
+def test_migrate_copies_every_record(engine) -> None:
+    """
+    test that the compact tables hold every record, allocated short codes by key,
+    custom ones in their own table, and that urls and owners are stored once
+    """
+    add_records(
+        engine,
+        ('b2Xz9q', 'one', 'https://example.com/shared', True),
+        ('bcdfgh', 'two', 'https://example.com/shared', True),
+        ('custom', 'one', 'https://example.com/shared', False),
+        ('ZZZZZZ', 'one', 'https://example.com/other', True),
+        ('anon', None, 'https://example.com/other', None))
+
+    assert migrate_compact(engine, batch_size=2) == (5, 0)
+    assert compact_records(engine) == {
+        'b2Xz9q': ('one', 'https://example.com/shared'),
+        'bcdfgh': ('two', 'https://example.com/shared'),
+        'custom': ('one', 'https://example.com/shared'),
+        'ZZZZZZ': ('one', 'https://example.com/other'),
+        'anon': ('anonymous', 'https://example.com/other')}
+
+    with engine.connect() as connection:
+        assert connection.execute(select(func.count()).select_from(UrlBodyModel)).scalar() == 2
+        assert connection.execute(select(func.count()).select_from(OwnerModel)).scalar() == 3
+        assert connection.execute(
+            select(func.count()).select_from(CompactLinkModel)).scalar() == 3
+        assert connection.execute(select(CustomLinkModel.short_code)).scalars().all() == \
+            ['anon', 'custom']
+        assert connection.execute(select(CompactLinkModel.canonical)).scalars().all() == \
+            [True, True, True]
+
+
+def test_migrate_again_converges(engine) -> None:
+    """
+    test that running the migration again picks up changed and deleted records and
+    changes nothing when nothing changed
+    """
+    add_records(
+        engine,
+        ('b2Xz9q', 'one', 'https://example.com/1', True),
+        ('bcdfgh', 'one', 'https://example.com/2', True),
+        ('custom', 'one', 'https://example.com/3', False),
+        ('g2h3j4', 'two', 'https://example.com/4', True))
+    migrate_compact(engine)
+
+    with Session(engine) as session:
+        session.execute(delete(ShortURLModel).where(
+            ShortURLModel.short_code.in_(['bcdfgh', 'custom'])))
+        session.get(ShortURLModel, 'b2Xz9q').url = 'https://example.com/changed'
+        session.commit()
+
+    add_records(engine, ('new', 'two', 'https://example.com/4', False))
+
+    assert migrate_compact(engine, batch_size=1) == (3, 2)
+    expected = {
+        'b2Xz9q': ('one', 'https://example.com/changed'),
+        'g2h3j4': ('two', 'https://example.com/4'),
+        'new': ('two', 'https://example.com/4')}
+    assert compact_records(engine) == expected
+
+    assert migrate_compact(engine) == (3, 0)
+    assert compact_records(engine) == expected
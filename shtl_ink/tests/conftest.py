@@ -0,0 +1,69 @@
+"""
+test fixtures shared by the tests
+"""
+
+from contextlib import ExitStack
+
+from shtl_ink_api.models import Base
+from shtl_ink_api.database import CompactBase
+from shtl_ink_api.routing import ReadWriteRouter
+from shtl_ink_api.app import app, get_db_router, redirect_cache, admission
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+from pytest import fixture
+
+
+@fixture
+def engine(request):
+    """
+    test fixture to supply an empty sqlite database at the SQLALCHEMY_DATABASE_URL of the
+    test module, without the compact schema
+    """
+    engine = create_engine(request.module.SQLALCHEMY_DATABASE_URL)
+    CompactBase.metadata.drop_all(bind=engine)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@fixture
+def empty_database():
+    """
+    test fixture to supply a factory of routers on an empty sqlite database, given its sync
+    and async urls
+    """
+    def router(url: str, async_url: str) -> ReadWriteRouter:
+        engine = create_engine(url)
+        Base.metadata.drop_all(bind=engine)
+        Base.metadata.create_all(bind=engine)
+        engine.dispose()
+        return ReadWriteRouter(create_async_engine(async_url))
+
+    yield router
+
+
+@fixture
+def app_client():
+    """
+    test fixture to supply a factory of clients for the app reading and writing through a
+    given router, the app's own router is put back once the test is done
+    """
+    clients = ExitStack()
+    app_router = app.state.db_router
+
+    def client(router) -> TestClient:
+        app.dependency_overrides[get_db_router] = lambda: router
+        app.state.db_router = router
+        redirect_cache.clear()
+        # every test writes as the same anonymous client, start each with a full bucket
+        admission.buckets.clear()
+        return clients.enter_context(TestClient(app))
+
+    yield client
+
+    clients.close()
+    admission.buckets.clear()
+    app.dependency_overrides.clear()
+    app.state.db_router = app_router
@@ -0,0 +1,112 @@
+"""
+tests for fastpath.RedirectFastPath
+"""
+
+from shtl_ink_api.models import ShortURLModel
+from shtl_ink_api.routing import ReadWriteRouter
+from shtl_ink_api.cache import LRUCache
+from shtl_ink_api.fastpath import RedirectFastPath
+from shtl_ink_api.bloom import BloomFilter
+from shtl_ink_api.app import app, get_db_router
+from fastapi.testclient import TestClient
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import create_async_engine
+from pytest import fixture
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./fastpathtest.db.sqlite"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./fastpathtest.db.sqlite"
+
+
+@fixture
+def cache() -> LRUCache:
+    """
+    test fixture to supply an empty redirect cache
+    """
+    yield LRUCache(max_size=100, ttl=60)
+
+
+@fixture
+def client(cache, engine) -> TestClient:
+    """
+    test fixture to supply a client for the fast path in front of the app, backed by a
+    sqlite database holding one record
+    """
+    with Session(engine) as session:
+        session.add(ShortURLModel(
+            owner_id="anonymous", url="https://example.com/a b", short_code="fast"))
+        session.commit()
+
+    async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+    router = ReadWriteRouter(async_engine)
+    app.dependency_overrides[get_db_router] = lambda: router
+    app_router, app.state.db_router = app.state.db_router, router
+
+    with TestClient(RedirectFastPath(app, async_engine, cache)) as test_client:
+        yield test_client
+
+    app.dependency_overrides.clear()
+    app.state.db_router = app_router
+
+
+def test_redirect(client, cache) -> None:
+    """
+    test that a known short code redirects, the same way the app's route does
+    """
+    response = client.get("/fast", allow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://example.com/a%20b"
+    assert response.content == b""
+    assert cache.get("fast") == ("https://example.com/a b", None)
+
+
+def test_not_found(client) -> None:
+    """
+    test that an unknown short code gets the app's not found body
+    """
+    response = client.get("/missing", allow_redirects=False)
+    assert response.status_code == 404
+    assert response.json() == {"message": "missing not found"}
+
+
+def test_other_routes_pass_through(client) -> None:
+    """
+    test that the app's own routes are not treated as short codes
+    """
+    response = client.get("/all_short_codes")
+    assert response.status_code == 200
+    assert [record["short_code"] for record in response.json()] == ["fast"]
+
+    response = client.get("/short_code/fast")
+    assert response.json()["url"] == "https://example.com/a b"
+
+    response = client.post("/short_code", json={"short_code": "fast"})
+    assert response.status_code == 200
+
+
+def test_bloom_filter_skips_database(cache) -> None:
+    """
+    test that codes the bloom filter rules out are not found without a database
+    """
+    bloom = BloomFilter(capacity=10, error_rate=0.01)
+    bloom.loaded = True
+
+    with TestClient(RedirectFastPath(app, None, cache, bloom=bloom)) as test_client:
+        response = test_client.get("/missing", allow_redirects=False)
+
+    assert response.status_code == 404
+
+
+def test_permanent_redirect(client, cache) -> None:
+    """
+    test that the fast path sends the cache policy of the short code
+    """
+    assert client.get("/fast", allow_redirects=False).headers["cache-control"] == "no-store"
+
+    client.post("/create_custom_short_code", json={
+        "short_code": "kept", "url": "https://example.com/kept", "cache_max_age": 60})
+    cache.clear()
+
+    for _ in range(2):
+        response = client.get("/kept", allow_redirects=False)
+        assert response.status_code == 308
+        assert response.headers["cache-control"] == "public, max-age=60"
@@ -0,0 +1,56 @@
+"""
+tests for metrics.py
+"""
+
+from shtl_ink_api.metrics import Counter, Gauge, Histogram, Registry, instrument_engine
+from shtl_ink_api.metrics import query_duration, pool_checkouts, registry
+from sqlalchemy import create_engine, text
+
+
+def test_histogram_buckets_are_cumulative() -> None:
+    """
+    test that a histogram renders cumulative buckets, the sum and the count
+    """
+    histogram = Histogram('latency_seconds', 'latency', ('handler',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, 'a')
+    histogram.observe(0.1, 'a')
+    histogram.observe(0.5, 'a')
+    histogram.observe(2.0, 'a')
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{handler="a",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{handler="a",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{handler="a",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{handler="a"} 2.65' in lines
+    assert 'latency_seconds_count{handler="a"} 4' in lines
+
+
+def test_registry_runs_collectors() -> None:
+    """
+    test that collectors run before every render
+    """
+    test_registry = Registry()
+    counter = test_registry.register(Counter('things_total', 'things'))
+    gauge = test_registry.register(Gauge('level', 'level', ('side',)))
+    gauge.inc('left')
+    gauge.dec('left', amount=3)
+    test_registry.add_collector(lambda: counter.set(7))
+    output = test_registry.render()
+    assert '# TYPE things_total counter\nthings_total 7\n' in output
+    assert 'level{side="left"} -2' in output
+
+
+def test_instrument_engine_times_queries() -> None:
+    """
+    test that statements and pool checkouts on an instrumented engine are counted
+    """
+    engine = create_engine("sqlite://")
+    instrument_engine(engine, "metrics_test")
+
+    with engine.connect() as connection:
+        connection.execute(text("select 1"))
+
+    assert query_duration.values[("metrics_test", "SELECT")][-2] == 0
+    assert sum(query_duration.values[("metrics_test", "SELECT")][:-1]) == 1
+    assert pool_checkouts.values[("metrics_test",)] == 1
+    assert 'db_pool_checkouts_total{engine="metrics_test"} 1' in registry.render()
+    engine.dispose()
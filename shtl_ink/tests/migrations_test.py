@@ -0,0 +1,150 @@
+"""
+tests for migrations.py
+"""
+
+import os
+import subprocess
+import sys
+
+from shtl_ink_api.models import url_hash
+from shtl_ink_api.migrations import (
+    add_url_hash, add_cache_max_age, add_clicks_foreign_key, upgrade)
+from sqlalchemy import create_engine, inspect, text
+from pytest import fixture
+
+PACKAGE_PATH = os.path.join(os.path.dirname(__file__), '..')
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./migrationtest.db.sqlite"
+
+
+@fixture
+def legacy_engine():
+    """
+    test fixture to supply a database with the short_code_to_url table as it was
+    before url_hash was added
+    """
+    engine = create_engine(SQLALCHEMY_DATABASE_URL)
+
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS short_code_to_url"))
+        connection.execute(text(
+            "CREATE TABLE short_code_to_url (owner_id VARCHAR(2000), "
+            "url VARCHAR(2000), short_code VARCHAR(2000) PRIMARY KEY)"))
+        connection.execute(
+            text("INSERT INTO short_code_to_url VALUES ('anonymous', :url, :short_code)"),
+            [{"url": f"https://example.com/{i}", "short_code": f"code{i}"}
+             for i in range(25)])
+
+    yield engine
+    engine.dispose()
+
+
+def test_add_url_hash_backfills(legacy_engine) -> None:
+    """
+    test that existing rows get their url hash in batches and the index is created
+    """
+    assert add_url_hash(legacy_engine, batch_size=10) == 25
+
+    with legacy_engine.connect() as connection:
+        rows = connection.execute(text(
+            "SELECT url, url_hash FROM short_code_to_url")).all()
+
+    assert all(hash == url_hash(url) for url, hash in rows)
+    assert "ix_short_code_to_url_owner_id_url_hash" in [
+        index["name"] for index in inspect(legacy_engine).get_indexes("short_code_to_url")]
+
+
+def test_upgrade_is_repeatable(legacy_engine) -> None:
+    """
+    test that upgrading an up to date database does nothing
+    """
+    upgrade(legacy_engine)
+    assert add_url_hash(legacy_engine) == 0
+    upgrade(legacy_engine)
+    assert "ix_short_code_to_url_canonical_owner_id_url_hash" in [
+        index["name"] for index in inspect(legacy_engine).get_indexes("short_code_to_url")]
+
+
+def test_add_cache_max_age(legacy_engine) -> None:
+    """
+    test that the cache_max_age column is added once and existing rows stay temporary
+    """
+    add_cache_max_age(legacy_engine)
+    add_cache_max_age(legacy_engine)
+
+    with legacy_engine.connect() as connection:
+        assert connection.execute(text(
+            "SELECT count(*) FROM short_code_to_url WHERE cache_max_age IS NULL")).scalar() == 25
+
+
+def test_add_clicks_foreign_key(legacy_engine) -> None:
+    """
+    test that link_clicks gets its foreign key once, counts of missing short codes are
+    dropped and the rest kept
+    """
+    with legacy_engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS link_clicks"))
+        connection.execute(text(
+            "CREATE TABLE link_clicks (short_code VARCHAR(2000) PRIMARY KEY, "
+            "clicks BIGINT NOT NULL, last_access DATETIME)"))
+        connection.execute(text(
+            "INSERT INTO link_clicks VALUES ('code1', 3, NULL), ('gone', 5, NULL)"))
+
+    assert add_clicks_foreign_key(legacy_engine) == 1
+    assert add_clicks_foreign_key(legacy_engine) == 0
+    assert inspect(legacy_engine).get_foreign_keys("link_clicks")[0]["options"] == {
+        "ondelete": "CASCADE", "onupdate": "CASCADE"}
+
+    with legacy_engine.connect() as connection:
+        assert connection.execute(text(
+            "SELECT short_code, clicks FROM link_clicks")).all() == [("code1", 3)]
+
+    with legacy_engine.begin() as connection:
+        connection.execute(text("DROP TABLE link_clicks"))
+
+
+def run_python(args: list, cwd) -> subprocess.CompletedProcess:
+    """
+    runs python in cwd with the package importable and the demo configuration
+    """
+    env = {key: value for key, value in os.environ.items() if not key.startswith('DB_')}
+    env['PYTHONPATH'] = os.path.abspath(PACKAGE_PATH)
+    return subprocess.run(
+        [sys.executable] + args, cwd=cwd, env=env, capture_output=True, text=True)
+
+
+def test_import_does_not_touch_database(tmp_path) -> None:
+    """
+    test that importing the app creates no tables, schema work is left to the migrate
+    command or to startup
+    """
+    result = run_python(['-c', 'import shtl_ink_api.app'], tmp_path)
+    assert result.returncode == 0, result.stderr
+    database = tmp_path / 'sqlite.db'
+    assert not database.exists() or inspect(
+        create_engine(f"sqlite:///{database}")).get_table_names() == []
+
+
+def test_import_defers_supertokens(tmp_path) -> None:
+    """
+    test that importing the app leaves supertokens to worker startup and the first
+    management request
+    """
+    result = run_python(['-c', 'import sys, shtl_ink_api.app; print(sorted(name for name in '
+                         'sys.modules if name.startswith("supertokens_python")))'], tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == '[]'
+
+
+def test_migrate_command(tmp_path) -> None:
+    """
+    test that the migrate command creates every table and index
+    """
+    result = run_python(['-m', 'shtl_ink_api', 'migrate'], tmp_path)
+    assert result.returncode == 0, result.stderr
+    assert 'up to date' in result.stdout
+    inspector = inspect(create_engine(f"sqlite:///{tmp_path / 'sqlite.db'}"))
+    assert set(inspector.get_table_names()) >= {
+        'short_code_to_url', 'short_code_blocks', 'link_clicks'}
+    assert 'ix_short_code_to_url_owner_id_short_code' in [
+        index['name'] for index in inspector.get_indexes('short_code_to_url')]
@@ -0,0 +1,122 @@
+"""
+tests for routing.ReadWriteRouter, with sqlite files standing in for a primary and its
+read replicas
+"""
+
+from shtl_ink_api.models import ShortURLModel, Base
+from shtl_ink_api.routing import ReadWriteRouter
+from shtl_ink_api.app import app, get_db_router
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import create_async_engine
+from pytest import fixture
+
+DATABASE_PATHS = [
+    "./routingtest_primary.db.sqlite",
+    "./routingtest_replica0.db.sqlite",
+    "./routingtest_replica1.db.sqlite"]
+
+
+@fixture
+def engines() -> list:
+    """
+    test fixture to supply async engines for a primary and two replicas, each holding
+    its own url for the same short code
+    """
+    for i, path in enumerate(DATABASE_PATHS):
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.drop_all(bind=engine)
+        Base.metadata.create_all(bind=engine)
+
+        with Session(engine) as session:
+            session.add(ShortURLModel(
+                owner_id="anonymous", url=f"https://example.com/{i}", short_code="shared"))
+            session.commit()
+
+        engine.dispose()
+
+    yield [create_async_engine(f"sqlite+aiosqlite:///{path}") for path in DATABASE_PATHS]
+
+
+@fixture
+def client(engines, app_client) -> TestClient:
+    """
+    test fixture to supply a client for the app reading from two replicas
+    """
+    return app_client(ReadWriteRouter(engines[0], engines[1:], window=60))
+
+
+def test_reads_rotate_over_replicas(engines) -> None:
+    """
+    test that reads take turns on the replicas and that writes go to the primary
+    """
+    router = ReadWriteRouter(engines[0], engines[1:])
+    assert router.read_session().bind is engines[1]
+    assert router.read_session().bind is engines[2]
+    assert router.read_session().bind is engines[1]
+    assert router.read_engine() is engines[2]
+    assert router.primary().bind is engines[0]
+
+
+def test_reads_without_replicas_use_primary(engines) -> None:
+    """
+    test that every session is on the primary when there are no replicas
+    """
+    router = ReadWriteRouter(engines[0])
+    assert not router.replicated
+    assert router.read_session("abc").bind is engines[0]
+    assert router.read_engine("abc") is engines[0]
+
+
+def test_read_your_writes_window(engines) -> None:
+    """
+    test that keys written within the window are read from the primary, and forgotten after
+    """
+    router = ReadWriteRouter(engines[0], engines[1:], window=60)
+    router.written("abc", "someone")
+    assert router.read_session("abc").bind is engines[0]
+    assert router.read_session("other", "someone").bind is engines[0]
+    assert router.read_session("other").bind is engines[1]
+
+    router.window = 0
+    assert router.read_session("abc").bind is engines[2]
+    router.written("def")
+    assert "abc" not in router._written
+
+
+def test_app_reads_from_replicas(client) -> None:
+    """
+    test that lookups are answered from the replicas in turn
+    """
+    assert client.get("/short_code/shared").json()["url"] == "https://example.com/1"
+    assert client.get("/short_code/shared").json()["url"] == "https://example.com/2"
+
+
+def test_app_reads_own_writes(client) -> None:
+    """
+    test that changes are read back from the primary while the replicas lag behind
+    """
+    short_code = client.post(
+        "/create_short_code", json={"url": "https://example.com/new"}).json()["short_code"]
+    response = client.get(f"/short_code/{short_code}")
+    assert response.status_code == 200
+    assert response.json()["url"] == "https://example.com/new"
+    assert sorted(record["short_code"] for record in client.get("/all_short_codes").json()) \
+        == sorted(["shared", short_code])
+
+    assert client.delete("/delete_short_code/shared").status_code == 200
+    assert client.get("/short_code/shared").status_code == 404
+
+
+def test_app_replica_miss_retried_on_primary(client) -> None:
+    """
+    test that a code missing on the replica is looked up on the primary after the window
+    """
+    router = app.dependency_overrides[get_db_router]()
+    short_code = client.post(
+        "/create_short_code", json={"url": "https://example.com/new"}).json()["short_code"]
+    router.window = 0
+    response = client.get(f"/{short_code}", allow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"] == "https://example.com/new"
@@ -2,7 +2,7 @@
 tests for models.short_url_model
 """
 
-from shtl_ink_api.models import ShortURLModel
+from shtl_ink_api.models import ShortURLModel, url_hash
 """
 Creating an object and printing it calls repr, successful print will return None
 """
@@ -13,3 +13,29 @@ def test_model_repr():
         url='https://example.test.url',
         short_code='testshort')
     assert print(short_url_model) is None
+
+
+def test_model_url_hash():
+    """
+    test that setting the url keeps the url hash in sync, and that the hash is not serialized
+    """
+    short_url_model = ShortURLModel(
+        url='https://example.test.url',
+        short_code='testshort')
+    assert short_url_model.url_hash == url_hash('https://example.test.url')
+    assert len(short_url_model.url_hash) == 32
+
+    short_url_model.url = 'https://example.other.url'
+    assert short_url_model.url_hash == url_hash('https://example.other.url')
+    assert 'url_hash' not in short_url_model.to_dict()
+
+
+def test_model_to_json():
+    """
+    test that the precompiled serializer matches to_dict
+    """
+    short_url_model = ShortURLModel(
+        owner_id='someone',
+        url='https://example.test.url',
+        short_code='testshort')
+    assert short_url_model.to_json() == short_url_model.to_dict()
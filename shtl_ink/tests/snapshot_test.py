@@ -0,0 +1,320 @@
+"""
+tests for snapshot.py
+"""
+
+import os
+from time import time
+
+import shtl_ink_api.app as app_module
+from shtl_ink_api.models import ShortURLModel, ShortCodeChangeModel
+from shtl_ink_api.changes import CREATE, DELETE, change_rows, log_changes
+from shtl_ink_api.snapshot import Snapshot, SnapshotFile, DELETED
+from shtl_ink_api.snapshot import write_snapshot, export_snapshot, export_delta
+from shtl_ink_api.routing import ReadWriteRouter
+from shtl_ink_api.app import app, get_db_router, redirect_cache
+from fastapi.testclient import TestClient
+from sqlalchemy import delete, update, insert
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import create_async_engine
+from pytest import fixture
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./snapshottest.db.sqlite"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./snapshottest.db.sqlite"
+
+
+@fixture
+def engine(engine):
+    """
+    test fixture to supply the empty sqlite database of conftest.engine holding 1000
+    records
+    """
+    with Session(engine) as session:
+        session.add_all([
+            ShortURLModel(owner_id="anonymous", url=f"https://example.com/{i}",
+                          short_code=f"code{i}")
+            for i in range(1000)])
+        session.commit()
+
+    yield engine
+
+
+@fixture
+def snapshot_path(tmp_path) -> str:
+    """
+    test fixture to supply a path for a snapshot file
+    """
+    yield str(tmp_path / "redirects.snapshot")
+
+
+def test_write_and_read(snapshot_path) -> None:
+    """
+    test that every written short code is found, including ones past probe collisions,
+    and that others are not
+    """
+    rows = [(f"code{i}", f"https://example.com/{i}/ünïcode", i if i % 2 else None)
+            for i in range(5000)]
+    write_snapshot(snapshot_path, rows, len(rows))
+    snapshot_file = SnapshotFile(snapshot_path)
+    assert len(snapshot_file) == 5000
+
+    for short_code, url, cache_max_age in rows:
+        assert snapshot_file.get(short_code) == (url, cache_max_age)
+
+    assert snapshot_file.get("missing") is None
+    assert sorted(snapshot_file.items()) == sorted(rows)
+    snapshot_file.close()
+    assert [name for name in os.listdir(os.path.dirname(snapshot_path))] == [
+        "redirects.snapshot"]
+
+
+def test_export_delta_and_swap(engine, snapshot_path) -> None:
+    """
+    test that deltas carry changes and deletions since the base snapshot, and that a new
+    base snapshot replaces both
+    """
+    assert export_snapshot([engine], snapshot_path) == 1000
+    snapshot = Snapshot(snapshot_path)
+    snapshot.refresh()
+    assert snapshot.get("code1") == ("https://example.com/1", None)
+
+    with engine.begin() as connection:
+        connection.execute(update(ShortURLModel).where(
+            ShortURLModel.short_code == "code1").values(url="https://example.com/changed"))
+        connection.execute(insert(ShortCodeChangeModel), change_rows(CREATE, ["code1"]))
+
+    log_deletes(engine, "code2")
+
+    with Session(engine) as session:
+        session.add(ShortURLModel(owner_id="anonymous", url="https://example.com/new",
+                                  short_code="new"))
+        log_changes(session, CREATE, "new")
+        session.commit()
+
+    assert export_delta([engine], snapshot_path) == 3
+    assert snapshot.get("new") is None
+    snapshot.refresh()
+    assert snapshot.get("code1") == ("https://example.com/changed", None)
+    assert snapshot.get("code2") == DELETED
+    assert snapshot.get("new") == ("https://example.com/new", None)
+
+    export_snapshot([engine], snapshot_path)
+    assert not os.path.exists(f"{snapshot_path}.delta")
+    snapshot.refresh()
+    assert snapshot.delta is None
+    assert snapshot.get("code2") is None
+    assert snapshot.get("new") == ("https://example.com/new", None)
+    snapshot.close()
+
+
+def test_export_delta_reads_the_change_log(engine, snapshot_path) -> None:
+    """
+    test that a delta only looks up the short codes logged since the base snapshot, and
+    reads every row once the log was compacted past the snapshot's watermark
+    """
+    log_deletes(engine, "code1")
+    export_snapshot([engine], snapshot_path)
+
+    # the log entries of a create and delete in between cancel out, the unlogged delete
+    # is only seen by reading every row
+    with Session(engine) as session:
+        session.add(ShortURLModel(owner_id="anonymous", url="https://example.com/brief",
+                                  short_code="brief"))
+        log_changes(session, CREATE, "brief")
+        session.commit()
+
+    log_deletes(engine, "brief", "code2")
+
+    with engine.begin() as connection:
+        connection.execute(delete(ShortURLModel).where(ShortURLModel.short_code == "code3"))
+
+    assert export_delta([engine], snapshot_path) == 1
+    snapshot_file = SnapshotFile(f"{snapshot_path}.delta")
+    assert list(snapshot_file.items()) == [("code2", *DELETED)]
+    snapshot_file.close()
+
+    with engine.begin() as connection:
+        connection.execute(delete(ShortCodeChangeModel))
+
+    log_deletes(engine, "code4")
+    assert export_delta([engine], snapshot_path) == 3
+    snapshot_file = SnapshotFile(f"{snapshot_path}.delta")
+    assert sorted(short_code for short_code, _, _ in snapshot_file.items()) == [
+        "code2", "code3", "code4"]
+    snapshot_file.close()
+
+
+def test_stale_delta_ignored(snapshot_path) -> None:
+    """
+    test that a delta written for an older base snapshot is not applied
+    """
+    base_id = write_snapshot(snapshot_path, [("abc", "https://example.com/old", None)], 1)
+    write_snapshot(f"{snapshot_path}.delta", [("abc", "https://example.com/delta", None)], 1,
+                   base_id=base_id)
+    snapshot = Snapshot(snapshot_path)
+    snapshot.refresh()
+    assert snapshot.get("abc") == ("https://example.com/delta", None)
+
+    write_snapshot(snapshot_path, [("abc", "https://example.com/new", None)], 1)
+    snapshot.refresh()
+    assert snapshot.delta is None
+    assert snapshot.get("abc") == ("https://example.com/new", None)
+    snapshot.close()
+
+
+def test_overlay_until_covered(snapshot_path) -> None:
+    """
+    test that changes win over the files until a newer snapshot's watermark covers their
+    change log seq, whatever time the snapshot claims it was written
+    """
+    snapshot = Snapshot(snapshot_path)
+    snapshot.set("abc", "https://example.com/local")
+    snapshot.delete("def")
+    assert snapshot.get("abc") == ("https://example.com/local", None)
+    assert snapshot.get("def") == DELETED
+
+    # replayed by the feed of shard 0, the others came from shard 1
+    snapshot.invalidate("abc", 0, 5)
+    snapshot.invalidate("ghi", 1, 3)
+    snapshot.invalidate("jkl", 1, 4)
+
+    # written by a host whose clock runs ahead
+    rows = [(short_code, f"https://example.com/{short_code}", None)
+            for short_code in ("abc", "ghi", "jkl")]
+    write_snapshot(snapshot_path, rows, 3, created=time() + 3600, watermarks=[4, 3])
+    snapshot.refresh()
+    assert snapshot.overlay == {"def": (DELETED, None), "abc": (None, (0, 5)),
+                                "jkl": (None, (1, 4))}
+    assert snapshot.get("abc") is None
+    assert snapshot.get("ghi") == ("https://example.com/ghi", None)
+
+    write_snapshot(snapshot_path, rows, 3, created=0, watermarks=[5, 4])
+    snapshot.refresh()
+    assert snapshot.overlay == {"def": (DELETED, None)}
+    assert snapshot.get("abc") == ("https://example.com/abc", None)
+
+    # after a reset the feed may never replay the changes of this worker
+    snapshot.ignore()
+    assert snapshot.overlay == {}
+    snapshot.close()
+
+
+def test_redirects_served_from_snapshot(engine, snapshot_path, monkeypatch) -> None:
+    """
+    test that redirects are answered from the snapshot without the database, and that
+    deletes are seen right away
+    """
+    export_snapshot([engine], snapshot_path)
+    snapshot = Snapshot(snapshot_path)
+    monkeypatch.setattr(app_module, "redirect_snapshot", snapshot)
+    async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+    router = ReadWriteRouter(async_engine)
+    app.dependency_overrides[get_db_router] = lambda: router
+    app_router, app.state.db_router = app.state.db_router, router
+    redirect_cache.clear()
+
+    with TestClient(app) as client:
+        # gone from the database, still in the snapshot
+        with engine.begin() as connection:
+            connection.execute(delete(ShortURLModel).where(ShortURLModel.short_code == "code7"))
+
+        response = client.get("/code7", allow_redirects=False)
+        assert response.status_code == 307
+        assert response.headers["location"] == "https://example.com/7"
+
+        assert client.delete("/delete_short_code/code8").status_code == 200
+        assert client.get("/code8", allow_redirects=False).status_code == 404
+
+    app.dependency_overrides.clear()
+    app.state.db_router = app_router
+    snapshot.close()
+
+
+def log_deletes(engine, *short_codes: str) -> None:
+    with engine.begin() as connection:
+        connection.execute(delete(ShortURLModel).where(ShortURLModel.short_code.in_(short_codes)))
+        connection.execute(insert(ShortCodeChangeModel), change_rows(DELETE, short_codes))
+
+
+def test_watermarks_written(engine, snapshot_path) -> None:
+    """
+    test that snapshots and deltas keep the newest change log seq from before their rows
+    were read
+    """
+    log_deletes(engine, "code1", "code2")
+    export_snapshot([engine], snapshot_path)
+    log_deletes(engine, "code3")
+    export_delta([engine], snapshot_path)
+    snapshot = Snapshot(snapshot_path)
+    snapshot.refresh()
+
+    assert snapshot.base.watermarks == [2]
+    assert snapshot.delta.watermarks == [3]
+    assert snapshot.watermarks == [3]
+    assert snapshot.get("code3") == DELETED
+    snapshot.close()
+
+
+def serve(snapshot, monkeypatch, requests):
+    """
+    runs requests(client) against the app started with snapshot, returns the snapshot
+    """
+    monkeypatch.setattr(app_module, "redirect_snapshot", snapshot)
+    async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL)
+    router = ReadWriteRouter(async_engine)
+    app.dependency_overrides[get_db_router] = lambda: router
+    app_router, app.state.db_router = app.state.db_router, router
+    redirect_cache.clear()
+
+    with TestClient(app) as client:
+        requests(client)
+
+    app.dependency_overrides.clear()
+    app.state.db_router = app_router
+    snapshot.close()
+
+
+def test_changes_since_snapshot_replayed(engine, snapshot_path, monkeypatch) -> None:
+    """
+    test that a worker started after a snapshot was written does not serve short codes
+    deleted in between from it
+    """
+    export_snapshot([engine], snapshot_path)
+    log_deletes(engine, "code7")
+    snapshot = Snapshot(snapshot_path)
+
+    def requests(client):
+        assert not snapshot.ignored
+        assert client.get("/code7", allow_redirects=False).status_code == 404
+
+        # gone from the database without a log entry, still served from the snapshot
+        with engine.begin() as connection:
+            connection.execute(delete(ShortURLModel).where(ShortURLModel.short_code == "code8"))
+
+        assert client.get("/code8", allow_redirects=False).status_code == 307
+
+    serve(snapshot, monkeypatch, requests)
+
+
+def test_snapshot_ignored_past_compacted_changes(engine, snapshot_path, monkeypatch) -> None:
+    """
+    test that a snapshot older than the oldest change log entry is not served from until
+    a newer one is written
+    """
+    export_snapshot([engine], snapshot_path)
+    log_deletes(engine, "code7")
+
+    with engine.begin() as connection:
+        connection.execute(delete(ShortCodeChangeModel))
+
+    log_deletes(engine, "code8")
+    snapshot = Snapshot(snapshot_path)
+
+    def requests(client):
+        assert snapshot.ignored
+        assert client.get("/code7", allow_redirects=False).status_code == 404
+        assert client.get("/code9", allow_redirects=False).status_code == 307
+        export_snapshot([engine], snapshot_path)
+        app_module.refresh_snapshot()
+        assert not snapshot.ignored
+
+    serve(snapshot, monkeypatch, requests)